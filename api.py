@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""Read-only HTTP/JSON query API of the sensor data.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+データベースに保存したセンサーデータを、読み取り専用のHTTP/JSON APIで
+公開します。api.py は単独で動作するアプリケーションです。
+以下のように実行してください。
+
+$ python3 ./api.py
+
+使用するアドレスとポートは、config.ini の[API]で設定してください。
+
+    GET /devices : デバイスリストと最終受信時刻
+    GET /latest  : デバイス毎の最新のセンサーデータ
+    GET /range?id={originator id}&begin={epoch ms}&end={epoch ms}&step={ms}
+                 : 期間のセンサーデータをstepミリ秒毎に平均したもの
+
+レスポンスはETagを付けてキャッシュします。キャッシュはデータベースの最終行IDが
+変わったときに破棄するので、データが変わるまでデータベースへの問い合わせは
+行いません。If-None-MatchのETagが一致する場合は304を返します。
+
+Serve the sensor data stored in the database by the read-only HTTP/JSON API.
+This application works standalone. you can run as follows.
+
+$ python3 ./api.py
+
+Set the address and the port in the [API] section of the config.ini file.
+
+    GET /devices : device list and the last receive time
+    GET /latest  : the latest sensor data of each device
+    GET /range?id={originator id}&begin={epoch ms}&end={epoch ms}&step={ms}
+                 : the sensor data of the range averaged every step milliseconds
+
+The responses are cached with ETag. The cache is cleared when the last row ID
+of the database changes, so the database is not queried until the data
+changes. If the ETag of If-None-Match matches, 304 is returned.
+
+"""
+
+import json
+import zlib
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from config import cmConfig
+from logger import cmLogger
+from datastore import PlantTwitterDatastore
+
+
+class PlantTwitterQueryAPI():
+
+    # max. points of a range query
+    API_MAX_POINTS = 10000
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.cache_entries = int(
+            self.config.option_list['API']['API_CACHE_ENTRIES'])
+
+        # path -> (etag, body)
+        self.cache = OrderedDict()
+        self.data_version = None
+        self.last_id = None
+
+        self.data_store = PlantTwitterDatastore(self.logger)
+        self.data_store.openConnection(read_only=True)
+
+    def checkCache(self):
+        """Clear the cache if the last row ID changed.
+
+        他の接続がコミットした場合だけ最終行IDを確認して、変わっていれば
+        キャッシュを破棄します。
+
+        Check the last row ID only if another connection committed, and clear
+        the cache if it changed.
+        """
+
+        data_version = self.data_store.getDataVersion()
+        if data_version == self.data_version:
+            return
+        self.data_version = data_version
+
+        last_id = self.data_store.selectLastID()
+        if last_id != self.last_id:
+            self.logger.debug("api: clear cache:last id={0}".format(last_id))
+            self.last_id = last_id
+            self.cache.clear()
+
+    def getResponse(self, path):
+        """Return (status, etag, body) of the request path.
+
+        リクエストパスのレスポンス(ステータス, ETag, 本文)を返します。
+
+        Return (status, etag, body) of the request path.
+        """
+
+        self.checkCache()
+
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            (etag, body) = self.cache[path]
+            return (200, etag, body)
+
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+
+        try:
+            if url.path == '/devices':
+                data = self.getDevices()
+            elif url.path == '/latest':
+                data = self.getLatest()
+            elif url.path == '/range':
+                data = self.getRange(query)
+            else:
+                return (404, None, b'{"error": "not found"}')
+        except (KeyError, ValueError) as e:
+            return (400, None, json.dumps({'error': 'invalid query: {0}'.format(e)}).encode('utf-8'))
+
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        etag = '"{0}-{1:08x}"'.format(self.last_id, zlib.crc32(body))
+
+        self.cache[path] = (etag, body)
+        if len(self.cache) > self.cache_entries:
+            self.cache.popitem(last=False)
+
+        return (200, etag, body)
+
+    def getDevices(self):
+        devices = []
+        for b_sensor_id, device_model in self.config.device_list.items():
+            r = self.data_store.selectLatestRecord(b_sensor_id)
+            devices.append({
+                'ORIGINATOR_ID': b_sensor_id.decode('utf-8'),
+                'DEVICE_MODEL': device_model,
+                'RECEIVED_AT': r[self.data_store.ROW_INDEX_RECEIVED_AT] if r else None,
+            })
+        return devices
+
+    def getLatest(self):
+        latest = []
+        for b_sensor_id, device_model in self.config.device_list.items():
+            r = self.data_store.selectLatestRecord(b_sensor_id)
+            if r is not None:
+                latest.append(self.rowToDict(r))
+        return latest
+
+    def getRange(self, query):
+        originator_id = query['id'][0].lower()
+        begin_at = int(query['begin'][0])
+        end_at = int(query['end'][0])
+        step = int(query.get('step', ['60000'])[0])
+
+        if step <= 0 or end_at <= begin_at:
+            raise ValueError('range')
+        if (end_at - begin_at) // step > self.API_MAX_POINTS:
+            raise ValueError('too many points')
+
+        names = ('RECEIVED_AT', 'ROWS', 'DBM', 'TEMPERATURE', 'SOIL_MOISTURE', 'HUMIDITY')
+        return [dict(zip(names, r)) for r in self.data_store.selectDownsampledRecords(
+            originator_id, begin_at, end_at, step)]
+
+    def rowToDict(self, r):
+        ds = self.data_store
+        values = OrderedDict()
+        for name, index in (('ID', ds.ROW_INDEX_ID),
+                            ('ORIGINATOR_ID', ds.ROW_INDEX_ORIGINATOR_ID),
+                            ('DEVICE_MODEL', ds.ROW_INDEX_DEVICE_MODEL),
+                            ('DBM', ds.ROW_INDEX_DBM),
+                            ('TEMPERATURE', ds.ROW_INDEX_TEMPERATURE),
+                            ('SOIL_MOISTURE', ds.ROW_INDEX_SOIL_MOISTURE),
+                            ('HUMIDITY', ds.ROW_INDEX_HUMIDITY),
+                            ('CONTACT_SWITCH', ds.ROW_INDEX_CONTACT_SWITCH),
+                            ('ROCKER_SWITCH', ds.ROW_INDEX_ROCKER_SWITCH),
+                            ('CREATE_AT', ds.ROW_INDEX_CREATE_AT),
+                            ('RECEIVED_AT', ds.ROW_INDEX_RECEIVED_AT)):
+            v = r[index]
+            if isinstance(v, bytes):
+                v = v.decode('utf-8')
+            if v == '':
+                v = None
+            values[name] = v
+        return values
+
+
+class PlantTwitterQueryHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        (status, etag, body) = self.server.query_api.getResponse(self.path)
+
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.debug("--- start: {0} ----".format(__file__))
+
+    config = cmConfig()
+    address = config.option_list['API']['API_ADDRESS']
+    port = int(config.option_list['API']['API_PORT'])
+
+    api_server = HTTPServer((address, port), PlantTwitterQueryHandler)
+    api_server.query_api = PlantTwitterQueryAPI(logger)
+
+    logger.info("start: query api:{0}:{1}".format(address, port))
+    api_server.serve_forever()
+
+    logger.debug("--- end: {0} ----".format(__file__))
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""Move the old sensor data into the compressed archive.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+ARCHIVE_AFTER_DAYS日より前の'SENSORLOGS'テーブルの行を、デバイスと月毎の
+圧縮したブロック(archivestore.py)に移動します。ブロックはARCHIVE_BLOCK_ROWS行
+までで、月をまたぎません。ブロックを書き込んで、元の行を削除するまでを
+ブロック毎に1つのトランザクションで実行するので、receiver.py を停止せずに
+実行できます。archive.py は単独で動作するアプリケーションです。
+以下のように実行してください。(cronで毎晩実行できます)
+
+$ python3 ./archive.py
+$ python3 ./archive.py --days 60 --id 040154f1
+
+移動した行もPlantTwitterDatastoreのiterRecords()などで読み込めます。
+削除した行の領域は新しい行に再利用されます。ファイルを小さくする場合は、
+receiver.py を停止して "python3 ./migrate.py --vacuum" を実行してください。
+DATA_STORE_BACKENDが'sqlite'の場合だけ使用できます。
+
+Move the rows of the 'SENSORLOGS' table older than ARCHIVE_AFTER_DAYS days
+into the compressed blocks (archivestore.py) of each device and month.
+A block has ARCHIVE_BLOCK_ROWS rows at most, and does not span months.
+Writing a block and deleting the rows is a transaction of each block, so you
+can run it without stopping receiver.py.
+This application works standalone. you can run as follows.
+(You can run it every night by cron)
+
+$ python3 ./archive.py
+$ python3 ./archive.py --days 60 --id 040154f1
+
+The moved rows are still read by iterRecords() and others of
+PlantTwitterDatastore. The space of the deleted rows is reused for the new
+rows. To reduce the file size, stop receiver.py and run
+"python3 ./migrate.py --vacuum".
+Only DATA_STORE_BACKEND 'sqlite' is supported.
+
+"""
+
+import time
+import sqlite3
+import argparse
+import datetime
+
+from config import cmConfig
+from logger import cmLogger
+from datastore import PlantTwitterDatastore
+from sqlitestore import PlantTwitterSqliteStore
+from archivestore import PlantTwitterArchiveStore
+
+
+class PlantTwitterArchiver():
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        self.archive_days = int(config.option_list['Archive']['ARCHIVE_AFTER_DAYS'])
+        self.block_rows = int(config.option_list['Archive']['ARCHIVE_BLOCK_ROWS'])
+
+        self.archive = PlantTwitterArchiveStore(self.logger)
+
+    def getCutoff(self, now_datetime, days):
+        # the rows before the midnight of the day are archived.
+        cutoff = (now_datetime - datetime.timedelta(days=days)).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        return int(time.mktime(cutoff.timetuple()) * 1000)
+
+    def selectOriginatorIDs(self, data_store, cutoff):
+        sql = "SELECT DISTINCT ORIGINATOR_ID FROM SENSORLOGS WHERE RECEIVED_AT < ?"
+        try:
+            rows = data_store.conn.execute(sql, (cutoff,)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+        # ORIGINATOR_ID is an integer in the typed schema.
+        if data_store.backend.schema_version >= data_store.backend.SCHEMA_VERSION_TYPED:
+            return [b'%08x' % r[0] for r in rows]
+        return [data_store.toOriginatorID(r[0]) for r in rows]
+
+    def archiveDevice(self, data_store, originator_id, cutoff):
+        """Move the rows of the device before cutoff into the blocks.
+
+        デバイスのcutoff(エポックミリ秒)より前の行をブロックに移動して、
+        (移動した行数, ブロックのバイト数)を返します。
+
+        Move the rows of the device before cutoff (epoch milliseconds) into
+        the blocks, and return (moved rows, bytes of the blocks).
+        """
+
+        moved_rows = 0
+        moved_bytes = 0
+
+        block = []
+        block_month = None
+        for r in data_store.iterRecords(originator_id, 0, cutoff, archived=False):
+            month = time.strftime(
+                '%Y-%m', time.localtime(r[data_store.ROW_INDEX_RECEIVED_AT] // 1000))
+            if block and (len(block) >= self.block_rows or month != block_month or
+                          r[data_store.ROW_INDEX_DEVICE_MODEL] !=
+                          block[0][data_store.ROW_INDEX_DEVICE_MODEL]):
+                moved_bytes += self.moveBlock(data_store, block)
+                moved_rows += len(block)
+                block = []
+            block.append(r)
+            block_month = month
+
+        if block:
+            moved_bytes += self.moveBlock(data_store, block)
+            moved_rows += len(block)
+
+        return (moved_rows, moved_bytes)
+
+    def moveBlock(self, data_store, rows):
+        # write a block and delete the rows in a transaction
+        data = self.archive.encodeBlock(rows)
+
+        # the rows must be decoded as they were.
+        decoded = self.archive.decodeBlock(rows[0][data_store.ROW_INDEX_ORIGINATOR_ID],
+                                           rows[0][data_store.ROW_INDEX_DEVICE_MODEL], data)
+        if list(decoded) != [tuple(r) for r in rows]:
+            raise ValueError("decoded rows differ:{0}".format(
+                rows[0][data_store.ROW_INDEX_ORIGINATOR_ID]))
+
+        row_ids = [r[data_store.ROW_INDEX_ID] for r in rows]
+        try:
+            self.archive.insertBlock(data_store.conn, rows, data)
+            for begin in range(0, len(row_ids), data_store.backend.SQL_PARAMS_MAX):
+                chunk = row_ids[begin:begin + data_store.backend.SQL_PARAMS_MAX]
+                data_store.conn.execute("DELETE FROM SENSORLOGS WHERE ID IN (" +
+                                        ", ".join("?" * len(chunk)) + ")", chunk)
+            data_store.conn.commit()
+        except sqlite3.Error:
+            data_store.conn.rollback()
+            raise
+
+        self.logger.debug("archive: block:{0} rows={1} bytes={2}".format(
+            rows[0][data_store.ROW_INDEX_ORIGINATOR_ID], len(rows), len(data)))
+
+        return len(data)
+
+    def archiveDevices(self, now_datetime, days=None, originator_id=None):
+        """Archive the old rows of all devices or a device.
+
+        全デバイス(originator_idを指定した場合はそのデバイス)の古い行を
+        移動します。成功した場合はTrueを返します。
+
+        Archive the old rows of all devices, or the device of originator_id.
+        If it succeeds, return True.
+        """
+
+        data_store = PlantTwitterDatastore(self.logger)
+        data_store.openConnection()
+
+        if data_store.hasArchive() is not True:
+            self.logger.error(("archive: the sqlite backend of the schema version {0} " +
+                               "or later is required. run migrate.py.").format(
+                                   PlantTwitterSqliteStore.SCHEMA_VERSION_ARCHIVE))
+            data_store.closeConnection()
+            return False
+
+        cutoff = self.getCutoff(now_datetime, self.archive_days if days is None else days)
+        if originator_id is None:
+            originator_ids = self.selectOriginatorIDs(data_store, cutoff)
+        else:
+            originator_ids = [data_store.toOriginatorID(originator_id)]
+
+        result = True
+        for o_id in originator_ids:
+            try:
+                (rows, size) = self.archiveDevice(data_store, o_id, cutoff)
+            except (sqlite3.Error, ValueError) as e:
+                self.logger.error("archive: {0}:{1}".format(o_id, e))
+                result = False
+                continue
+            self.logger.info("archive: {0} rows={1} bytes={2}".format(o_id, rows, size))
+
+        data_store.closeConnection()
+
+        return result
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Move the old sensor data into the archive.')
+    arg_parser.add_argument('--id', help='originator id (default: all devices)')
+    arg_parser.add_argument('--days', type=int,
+                            help='archive the rows older than the days (default: config.ini)')
+    args = arg_parser.parse_args()
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.debug("--- start: {0} ----".format(__file__))
+
+    eo_archiver = PlantTwitterArchiver(logger)
+    if eo_archiver.archiveDevices(datetime.datetime.now(), args.days,
+                                  args.id.lower() if args.id else None):
+        logger.info("archive result: Success")
+    else:
+        logger.error("archive result: Failure")
+
+    logger.debug("--- end: {0} ----".format(__file__))
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+"""Compressed archive storage of the old sensor data.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+archive.py が'SENSORLOGS'テーブルから移動した古い行を、デバイスと月毎の
+圧縮したブロックで'ARCHIVE_BLOCKS'テーブルに保存するストレージです。
+ブロックは列毎にGorillaと同様の方式で符号化します。受信時刻と行IDは
+差分の差分、dBmと土壌水分量は差分、気温と湿度(float64)とペイロードは
+前の値とのXORで、値が変わらない列は1ビットです。土壌水分量、気温、湿度は
+ペイロードから求めた値なので、ブロック内の同じペイロードの行と同じ場合は
+まとめて1ビットです。
+PlantTwitterDatastoreのiterRecords()、iterColumns()、
+selectDownsampledRecords()、selectLatestRecord()は、期間に含まれるブロックを
+復号して、'SENSORLOGS'テーブルの行と同じ形式で返します。
+
+Storage of the old rows moved from the 'SENSORLOGS' table by archive.py, in
+compressed blocks of each device and month in the 'ARCHIVE_BLOCKS' table.
+The columns of a block are encoded in the same way as Gorilla. The receive
+time and the row ID are delta-of-delta, dBm and the soil moisture are
+delta, and the temperature and the humidity (float64) and the payload are
+XOR with the previous value, so a column of the same value costs a bit.
+The soil moisture, the temperature and the humidity are decoded from the
+payload, so they cost a bit together if they are the same as a row of the
+same payload in the block.
+iterRecords(), iterColumns(), selectDownsampledRecords() and
+selectLatestRecord() of PlantTwitterDatastore decode the blocks in the time
+range, and return the rows of the same form as the 'SENSORLOGS' table.
+
+ARCHIVE_BLOCKS:
+    ID INTEGER PRIMARY KEY AUTOINCREMENT
+    ORIGINATOR_ID TEXT
+    DEVICE_MODEL TEXT
+    MONTH TEXT ('YYYY-MM' of the local time)
+    ROWS INTEGER
+    BEGIN_AT INTEGER (the first receive time)
+    END_AT INTEGER (the last receive time)
+    DATA BLOB
+
+Block (bit stream, big endian):
+    version 8 bits, rows 32 bits, strings 8 bits,
+    the strings (length 8 bits, UTF-8) of TELEGRAM_TYPE, CONTACT_SWITCH and
+    ROCKER_SWITCH, and the rows:
+        RECEIVED_AT, ID: delta-of-delta
+        DBM: delta (-2**40: none)
+        TELEGRAM_TYPE, CONTACT_SWITCH, ROCKER_SWITCH: delta of the string index
+        DB_0..DB_3: XOR of (length << 32 | payload)
+        '0': SOIL_MOISTURE, TEMPERATURE and HUMIDITY are the same as the last
+             row of the same payload in the block, or '1' and:
+            SOIL_MOISTURE: delta (-2**40: none)
+            TEMPERATURE, HUMIDITY: XOR of float64 (NaN: none)
+    integer: '0' zero, '10' 5 bits, '110' 11 bits, '1110' 14 bits,
+             '11110' 32 bits, '11111' 64 bits (zigzag)
+    XOR: '0' same, '10' in the previous window,
+         '11' leading zeros 5 bits, length - 1 6 bits, the meaningful bits
+"""
+
+import time
+import heapq
+import struct
+import binascii
+import itertools
+import sqlite3
+
+from config import cmConfig
+from logger import cmLogger
+
+
+class PlantTwitterBitWriter():
+
+    def __init__(self):
+        self.data = bytearray()
+        self.bits = 0
+        self.count = 0
+
+    def write(self, value, width):
+        self.bits = (self.bits << width) | (value & ((1 << width) - 1))
+        self.count += width
+        while self.count >= 8:
+            self.count -= 8
+            self.data.append((self.bits >> self.count) & 0xff)
+        self.bits &= (1 << self.count) - 1
+
+    def getBytes(self):
+        if self.count == 0:
+            return bytes(self.data)
+        return bytes(self.data) + bytes(((self.bits << (8 - self.count)) & 0xff,))
+
+
+class PlantTwitterBitReader():
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        self.bits = 0
+        self.count = 0
+
+    def read(self, width):
+        while self.count < width:
+            self.bits = (self.bits << 8) | self.data[self.offset]
+            self.offset += 1
+            self.count += 8
+        self.count -= width
+        value = self.bits >> self.count
+        self.bits &= (1 << self.count) - 1
+        return value
+
+    def readPrefix(self, limit):
+        # number of '1' bits before a '0', up to limit
+        ones = 0
+        while ones < limit and self.read(1) == 1:
+            ones += 1
+        return ones
+
+
+class PlantTwitterArchiveStore():
+
+    ARCHIVE_VERSION = 1
+
+    # integer buckets: bits of the zigzag value after the '1...0' prefix
+    INT_BUCKETS = (5, 11, 14, 32, 64)
+    # absent DBM and SOIL_MOISTURE
+    INT_NONE = -(1 << 40)
+
+    FLOAT = struct.Struct('<d')
+    FLOAT_BITS = struct.Struct('<Q')
+    FLOAT_NONE = float('nan')
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def writeInt(self, writer, value):
+        if value == 0:
+            writer.write(0, 1)
+            return
+        zigzag = value * 2 if value > 0 else -value * 2 - 1
+        for (ones, width) in enumerate(self.INT_BUCKETS):
+            if zigzag < (1 << width) or ones == len(self.INT_BUCKETS) - 1:
+                # '1' * (ones + 1) + '0', the last bucket has no '0'.
+                if ones == len(self.INT_BUCKETS) - 1:
+                    writer.write((1 << (ones + 1)) - 1, ones + 1)
+                else:
+                    writer.write(((1 << (ones + 1)) - 1) << 1, ones + 2)
+                writer.write(zigzag, width)
+                return
+
+    def readInt(self, reader):
+        ones = reader.readPrefix(len(self.INT_BUCKETS))
+        if ones == 0:
+            return 0
+        zigzag = reader.read(self.INT_BUCKETS[ones - 1])
+        return zigzag // 2 if zigzag % 2 == 0 else -(zigzag + 1) // 2
+
+    def writeXor(self, writer, state, value):
+        # state: [previous value, leading zeros, trailing zeros]
+        xor = value ^ state[0]
+        state[0] = value
+        if xor == 0:
+            writer.write(0, 1)
+            return
+
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if state[1] is not None and leading >= state[1] and trailing >= state[2]:
+            writer.write(0b10, 2)
+            writer.write(xor >> state[2], 64 - state[1] - state[2])
+            return
+
+        meaningful = 64 - leading - trailing
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        writer.write(meaningful - 1, 6)
+        writer.write(xor >> trailing, meaningful)
+        state[1] = leading
+        state[2] = trailing
+
+    def readXor(self, reader, state):
+        if reader.read(1) == 0:
+            return state[0]
+        if reader.read(1) == 0:
+            xor = reader.read(64 - state[1] - state[2]) << state[2]
+        else:
+            state[1] = reader.read(5)
+            meaningful = reader.read(6) + 1
+            state[2] = 64 - state[1] - meaningful
+            xor = reader.read(meaningful) << state[2]
+        state[0] ^= xor
+        return state[0]
+
+    def toFloatBits(self, value):
+        if value == '' or value is None:
+            value = self.FLOAT_NONE
+        return self.FLOAT_BITS.unpack(self.FLOAT.pack(value))[0]
+
+    def fromFloatBits(self, bits):
+        value = self.FLOAT.unpack(self.FLOAT_BITS.pack(bits))[0]
+        return '' if value != value else value
+
+    def toPayload(self, data_dl):
+        payload = b''.join(binascii.unhexlify(d) for d in data_dl if d != '')
+        return (len(payload) << 32) | int.from_bytes(payload.ljust(4, b'\0'), 'big')
+
+    def fromPayload(self, value):
+        payload = (value & 0xffffffff).to_bytes(4, 'big')[:value >> 32]
+        data_dl = [binascii.hexlify(payload[i:i + 1]) for i in range(len(payload))]
+        return data_dl + [''] * (4 - len(data_dl))
+
+    def encodeBlock(self, rows):
+        """Encode the rows of a device into a block.
+
+        デバイスの行(受信時刻の順)を1つのブロックに符号化します。
+
+        Encode the rows of a device (in the order of the receive time) into
+        a block.
+        """
+
+        strings = []
+        for r in rows:
+            for v in (r[2], r[11], r[12]):
+                if v not in strings:
+                    strings.append(v)
+        if len(strings) > 255:
+            raise ValueError("too many strings in a block:{0}".format(len(strings)))
+
+        writer = PlantTwitterBitWriter()
+        writer.write(self.ARCHIVE_VERSION, 8)
+        writer.write(len(rows), 32)
+        writer.write(len(strings), 8)
+        for v in strings:
+            encoded = v.encode('utf-8')
+            writer.write(len(encoded), 8)
+            for c in encoded:
+                writer.write(c, 8)
+
+        # previous value and delta of the delta-of-delta columns
+        received = [0, 0]
+        row_id = [0, 0]
+        # previous value of the delta columns
+        previous = [0, 0, 0, 0, 0]
+        temperature = [0, None, None]
+        humidity = [0, None, None]
+        payload = [0, None, None]
+        # payload -> the values decoded from it
+        derived = {}
+
+        for r in rows:
+            for (state, value) in ((received, r[14]), (row_id, r[15])):
+                delta = value - state[0]
+                self.writeInt(writer, delta - state[1])
+                state[0] = value
+                state[1] = delta
+
+            values = (self.INT_NONE if r[7] == '' else r[7],
+                      strings.index(r[2]), strings.index(r[11]), strings.index(r[12]))
+            for (i, value) in enumerate(values):
+                self.writeInt(writer, value - previous[i])
+                previous[i] = value
+
+            payload_value = self.toPayload(r[3:7])
+            self.writeXor(writer, payload, payload_value)
+
+            # the values are the same as the last row of the same payload mostly.
+            values = (self.INT_NONE if r[9] == '' else r[9],
+                      self.toFloatBits(r[8]), self.toFloatBits(r[10]))
+            if derived.get(payload_value) == values:
+                writer.write(0, 1)
+                previous[4] = values[0]
+                temperature[0] = values[1]
+                humidity[0] = values[2]
+                continue
+
+            writer.write(1, 1)
+            derived[payload_value] = values
+            self.writeInt(writer, values[0] - previous[4])
+            previous[4] = values[0]
+            self.writeXor(writer, temperature, values[1])
+            self.writeXor(writer, humidity, values[2])
+
+        return writer.getBytes()
+
+    def decodeBlock(self, originator_id, device_model, data):
+        """Generator that decodes the rows of a block.
+
+        ブロックを復号して、'SENSORLOGS'テーブルと同じ形式の行を返す
+        ジェネレーターです。(CREATE_ATは受信時刻から作成します)
+
+        Generator that decodes a block, and returns the rows of the same form
+        as the 'SENSORLOGS' table. (CREATE_AT is made from the receive time)
+        """
+
+        reader = PlantTwitterBitReader(data)
+        if reader.read(8) != self.ARCHIVE_VERSION:
+            self.logger.error("archive: unsupported block:{0}".format(originator_id))
+            return
+        rows = reader.read(32)
+        strings = []
+        for i in range(reader.read(8)):
+            strings.append(bytes(reader.read(8) for c in range(reader.read(8))).decode('utf-8'))
+
+        received = [0, 0]
+        row_id = [0, 0]
+        previous = [0, 0, 0, 0, 0]
+        temperature = [0, None, None]
+        humidity = [0, None, None]
+        payload = [0, None, None]
+        derived = {}
+
+        for i in range(rows):
+            for state in (received, row_id):
+                state[1] += self.readInt(reader)
+                state[0] += state[1]
+
+            for j in range(4):
+                previous[j] += self.readInt(reader)
+
+            payload_value = self.readXor(reader, payload)
+
+            if reader.read(1) == 0:
+                (previous[4], temperature[0], humidity[0]) = derived[payload_value]
+            else:
+                previous[4] += self.readInt(reader)
+                self.readXor(reader, temperature)
+                self.readXor(reader, humidity)
+                derived[payload_value] = (previous[4], temperature[0], humidity[0])
+
+            data_dl = self.fromPayload(payload_value)
+            temperature_value = self.fromFloatBits(temperature[0])
+            humidity_value = self.fromFloatBits(humidity[0])
+
+            create_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(received[0] // 1000))
+
+            yield (originator_id, device_model, strings[previous[1]],
+                   data_dl[0], data_dl[1], data_dl[2], data_dl[3],
+                   '' if previous[0] == self.INT_NONE else previous[0],
+                   temperature_value,
+                   '' if previous[4] == self.INT_NONE else previous[4],
+                   humidity_value, strings[previous[2]], strings[previous[3]],
+                   create_at, received[0], row_id[0])
+
+    def insertBlock(self, conn, rows, data):
+        # rows of a device and a month, data of encodeBlock(): committed by the caller.
+        begin_at = rows[0][14]
+        conn.execute("INSERT INTO ARCHIVE_BLOCKS (ORIGINATOR_ID, DEVICE_MODEL, MONTH, " +
+                     "ROWS, BEGIN_AT, END_AT, DATA) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (rows[0][0], rows[0][1],
+                      time.strftime('%Y-%m', time.localtime(begin_at // 1000)),
+                      len(rows), begin_at, max(r[14] for r in rows), data))
+
+    def iterRecords(self, conn, originator_id, begin_at, end_at):
+        """Generator of the archived rows of the time range.
+
+        指定したデバイスと期間(begin_at以上end_at未満)のブロックの行を、
+        デバイス毎に受信時刻の順に返すジェネレーターです。
+        originator_idがNoneの場合は全デバイスが対象です。
+
+        Generator of the rows of the blocks of the device and the time range
+        (begin_at or later and before end_at), in the order of the receive
+        time of each device. If originator_id is None, all devices are
+        selected.
+        """
+
+        sql = "SELECT ORIGINATOR_ID, DEVICE_MODEL, DATA FROM ARCHIVE_BLOCKS " + \
+            "WHERE END_AT >= ? AND BEGIN_AT < ? "
+        params = (begin_at, end_at)
+        if originator_id is not None:
+            sql += "AND ORIGINATOR_ID = ? "
+            params += (originator_id,)
+        sql += "ORDER BY ORIGINATOR_ID, BEGIN_AT"
+
+        try:
+            blocks = conn.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return
+
+        # the blocks of a device may overlap with the rows replayed later.
+        for (o_id, device_blocks) in itertools.groupby(blocks, lambda b: b[0]):
+            for r in heapq.merge(*[self.decodeBlock(o_id, device_model, data)
+                                   for (o_id, device_model, data) in device_blocks],
+                                 key=lambda r: (r[14], r[15])):
+                if begin_at <= r[14] < end_at:
+                    yield r
+
+    def selectLatestRecord(self, conn, originator_id):
+        try:
+            block = conn.execute(
+                "SELECT DEVICE_MODEL, DATA FROM ARCHIVE_BLOCKS WHERE ORIGINATOR_ID = ? " +
+                "ORDER BY END_AT DESC LIMIT 1", (originator_id,)).fetchone()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return None
+        if block is None:
+            return None
+        return max(self.decodeBlock(originator_id, block[0], block[1]),
+                   key=lambda r: (r[14], r[15]), default=None)
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+"""Back up the database online without stopping the receiver.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+receiver.py が書き込み中の sensorlogs.db を、sqliteのオンラインバックアップ
+APIでBACKUP_PAGES_PER_STEPページずつコピーして、ステップの間に
+BACKUP_STEP_SLEEP秒待機します。スナップショットは整合性を検査してから
+DATA_FILE_PATHのbackupディレクトリに保存され(BACKUP_COMPRESSが'gzip'の場合は
+圧縮)、新しい順にBACKUP_COUNT個まで残します。
+backup.py は単独で動作するアプリケーションです。以下のように実行してください。
+(cronで毎晩実行できます)
+
+$ python3 ./backup.py
+$ python3 ./backup.py --list
+$ python3 ./backup.py --verify backup/sensorlogs-20170601-030000.db.gz
+$ python3 ./backup.py --restore latest --force
+
+データベースがWALモード("python3 ./migrate.py --wal")の場合は、バックアップの
+間1つの読み込みトランザクションを保持するので、コピーは開始時点の内容で、
+書き込みで最初からやり直すことはなく、receiver.py のコミットも待たされません。
+(バックアップの間はWALのチェックポイントが進まないので、WALが大きくなります)
+それ以外のモードでは、各ステップの間だけ読み込みロックを保持するので、コミットは
+最大で1ステップ待たされます。ステップがBACKUP_STEP_BUDGET秒を超えた場合は、
+その比率で次の待機を長くします。書き込みがあるとコピーは最初からやり直しになり、
+BACKUP_MAX_RESTARTS回を超えた場合は、BACKUP_RETRY_SECONDS秒後にコピーを
+やり直します。BACKUP_RETRY_COUNT回やり直しても完了しない場合は失敗します。
+(コミットを待たせる全ページのコピーは行いません)
+setup_db.sh はデータベースをWALモードで作成します。
+--restoreは receiver.py を停止して実行してください。スナップショットを展開して
+整合性を検査してから、データベースファイルを置き換えます。元のファイルは
+sensorlogs.db.{日時}.old に移動します。(--forceが必要です)
+
+Copy sensorlogs.db, while receiver.py is writing it, by the online backup
+API of sqlite BACKUP_PAGES_PER_STEP pages at a step, and wait
+BACKUP_STEP_SLEEP seconds between the steps. The snapshot is checked for
+integrity, and saved in the backup directory of DATA_FILE_PATH (compressed if
+BACKUP_COMPRESS is 'gzip'). The newest BACKUP_COUNT snapshots are kept.
+This application works standalone. you can run as follows.
+(You can run it every night by cron)
+
+$ python3 ./backup.py
+$ python3 ./backup.py --list
+$ python3 ./backup.py --verify backup/sensorlogs-20170601-030000.db.gz
+$ python3 ./backup.py --restore latest --force
+
+If the database is in the WAL mode ("python3 ./migrate.py --wal"), a read
+transaction is held during the backup, so the copy is the contents at the
+start, it is never restarted by the writes, and the commits of receiver.py
+never wait. (The WAL grows during the backup, because the checkpoint cannot
+go past the transaction)
+In the other modes, the read lock is held only during each step, so a commit
+waits for a step at most. If a step takes longer than BACKUP_STEP_BUDGET
+seconds, the next pause is longer by the ratio. A write restarts the copy
+from the beginning. After BACKUP_MAX_RESTARTS restarts, the copy is tried
+again after BACKUP_RETRY_SECONDS seconds, and the backup fails if it is not
+completed in BACKUP_RETRY_COUNT retries. (All the pages are never copied at
+a step, which makes the commits wait)
+setup_db.sh creates the database in the WAL mode.
+Run --restore while receiver.py is stopped. The snapshot is extracted and
+checked for integrity, then replaces the database file. The old file is
+moved to sensorlogs.db.{datetime}.old. (--force is required)
+
+"""
+
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import argparse
+import datetime
+import tempfile
+
+from config import cmConfig
+from logger import cmLogger
+from datastore import PlantTwitterDatastore
+
+
+class PlantTwitterBackupRestarted(Exception):
+    # the copy was restarted BACKUP_MAX_RESTARTS times: stop the steps.
+    pass
+
+
+class PlantTwitterBackup():
+
+    BACKUP_DIRECTORY = '/backup'
+    BACKUP_PREFIX = 'sensorlogs-'
+    BACKUP_SUFFIXES = ('.db', '.db.gz')
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        self.db_file = config.option_list['DEFAULT'][
+            'DATA_FILE_PATH'] + PlantTwitterDatastore.DATA_STORE_FILE
+        self.backup_path = config.option_list['DEFAULT'][
+            'DATA_FILE_PATH'] + self.BACKUP_DIRECTORY
+
+        self.pages = int(config.option_list['Backup']['BACKUP_PAGES_PER_STEP'])
+        self.step_sleep = float(config.option_list['Backup']['BACKUP_STEP_SLEEP'])
+        self.step_budget = float(config.option_list['Backup']['BACKUP_STEP_BUDGET'])
+        self.max_restarts = int(config.option_list['Backup']['BACKUP_MAX_RESTARTS'])
+        self.retry_count = int(config.option_list['Backup']['BACKUP_RETRY_COUNT'])
+        self.retry_seconds = float(config.option_list['Backup']['BACKUP_RETRY_SECONDS'])
+        self.count = int(config.option_list['Backup']['BACKUP_COUNT'])
+        self.compress = config.option_list['Backup']['BACKUP_COMPRESS']
+
+        # state of a backup: the progress of the steps
+        self.remaining = None
+        self.restarts = 0
+        self.steps = 0
+        self.step_max = 0
+        self.step_begin = 0
+        # copies tried again after the restarts
+        self.retries = 0
+
+    def pauseStep(self, status, remaining, total):
+        # progress of Connection.backup(): called after each step
+        step_time = time.perf_counter() - self.step_begin
+        self.steps += 1
+        self.step_max = max(self.step_max, step_time)
+
+        # a write of the other connection restarts the copy.
+        if self.remaining is not None and remaining > self.remaining:
+            self.restarts += 1
+            self.logger.info("backup: restarted by a write:{0}".format(self.restarts))
+            if self.restarts > self.max_restarts:
+                raise PlantTwitterBackupRestarted()
+        self.remaining = remaining
+
+        if remaining > 0:
+            pause = self.step_sleep
+            if step_time > self.step_budget:
+                pause *= step_time / self.step_budget
+            time.sleep(pause)
+        self.step_begin = time.perf_counter()
+
+    def copyDatabase(self, file_name):
+        """Copy the database into file_name by the online backup API.
+
+        データベースをオンラインバックアップAPIでfile_nameにコピーします。
+        WALモードの場合は、読み込みトランザクションで開始時点の内容を固定します。
+
+        Copy the database into file_name by the online backup API.
+        In the WAL mode, a read transaction pins the contents at the start.
+        If the copy is restarted more than BACKUP_MAX_RESTARTS times by the
+        writes, PlantTwitterBackupRestarted is raised.
+        """
+
+        (self.remaining, self.restarts, self.steps, self.step_max) = (None, 0, 0, 0)
+
+        source = sqlite3.connect(self.db_file)
+        dest = sqlite3.connect(file_name)
+        try:
+            journal_mode = source.execute("PRAGMA journal_mode").fetchone()[0]
+            if journal_mode == 'wal':
+                source.execute("BEGIN")
+                source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+            # the copy is checked after the backup, it does not need a journal.
+            dest.execute("PRAGMA journal_mode = OFF")
+            dest.execute("PRAGMA synchronous = OFF")
+
+            self.step_begin = time.perf_counter()
+            source.backup(dest, pages=self.pages, progress=self.pauseStep,
+                          sleep=self.step_sleep)
+        finally:
+            dest.close()
+            source.close()
+
+        self.logger.info("backup: copied:{0} mode={1} steps={2} restarts={3} "
+                         "max step={4:.3f} sec".format(file_name, journal_mode, self.steps,
+                                                       self.restarts, self.step_max))
+
+    def copyDatabaseRetry(self, file_name):
+        """Copy the database, and try again later if the writes restart it.
+
+        データベースをコピーします。書き込みで中断した場合は
+        BACKUP_RETRY_SECONDS秒後に、BACKUP_RETRY_COUNT回までやり直します。
+        コピーできた場合はTrueを返します。
+
+        Copy the database. If the writes stop the copy, try again after
+        BACKUP_RETRY_SECONDS seconds, BACKUP_RETRY_COUNT times at most.
+        If it is copied, return True.
+        """
+
+        self.retries = 0
+        while True:
+            try:
+                self.copyDatabase(file_name)
+                return True
+            except PlantTwitterBackupRestarted:
+                self.logger.error("backup: restarted {0} times by the writes. use the WAL "
+                                  "mode: python3 ./migrate.py --wal".format(self.restarts - 1))
+            if self.retries >= self.retry_count:
+                return False
+            self.retries += 1
+            time.sleep(self.retry_seconds)
+
+    def checkDatabase(self, file_name):
+        """Check the integrity of a database file, and return True if it is ok.
+
+        データベースファイルの整合性('PRAGMA integrity_check')と、SENSORLOGS
+        テーブルがあることを検査します。問題がない場合はTrueを返します。
+
+        Check the integrity of a database file ('PRAGMA integrity_check') and
+        that the SENSORLOGS table exists. If it is ok, return True.
+        """
+
+        try:
+            conn = sqlite3.connect('file:' + file_name + '?mode=ro', uri=True)
+        except sqlite3.Error as e:
+            self.logger.error("backup: cannot open:{0}:{1}".format(file_name, e))
+            return False
+
+        try:
+            result = [r[0] for r in conn.execute("PRAGMA integrity_check")]
+            tables = [r[0] for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")]
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.Error as e:
+            self.logger.error("backup: check error:{0}:{1}".format(file_name, e.args[0]))
+            return False
+        finally:
+            conn.close()
+
+        if result != ['ok']:
+            self.logger.error("backup: integrity error:{0}:{1}".format(
+                file_name, '; '.join(result[:10])))
+            return False
+        if 'SENSORLOGS' not in tables:
+            self.logger.error("backup: no SENSORLOGS table:{0}".format(file_name))
+            return False
+
+        self.logger.info("backup: integrity ok:{0} version={1}".format(file_name, version))
+        return True
+
+    def syncFile(self, file_name):
+        with open(file_name, 'rb') as f:
+            os.fsync(f.fileno())
+
+    def createSnapshot(self, now_datetime):
+        """Create a snapshot of the database, and rotate the old snapshots.
+
+        データベースのスナップショットを作成して、古いスナップショットを
+        削除します。成功した場合はTrueを返します。
+
+        Create a snapshot of the database, and delete the old snapshots.
+        If it succeeds, return True.
+        """
+
+        if os.path.exists(self.db_file) is not True:
+            self.logger.error("backup: no database:{0}".format(self.db_file))
+            return False
+        if os.path.exists(self.backup_path) is not True:
+            os.makedirs(self.backup_path)
+
+        name = self.backup_path + '/' + self.BACKUP_PREFIX + \
+            now_datetime.strftime('%Y%m%d-%H%M%S') + self.BACKUP_SUFFIXES[0]
+        snapshot_file = name + '.gz' if self.compress == 'gzip' else name
+        copy_file = name + '.tmp'
+
+        begin_time = time.perf_counter()
+        try:
+            if self.copyDatabaseRetry(copy_file) is not True:
+                return False
+            if self.checkDatabase(copy_file) is not True:
+                return False
+
+            if self.compress == 'gzip':
+                with open(copy_file, 'rb') as f_in, \
+                        gzip.open(snapshot_file + '.tmp', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(copy_file)
+                copy_file = snapshot_file + '.tmp'
+
+            # the snapshot appears only when it is complete.
+            self.syncFile(copy_file)
+            os.replace(copy_file, snapshot_file)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            self.logger.error("backup: {0}:{1}".format(snapshot_file, e))
+            return False
+        finally:
+            if os.path.exists(copy_file):
+                os.remove(copy_file)
+
+        self.logger.info("backup: snapshot:{0} bytes={1} time={2:.1f} sec".format(
+            snapshot_file, os.path.getsize(snapshot_file), time.perf_counter() - begin_time))
+
+        self.rotateSnapshots()
+        return True
+
+    def listSnapshots(self):
+        # the oldest first: the names are sorted by the time.
+        if os.path.exists(self.backup_path) is not True:
+            return []
+        return [self.backup_path + '/' + n for n in sorted(os.listdir(self.backup_path))
+                if n.startswith(self.BACKUP_PREFIX) and n.endswith(self.BACKUP_SUFFIXES)]
+
+    def rotateSnapshots(self):
+        snapshots = self.listSnapshots()
+        for snapshot_file in snapshots[:max(0, len(snapshots) - self.count)]:
+            self.logger.info("backup: delete:{0}".format(snapshot_file))
+            os.remove(snapshot_file)
+
+    def extractSnapshot(self, snapshot_file, file_name):
+        # a copy of the database from the snapshot: gzip or not
+        if snapshot_file.endswith('.gz'):
+            with gzip.open(snapshot_file, 'rb') as f_in, open(file_name, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        else:
+            shutil.copyfile(snapshot_file, file_name)
+
+    def verifySnapshot(self, snapshot_file):
+        """Extract a snapshot into a temporary directory, and check it.
+
+        スナップショットを一時ディレクトリに展開して、整合性を検査します。
+
+        Extract a snapshot into a temporary directory, and check its
+        integrity.
+        """
+
+        with tempfile.TemporaryDirectory() as temp_path:
+            file_name = temp_path + PlantTwitterDatastore.DATA_STORE_FILE
+            try:
+                self.extractSnapshot(snapshot_file, file_name)
+            except (OSError, EOFError) as e:
+                self.logger.error("backup: cannot extract:{0}:{1}".format(snapshot_file, e))
+                return False
+            return self.checkDatabase(file_name)
+
+    def restoreSnapshot(self, snapshot_file, now_datetime, force=False):
+        """Replace the database file with a snapshot.
+
+        スナップショットを展開して整合性を検査してから、データベースファイルを
+        置き換えます。元のファイル(-wal, -shmを含む)は{日時}.oldに移動します。
+        receiver.py を停止して実行してください。
+
+        Extract a snapshot and check its integrity, then replace the database
+        file. The old file (with -wal and -shm) is moved to {datetime}.old.
+        Stop receiver.py while it runs.
+        """
+
+        if os.path.exists(self.db_file) and force is not True:
+            self.logger.error("backup: the database exists:{0}. stop receiver.py, "
+                              "and use --force".format(self.db_file))
+            return False
+
+        restore_file = self.db_file + '.restore'
+        try:
+            self.extractSnapshot(snapshot_file, restore_file)
+            if self.checkDatabase(restore_file) is not True:
+                os.remove(restore_file)
+                return False
+            self.syncFile(restore_file)
+
+            # a WAL of the old file must not be applied to the restored file.
+            old_file = self.db_file + now_datetime.strftime('.%Y%m%d-%H%M%S') + '.old'
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.db_file + suffix):
+                    os.replace(self.db_file + suffix, old_file + suffix)
+                    self.logger.info("backup: moved:{0}".format(old_file + suffix))
+            os.replace(restore_file, self.db_file)
+        except (OSError, EOFError) as e:
+            self.logger.error("backup: cannot restore:{0}:{1}".format(snapshot_file, e))
+            if os.path.exists(restore_file):
+                os.remove(restore_file)
+            return False
+
+        self.logger.info("backup: restored:{0}".format(snapshot_file))
+        return True
+
+    def findSnapshot(self, name):
+        # 'latest' or a file name
+        if name == 'latest':
+            snapshots = self.listSnapshots()
+            return snapshots[-1] if snapshots else None
+        return name if os.path.exists(name) else None
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Back up the database online.')
+    arg_group = arg_parser.add_mutually_exclusive_group()
+    arg_group.add_argument('--list', action='store_true', help='list the snapshots')
+    arg_group.add_argument('--verify', metavar='SNAPSHOT',
+                           help='check the integrity of a snapshot (or latest)')
+    arg_group.add_argument('--restore', metavar='SNAPSHOT',
+                           help='replace the database with a snapshot (or latest)')
+    arg_parser.add_argument('--force', action='store_true',
+                            help='replace the existing database by --restore')
+    args = arg_parser.parse_args()
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.debug("--- start: {0} ----".format(__file__))
+
+    eo_backup = PlantTwitterBackup(logger)
+    if args.list:
+        for snapshot_file in eo_backup.listSnapshots():
+            print("{0} {1}".format(snapshot_file, os.path.getsize(snapshot_file)))
+
+    elif args.verify or args.restore:
+        snapshot_file = eo_backup.findSnapshot(args.verify or args.restore)
+        if snapshot_file is None:
+            logger.error("backup: no snapshot:{0}".format(args.verify or args.restore))
+            result = False
+        elif args.verify:
+            result = eo_backup.verifySnapshot(snapshot_file)
+        else:
+            result = eo_backup.restoreSnapshot(snapshot_file, datetime.datetime.now(),
+                                               args.force)
+        if result:
+            logger.info("backup result: Success")
+        else:
+            logger.error("backup result: Failure")
+
+    else:
+        if eo_backup.createSnapshot(datetime.datetime.now()):
+            logger.info("backup result: Success")
+        else:
+            logger.error("backup result: Failure")
+
+    logger.debug("--- end: {0} ----".format(__file__))
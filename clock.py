@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Clock of the tweet and message logic.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+tweet, message, outbox, datastoreモジュールは現在時刻の取得と待機を
+PlantTwitterClockで行います。通常はシステムの時計を使いますが、
+PlantTwitterSimulatedClockを渡すと、sleep()で待たずに時刻だけを進めます。
+simulate.py は数週間分の動作を数秒で実行するために使います。
+
+The tweet, message, outbox and datastore modules get the current time and
+wait by PlantTwitterClock. The system clock is used normally, but if
+PlantTwitterSimulatedClock is given, sleep() only advances the time without
+waiting. simulate.py uses it to run weeks of operation in seconds.
+
+"""
+
+import time
+import datetime
+
+
+class PlantTwitterClock():
+
+    def time(self):
+        # epoch seconds
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def today(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class PlantTwitterSimulatedClock(PlantTwitterClock):
+    """Clock that advances only by sleep().
+
+    sleep()で指定した秒数だけ時刻を進めます。待機はしません。
+    nowは開始時刻(エポック秒)です。
+
+    The time advances by the seconds of sleep(), without waiting.
+    now is the time to start (epoch seconds).
+    """
+
+    # a sleep takes this at least: a shorter step may not change the epoch
+    # seconds of float.
+    SLEEP_MIN_SECONDS = 0.001
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += max(seconds, self.SLEEP_MIN_SECONDS)
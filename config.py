@@ -8,12 +8,14 @@ config.ini から設定情報を読み込みます。
 option_list: config.iniを読み込んだconfigparserオブジェクトです。
 device_list: 使用するEnOceanデバイスのデバイスIDとデバイス名のデバイスリスト
 をディクショナリ形式で格納します。
+config.ini はプロセスで一度だけ読み込み、全てのインスタンスで共有します。
 
 Read the configuration information from the config.ini file.
 option_list:The ConfigParser class object which was read a configuration
     files (config.ini).
 device_list: The dictionary type object  of device list that was configured
     the device ID and the device model name.
+The config.ini file is read once in a process, and shared by all instances.
 
 """
 
@@ -29,10 +31,18 @@ class cmConfig():
     device_list = {}
     option_list = ''
 
+    # config file -> ConfigParser object read
+    parsed_list = {}
+
     def __init__(self):
         cf_file = self.DATA_CONFIG_PATH + self.DATA_CONFIG_FILE
+        if cf_file in cmConfig.parsed_list:
+            self.option_list = cmConfig.parsed_list[cf_file]
+            return
+
         self.option_list = configparser.ConfigParser()
         self.option_list.read(cf_file)
+        cmConfig.parsed_list[cf_file] = self.option_list
 
         devices = self.option_list['DEFAULT'][
             'ENOCEAN_DEVICE_LIST'].translate(str.maketrans('', '', ' '))
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Run the receive, register and tweet stages in a supervised process.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+receiver.py と tweet.py の処理を一つのプロセスで実行します。
+daemon.py は単独で動作するアプリケーションです。以下のように実行してください。
+
+$ python3 ./daemon.py
+
+各段階(receiver, register, tweet)はスレッドで動作し、例外で停止した場合は
+DAEMON_RESTART_DELAY秒後に再起動します。(plant_twitter_component_restarts_total)
+設定、ロガー、メトリクスは全ての段階で共有します。登録したセンサーデータは
+メモリ(readingsモジュール)で共有するので、tweet段階はデータベースに
+問い合わせません。水やりを検知すると、DAEMON_TWEET_INTERVALを待たずに
+すぐにメッセージを作成します。
+config.ini の[Daemon]で、各段階を個別に有効にできます。receiver.py や
+tweet.py と同時に実行する場合は、同じ段階を無効にしてください。
+
+Run the stages of receiver.py and tweet.py in a process.
+This application works standalone. you can run as follows.
+
+$ python3 ./daemon.py
+
+Each stage (receiver, register, tweet) runs in a thread, and is restarted
+after DAEMON_RESTART_DELAY seconds if it stops by an exception.
+(plant_twitter_component_restarts_total)
+The configuration, the logger and the metrics are shared by all stages.
+The registered sensor data is shared in memory (the readings module), so the
+tweet stage does not query the database. When watering is detected, the
+message is created at once without waiting for DAEMON_TWEET_INTERVAL.
+Each stage can be enabled individually in the [Daemon] section of the
+config.ini file. To run it with receiver.py or tweet.py, disable the same
+stage.
+
+"""
+
+import sys
+import time
+import signal
+import traceback
+import threading
+from queue import Queue
+
+from config import cmConfig
+from logger import cmLogger
+from receiver import PlantTwitterReceiver
+from register import PlantTwitterRegister
+from tweet import PlantTwitterTweet
+from readings import PlantTwitterReadings
+from spool import PlantTwitterSpool
+from clock import PlantTwitterClock
+from metrics import cmMetrics
+from metrics import cmMetricsServer
+from profiler import PlantTwitterProfiler
+
+
+class PlantTwitterDaemon():
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.receiver_enabled = self.config.option_list[
+            'Daemon']['DAEMON_RECEIVER'] == 'True'
+        self.register_enabled = self.config.option_list[
+            'Daemon']['DAEMON_REGISTER'] == 'True'
+        self.tweet_enabled = self.config.option_list[
+            'Daemon']['DAEMON_TWEET'] == 'True'
+        self.tweet_interval = float(self.config.option_list[
+            'Daemon']['DAEMON_TWEET_INTERVAL'])
+        self.restart_delay = float(self.config.option_list[
+            'Daemon']['DAEMON_RESTART_DELAY'])
+
+        # the receiver needs the register to take the packets from the queue.
+        if self.receiver_enabled and self.register_enabled is False:
+            self.logger.error("daemon: receiver needs register. receiver is disabled.")
+            self.receiver_enabled = False
+
+        # shared state of the stages: the readings and the messages use the same clock.
+        self.clock = PlantTwitterClock()
+        self.eo_queue = Queue()
+        self.readings = PlantTwitterReadings(self.logger, self.clock)
+        self.eo_spool = None
+
+        # component name -> thread
+        self.threads = {}
+
+        cmMetrics().gauge('plant_twitter_queue_depth',
+                          'Packets waiting in the queue.').setFunction(self.eo_queue.qsize)
+
+    def startComponents(self):
+        if self.register_enabled:
+            # replay the frames not registered before the restart
+            eo_spool = PlantTwitterSpool(self.logger)
+            if eo_spool.enabled:
+                for frame in eo_spool.openSpool():
+                    self.eo_queue.put(frame)
+                self.eo_spool = eo_spool
+
+            eo_register = PlantTwitterRegister(self.logger, self.readings)
+            self.startComponent('register', eo_register.registerPacket,
+                                (self.eo_queue, self.eo_spool))
+
+        if self.receiver_enabled:
+            eo_receiver = PlantTwitterReceiver(self.logger)
+            self.startComponent('receiver', eo_receiver.receivePacket,
+                                (self.eo_queue, self.eo_spool))
+
+        if self.tweet_enabled:
+            # without the register, the readings are loaded from the database.
+            readings = self.readings if self.register_enabled else None
+            eo_tweet = PlantTwitterTweet(self.logger, readings, self.clock)
+            self.startComponent('deliver', eo_tweet.deliverMessages, ('deliver',))
+            self.startComponent('tweet', self.tweetMessages, (eo_tweet,))
+
+    def startComponent(self, name, target, args):
+        self.logger.info("daemon: start component:{0}".format(name))
+        thread = threading.Thread(target=self.runComponent, args=(name, target, args),
+                                  name=name)
+        thread.daemon = True
+        thread.start()
+        self.threads[name] = thread
+
+    def runComponent(self, name, target, args):
+        """Run the component, and restart it when it stops.
+
+        コンポーネントを実行して、停止した場合は再起動します。
+        この関数は、スレッドとして起動されます。
+
+        Run the component, and restart it when it stops.
+        This function is called by thread object.
+        """
+
+        metrics = cmMetrics()
+        metric_restarts = metrics.counter(
+            'plant_twitter_component_restarts_total', 'Restarts of the daemon components.',
+            {'component': name})
+
+        while True:
+            try:
+                target(*args)
+                self.logger.error("daemon: component stopped:{0}".format(name))
+            except:
+                e_type, e_value, e_traceback = sys.exc_info()
+                self.logger.error("Exception component {0}.:{1}".format(
+                    name, traceback.format_exception(e_type, e_value, e_traceback)))
+
+            metrics.setReady(name, False)
+            metric_restarts.inc()
+            time.sleep(self.restart_delay)
+            self.logger.info("daemon: restart component:{0}".format(name))
+
+    def tweetMessages(self, eo_tweet):
+        # create messages when a device is due, or at once when watering is detected.
+        cmMetrics().setReady('tweet')
+        while True:
+            eo_tweet.tweetMessage()
+            wait = eo_tweet.getWaitSeconds()
+            if wait is None or wait > self.tweet_interval:
+                wait = self.tweet_interval
+            if self.readings.updated.wait(wait):
+                self.logger.info("daemon: watering event: create messages")
+            self.readings.updated.clear()
+
+    def stopComponents(self):
+        if self.eo_spool is not None:
+            self.eo_spool.closeSpool()
+
+
+def handleSignal(signum, frame):
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.debug("--- start: {0} ----".format(__file__))
+
+    eo_daemon = PlantTwitterDaemon(logger)
+
+    # start metrics server
+    cmMetricsServer(logger).startServer('METRICS_DAEMON_PORT')
+
+    # setup profiler: config.ini or SIGUSR1
+    PlantTwitterProfiler(logger).setup()
+
+    signal.signal(signal.SIGTERM, handleSignal)
+
+    try:
+        eo_daemon.startComponents()
+        while True:
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("daemon: stop")
+    finally:
+        eo_daemon.stopComponents()
+
+    logger.debug("--- end: {0} ----".format(__file__))
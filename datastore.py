@@ -14,34 +14,146 @@ The definition of the 'SENSORLOGS' table are as follows.
 
 SENSORLOGS:
     ID INTEGER PRIMARY KEY AUTOINCREMENT
-    ORIGINATOR_ID TEXT
-    DEVICE_MODEL TEXT
+    ORIGINATOR_ID INTEGER
+    DEVICE_MODEL_ID INTEGER
     TELEGRAM_TYPE TEXT
-    DB_0 TEXT
-    DB_1 TEXT
-    DB_2 TEXT
-    DB_3 TEXT
+    PAYLOAD BLOB
     DBM INTEGER
-    TEMPERATURE INTEGER
+    TEMPERATURE REAL
     SOIL_MOISTURE INTEGER
-    HUMIDITY INTEGER
+    HUMIDITY REAL
     CONTACT_SWITCH TEXT
     ROCKER_SWITCH TEXT
-    CREATE_AT TIMESTAMP DEFAULT (DATETIME('now','localtime'))
+    RECEIVED_AT INTEGER
+
+DEVICE_MODELS:
+    ID INTEGER PRIMARY KEY
+    DEVICE_MODEL TEXT UNIQUE NOT NULL
+
+スキーマのバージョン3(migrate.py)から、SENSORLOGSは型付きのスキーマです。
+ORIGINATOR_IDは整数、DEVICE_MODEL_IDはDEVICE_MODELSのID、PAYLOADはDB_0..DB_3の
+生データで、値がない列はNULLです。insertRecord()とselectRecord()などの行の
+形式は変わりません。(ORIGINATOR_IDとDB_0..DB_3は16進数のbytes、値がない列は'')
+バージョン2以前のデータベースは、以前のスキーマのまま読み書きします。
+
+From the schema version 3 (migrate.py), SENSORLOGS is the typed schema.
+ORIGINATOR_ID is an integer, DEVICE_MODEL_ID is the ID of DEVICE_MODELS,
+PAYLOAD is the raw bytes of DB_0..DB_3, and the absent values are NULL.
+The values of insertRecord() and the rows of selectRecord() and others are
+not changed. (ORIGINATOR_ID and DB_0..DB_3 are hex bytes, and the absent
+values are '') The database of the version 2 or before is read and written
+in the previous schema.
+
+RECEIVED_AT は受信時刻(エポックミリ秒)です。selectRecord()が返すCREATE_ATは、
+表示用にRECEIVED_ATから作成した文字列です。既存のデータベースは
+migrate.py を実行して更新してください。
+
+RECEIVED_AT is the receive time (epoch milliseconds). CREATE_AT returned by
+selectRecord() is the string made from RECEIVED_AT for display.
+To update the existing database, run the migrate.py.
+
+WATERING_EVENTS:
+    ID INTEGER PRIMARY KEY AUTOINCREMENT
+    ORIGINATOR_ID TEXT
+    SOIL_MOISTURE INTEGER
+    SOIL_MOISTURE_BEFORE INTEGER
+    RECEIVED_AT INTEGER
+
+LINK_STATS:
+    ORIGINATOR_ID TEXT
+    GATEWAY TEXT
+    FRAMES INTEGER
+    DBM_MIN INTEGER
+    DBM_AVG REAL
+    DBM_MAX INTEGER
+    DBM_P10 INTEGER
+    DBM_P50 INTEGER
+    DBM_P90 INTEGER
+    SUB_TELEGRAMS_AVG REAL
+    INTERVAL INTEGER
+    EXPECTED_FRAMES INTEGER
+    LOSS REAL
+    FRAMES_TOTAL INTEGER
+    SUB_TELEGRAMS_TOTAL INTEGER
+    BEGIN_AT INTEGER
+    RECEIVED_AT INTEGER
+    PRIMARY KEY (ORIGINATOR_ID, GATEWAY)
+
+LINK_STATSはlinkstatsモジュールが集計した、デバイスとゲートウェイ毎の直近の
+フレームの電波の品質です。(INTERVALは送信間隔の中央値(ミリ秒)、LOSSは
+推定したパケットロス率、BEGIN_ATからRECEIVED_ATが時間枠)
+
+LINK_STATS is the radio link quality of the recent frames of each device and
+gateway collected by the linkstats module. (INTERVAL is the median of the
+reporting intervals (milliseconds), LOSS is the estimated packet loss, and
+BEGIN_AT to RECEIVED_AT is the window)
+
+LIVENESS_EVENTS:
+    ID INTEGER PRIMARY KEY AUTOINCREMENT
+    ORIGINATOR_ID TEXT
+    EVENT TEXT
+    LAST_RECEIVED_AT INTEGER
+    TIMEOUT INTEGER
+    RECEIVED_AT INTEGER
+
+LIVENESS_EVENTSはlivenessモジュールが検知した、デバイスの'silent'(期限を過ぎた)と
+'alive'(再び受信した)のイベントです。RECEIVED_ATは期限、または受信時刻です。
+
+LIVENESS_EVENTS is the 'silent' (past the deadline) and 'alive' (received
+again) events of the devices detected by the liveness module. RECEIVED_AT is
+the deadline or the receive time.
+
+センサーデータ(SENSORLOGS)の保存先は、config.ini のDATA_STORE_BACKENDで
+選択します。'sqlite'(デフォルト)はsqlitestore.pyのこのデータベースの
+'SENSORLOGS'テーブル、'mmap'はmmapstore.pyのデバイス毎の固定長レコード
+ファイルです。insertRecord()、insertRecords()、selectRecord()、
+selectRecordsAfter()、selectRecentRecords()、iterRecords()、iterColumns()、
+selectLatestRecord()、selectDownsampledRecords()、selectLastID()、
+getDataVersion()、hasArchive()は常にストレージに委譲します。ストレージは
+同じメソッドを持ち、行の形式も同じです。(DATA_STORE_BACKENDS)
+水やりイベントなど、その他のテーブルは常にこのデータベースに保存します。
+
+The storage of the sensor data (SENSORLOGS) is selected by DATA_STORE_BACKEND
+of the config.ini file. 'sqlite' (default) is the 'SENSORLOGS' table of this
+database in sqlitestore.py, and 'mmap' is the files of fixed-size records of
+each device in mmapstore.py. insertRecord(), insertRecords(), selectRecord(),
+selectRecordsAfter(), selectRecentRecords(), iterRecords(), iterColumns(),
+selectLatestRecord(), selectDownsampledRecords(), selectLastID(),
+getDataVersion() and hasArchive() are always delegated to the storage.
+The storages have the same methods, and the rows are of the same form.
+(DATA_STORE_BACKENDS)
+The other tables such as the watering events are always stored in this
+database.
+
+archive.py は古い行を'ARCHIVE_BLOCKS'テーブルの圧縮したブロックに移動します。
+(archivestore.py) 'sqlite'の場合、iterRecords()、iterColumns()、
+selectDownsampledRecords()、selectLatestRecord()は移動した行も返します。
+
+archive.py moves the old rows into the compressed blocks of the
+'ARCHIVE_BLOCKS' table. (archivestore.py) If 'sqlite', iterRecords(),
+iterColumns(), selectDownsampledRecords() and selectLatestRecord() also
+return the moved rows.
 """
 
 import time
-import datetime
+import struct
 import sqlite3
 
 from config import cmConfig
 from logger import cmLogger
+from metrics import cmMetrics
+from clock import PlantTwitterClock
+from sqlitestore import PlantTwitterSqliteStore
+from mmapstore import PlantTwitterMmapStore
 
 
 class PlantTwitterDatastore():
 
     DATA_STORE_FILE = '/sensorlogs.db'
 
+    # DATA_STORE_BACKEND -> storage of the sensor data
+    DATA_STORE_BACKENDS = {'sqlite': PlantTwitterSqliteStore, 'mmap': PlantTwitterMmapStore}
+
     ROW_INDEX_ORIGINATOR_ID = 0
     ROW_INDEX_DEVICE_MODEL = 1
     ROW_INDEX_TELEGRAM_TYPE = 2
@@ -56,24 +168,92 @@ class PlantTwitterDatastore():
     ROW_INDEX_CONTACT_SWITCH = 11
     ROW_INDEX_ROCKER_SWITCH = 12
     ROW_INDEX_CREATE_AT = 13
+    ROW_INDEX_RECEIVED_AT = 14
+    ROW_INDEX_ID = 15
+
+    # insertRecord() values: same as the row except CREATE_AT
+    VALUES_INDEX_RECEIVED_AT = 13
+
+    ROW_INDEX_WATERING_ORIGINATOR_ID = 0
+    ROW_INDEX_WATERING_SOIL_MOISTURE = 1
+    ROW_INDEX_WATERING_SOIL_MOISTURE_BEFORE = 2
+    ROW_INDEX_WATERING_RECEIVED_AT = 3
+
+    # iterColumns() columns
+    COLUMN_INDEX_RECEIVED_AT = 0
+    COLUMN_INDEX_DBM = 1
+    COLUMN_INDEX_TEMPERATURE = 2
+    COLUMN_INDEX_HUMIDITY = 3
+    COLUMN_INDEX_SOIL_MOISTURE = 4
+
+    ROW_INDEX_LIVENESS_ORIGINATOR_ID = 0
+    ROW_INDEX_LIVENESS_EVENT = 1
+    ROW_INDEX_LIVENESS_LAST_RECEIVED_AT = 2
+    ROW_INDEX_LIVENESS_TIMEOUT = 3
+    ROW_INDEX_LIVENESS_RECEIVED_AT = 4
 
-    def __init__(self, logger):
+    SQL_LINK_STATS_COLUMNS = "ORIGINATOR_ID, GATEWAY, FRAMES, DBM_MIN, DBM_AVG, " + \
+        "DBM_MAX, DBM_P10, DBM_P50, DBM_P90, SUB_TELEGRAMS_AVG, INTERVAL, " + \
+        "EXPECTED_FRAMES, LOSS, FRAMES_TOTAL, SUB_TELEGRAMS_TOTAL, BEGIN_AT, RECEIVED_AT"
+
+    ROW_INDEX_LINK_ORIGINATOR_ID = 0
+    ROW_INDEX_LINK_GATEWAY = 1
+    ROW_INDEX_LINK_FRAMES = 2
+    ROW_INDEX_LINK_DBM_MIN = 3
+    ROW_INDEX_LINK_DBM_AVG = 4
+    ROW_INDEX_LINK_DBM_MAX = 5
+    ROW_INDEX_LINK_DBM_P10 = 6
+    ROW_INDEX_LINK_DBM_P50 = 7
+    ROW_INDEX_LINK_DBM_P90 = 8
+    ROW_INDEX_LINK_SUB_TELEGRAMS_AVG = 9
+    ROW_INDEX_LINK_INTERVAL = 10
+    ROW_INDEX_LINK_EXPECTED_FRAMES = 11
+    ROW_INDEX_LINK_LOSS = 12
+    ROW_INDEX_LINK_FRAMES_TOTAL = 13
+    ROW_INDEX_LINK_SUB_TELEGRAMS_TOTAL = 14
+    ROW_INDEX_LINK_BEGIN_AT = 15
+    ROW_INDEX_LINK_RECEIVED_AT = 16
+
+    def __init__(self, logger, clock=None):
         self.logger = logger
+        # current time of the time ranges: simulate.py
+        self.clock = PlantTwitterClock() if clock is None else clock
 
         config = cmConfig()
         self.db_file = config.option_list['DEFAULT'][
             'DATA_FILE_PATH'] + self.DATA_STORE_FILE
 
-    def openConnection(self):
+        # storage of the sensor data
+        backend_name = config.option_list['DEFAULT']['DATA_STORE_BACKEND']
+        backend_class = self.DATA_STORE_BACKENDS.get(backend_name)
+        if backend_class is None:
+            self.logger.error(
+                "Unsupported data store backend:{0}. see config.ini.".format(backend_name))
+            backend_class = PlantTwitterSqliteStore
+        self.backend = backend_class(self.logger, self.clock)
+
+        metrics = cmMetrics()
+        self.metric_commit = metrics.histogram(
+            'plant_twitter_db_commit_seconds', 'Time to insert and commit sensor data.')
+        self.metric_errors = metrics.counter(
+            'plant_twitter_db_errors_total', 'Errors of sql execution.')
+
+    def openConnection(self, read_only=False):
         self.logger.debug(
             "sqlite3: open connection:{0}".format(self.db_file))
-        self.conn = sqlite3.connect(self.db_file)
+        if read_only:
+            self.conn = sqlite3.connect(
+                'file:' + self.db_file + '?mode=ro', uri=True)
+        else:
+            self.conn = sqlite3.connect(self.db_file)
         if isinstance(self.conn, sqlite3.Connection) is not True:
             self.logger.error(
                 "sqlite3: Cannot open connection:{0}".format(self.db_file))
             return
+        self.backend.openConnection(self.conn)
 
     def closeConnection(self):
+        self.backend.closeConnection()
         if isinstance(self.conn, sqlite3.Connection):
             self.logger.debug(
                 "sqlite3: close connection:{0}".format(self.db_file))
@@ -84,18 +264,221 @@ class PlantTwitterDatastore():
 
         # check value items
         values_length = len(values)
-        if values_length != 13:
+        if values_length == 13:
+            # receive time: now
+            values = values + (self.getEpochMillis(),)
+        elif values_length != 14:
             self.logger.error(
                 "Invalid value items.:{0}".format(values_length))
             return False
 
-        sql = "INSERT INTO SENSORLOGS (ORIGINATOR_ID, DEVICE_MODEL, " + \
-            "TELEGRAM_TYPE, DB_0, DB_1, DB_2, DB_3, DBM, TEMPERATURE, " + \
-            "SOIL_MOISTURE, HUMIDITY, CONTACT_SWITCH, ROCKER_SWITCH) " + \
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        begin_time = time.perf_counter()
+        try:
+            self.backend.insertRecord(*values)
+        except (sqlite3.Error, OSError, ValueError, struct.error) as e:
+            self.logger.error(
+                "data store: Write record error:{0}".format(e))
+            self.metric_errors.inc()
+            return False
+        self.metric_commit.observe(time.perf_counter() - begin_time)
+
+        return True
+
+    def insertRecords(self, values_list):
+        """Insert the values of many rows in a transaction.
+
+        insertRecord()の値(受信時刻を含む14項目)のリストを1つのトランザクションで
+        登録します。大量の行の読み込み(test_scaling.py)に使います。
+
+        Insert the list of the values of insertRecord() (14 items with the
+        receive time) in a transaction. It is used to load many rows.
+        (test_scaling.py)
+        """
+
+        try:
+            self.backend.insertRecords(values_list)
+        except (sqlite3.Error, OSError, ValueError, struct.error) as e:
+            self.logger.error(
+                "data store: Write record error:{0}".format(e))
+            self.metric_errors.inc()
+            return False
+
+        return True
+
+    def selectRecord(self, originator_id, device_model, rowcount=60):
+        return self.backend.selectRecord(originator_id, device_model, rowcount)
+
+    def selectRecordsAfter(self, originator_id, device_model, last_id, rowcount=60):
+        """Select the records of selectRecord() after the row ID.
+
+        selectRecord()と同じ直近1時間の行のうち、行IDがlast_idより大きい行を
+        新しい順に取得します。行の形式はselectRecord()に行IDを加えたものです。
+        (ROW_INDEX_ID) 前回の最後の行IDを指定すると、追加された行だけを
+        デバイスのインデックスから読み込みます。
+
+        Select the records of the last hour same as selectRecord(), whose row
+        ID is greater than last_id, from the latest. A row is that of
+        selectRecord() with the row ID. (ROW_INDEX_ID) If the last row ID of
+        the previous call is given, only the added rows are read on the index
+        of the device.
+        """
+
+        return self.backend.selectRecordsAfter(originator_id, device_model, last_id, rowcount)
+
+    def selectRecentRecords(self, devices, last_id=0, rowcount=60):
+        """Select the records of selectRecordsAfter() of the devices at once.
+
+        devicesのデバイス毎に、selectRecordsAfter()と同じ行を1回のクエリで
+        取得して、{originator_id: 行のリスト}を返します。'sqlite'の場合、
+        デバイス毎の行数はウィンドウ関数(ROW_NUMBER)で制限するので、
+        SQLite 3.25以降が必要です。それより前のSQLiteでは、デバイス毎に
+        クエリを実行します。
+
+        Select the same rows as selectRecordsAfter() of each device of devices
+        [(originator_id, device_model)] in a query, and return
+        {originator_id: list of the rows}. If 'sqlite', the rows of each
+        device are limited by a window function (ROW_NUMBER), so SQLite 3.25
+        or later is required. The older SQLite runs a query of each device.
+        """
+
+        return self.backend.selectRecentRecords(devices, last_id, rowcount)
+
+    def iterRecords(self, originator_id=None, begin_at=0, end_at=None, chunk_rows=1000,
+                    archived=True):
+        """Iterate the records of the time range in chunks.
+
+        指定したデバイスと期間(エポックミリ秒、begin_at以上end_at未満)の行を
+        chunk_rows行ずつ取得して返すジェネレーターです。
+        チャンク毎に前回の最後の行から検索を再開する短いクエリを実行するので、
+        範囲の大きさに関係なくメモリ使用量は一定で、受信処理の書き込みを
+        長時間ブロックしません。originator_idを省略すると全デバイスが対象です。
+        行の形式はselectRecord()に行IDを加えたものです。(ROW_INDEX_ID)
+        archivedがFalseでなければ、archive.py が移動した行を最初に返します。
+
+        Generator that selects the records of the device and the time range
+        (epoch milliseconds, begin_at or later and before end_at) in chunks
+        of chunk_rows rows.
+        Each chunk is a short query that restarts after the last row of the
+        previous chunk, so the memory usage stays flat regardless of the size
+        of the range, and the writer of the receiver is never blocked for
+        long. If originator_id is omitted, all devices are selected.
+        A row is that of selectRecord() with the row ID. (ROW_INDEX_ID)
+        The rows archived by archive.py are returned first, unless archived
+        is False.
+        """
+
+        return self.backend.iterRecords(originator_id, begin_at, end_at, chunk_rows, archived)
+
+    def iterColumns(self, originator_id, begin_at, end_at, chunk_rows=10000):
+        """Iterate the sensor values of the time range in column chunks.
+
+        指定したデバイスと期間の受信時刻、dBm、気温、湿度、土壌水分量を、
+        chunk_rows行ずつ列のリストのタプルで返すジェネレーターです。
+        (COLUMN_INDEX_*、値がない場合はNone) 集計用に必要な列だけを読み込みます。
+
+        Generator that returns the receive time, dBm, temperature, humidity
+        and soil moisture of the device and the time range in chunks of
+        chunk_rows rows, as a tuple of the lists of the columns.
+        (COLUMN_INDEX_*, None if absent) Only the columns for the statistics
+        are read.
+        """
+
+        return self.backend.iterColumns(originator_id, begin_at, end_at, chunk_rows)
+
+    def selectLatestRecord(self, originator_id):
+        """Select the latest record of the device.
+
+        デバイスの最新の行を取得します。行がない場合はNoneを返します。
+
+        Select the latest record of the device.
+        If there is no record, return None.
+        """
+
+        return self.backend.selectLatestRecord(originator_id)
+
+    def selectDownsampledRecords(self, originator_id, begin_at, end_at, step):
+        """Select the averages of every step milliseconds.
+
+        期間(エポックミリ秒)をstepミリ秒毎に区切って、測定値の平均を取得します。
+        行の形式は、(区間の開始時刻, 行数, 平均dBm, 平均温度, 平均土壌水分量,
+        平均湿度)です。
+
+        Select the averages of the measured values of every step milliseconds
+        in the time range (epoch milliseconds). A row is (begin time of the
+        step, rows, average dBm, average temperature, average soil moisture,
+        average humidity).
+        """
+
+        return self.backend.selectDownsampledRecords(originator_id, begin_at, end_at, step)
+
+    def selectLastID(self):
+        return self.backend.selectLastID()
+
+    def getDataVersion(self):
+        # changed when another connection commits.
+        return self.backend.getDataVersion()
+
+    def hasArchive(self):
+        # ARCHIVE_BLOCKS of archive.py: the sqlite backend only.
+        return self.backend.hasArchive()
+
+    def insertWateringEvent(self, originator_id, soil_moisture,
+                            soil_moisture_before, received_at):
+        self.logger.info("insert watering event:{0} {1} {2} {3}".format(
+            originator_id, soil_moisture, soil_moisture_before, received_at))
+
+        sql = "INSERT INTO WATERING_EVENTS (ORIGINATOR_ID, SOIL_MOISTURE, " + \
+            "SOIL_MOISTURE_BEFORE, RECEIVED_AT) VALUES (?, ?, ?, ?)"
+
+        try:
+            self.conn.execute(sql, (self.toOriginatorID(originator_id), soil_moisture,
+                                    soil_moisture_before, received_at))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return False
+
+        return True
+
+    def selectWateringEvent(self, originator_id, minutes=30):
+        """Select the latest watering event in the minutes.
+
+        直近minutes分以内の最新の水やりイベントを取得します。
+        イベントがない場合はNoneを返します。
+
+        Select the latest watering event in the minutes.
+        If there is no event, return None.
+        """
+
+        begin_at = self.getEpochMillis() - minutes * 60 * 1000
+
+        sql = "SELECT ORIGINATOR_ID, SOIL_MOISTURE, SOIL_MOISTURE_BEFORE, " + \
+            "RECEIVED_AT FROM WATERING_EVENTS " + \
+            "WHERE ORIGINATOR_ID = ? AND RECEIVED_AT > ? " + \
+            "ORDER BY RECEIVED_AT DESC LIMIT 1"
 
         try:
-            self.conn.execute(sql, values)
+            event = self.conn.execute(
+                sql, (self.toOriginatorID(originator_id), begin_at)).fetchone()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return None
+
+        return event
+
+    def insertLivenessEvent(self, originator_id, event, last_received_at,
+                            timeout, received_at):
+        self.logger.info("insert liveness event:{0} {1} {2} {3} {4}".format(
+            originator_id, event, last_received_at, timeout, received_at))
+
+        sql = "INSERT INTO LIVENESS_EVENTS (ORIGINATOR_ID, EVENT, " + \
+            "LAST_RECEIVED_AT, TIMEOUT, RECEIVED_AT) VALUES (?, ?, ?, ?, ?)"
+
+        try:
+            self.conn.execute(sql, (self.toOriginatorID(originator_id), event,
+                                    last_received_at, timeout, received_at))
             self.conn.commit()
         except sqlite3.Error as e:
             self.logger.error(
@@ -104,30 +487,143 @@ class PlantTwitterDatastore():
 
         return True
 
-    def selectRecord(self, originator_id, device_model, rowcount=60):
+    def selectLivenessEvent(self, originator_id):
+        """Select the latest liveness event of the device.
 
-        cur = self.conn.cursor()
-        cur.arraysize = rowcount
-        begin_date = (datetime.datetime.today() -
-                      datetime.timedelta(minutes=60)).strftime('%Y-%m-%d %H:%M:%S')
+        デバイスの最新の'silent'または'alive'イベントを取得します。
+        イベントがない場合はNoneを返します。
 
-        sql = "SELECT ORIGINATOR_ID, DEVICE_MODEL, TELEGRAM_TYPE, DB_0, " + \
-            "DB_1, DB_2, DB_3, DBM, TEMPERATURE, SOIL_MOISTURE, HUMIDITY, " + \
-            "CONTACT_SWITCH, ROCKER_SWITCH, CREATE_AT FROM SENSORLOGS " + \
-            "WHERE ORIGINATOR_ID like '" + originator_id + "' and " + \
-            "DEVICE_MODEL like '" + device_model + "' and " + \
-            "DATETIME(CREATE_AT,'LOCALTIME') > DATETIME('" + begin_date + "','LOCALTIME')" + \
-            "ORDER BY ID DESC LIMIT " + str(rowcount)
+        Select the latest 'silent' or 'alive' event of the device.
+        If there is no event, return None.
+        """
 
-        self.logger.debug("select values :{0}".format(sql))
+        sql = "SELECT ORIGINATOR_ID, EVENT, LAST_RECEIVED_AT, TIMEOUT, " + \
+            "RECEIVED_AT FROM LIVENESS_EVENTS WHERE ORIGINATOR_ID = ? " + \
+            "ORDER BY RECEIVED_AT DESC LIMIT 1"
 
         try:
-            cur.execute(sql)
-            sensor_list = cur.fetchmany()
-            cur.close()
+            event = self.conn.execute(
+                sql, (self.toOriginatorID(originator_id),)).fetchone()
         except sqlite3.Error as e:
             self.logger.error(
                 "sqlite3: Execute sql error:{0}".format(e.args[0]))
-            return ''
+            return None
+
+        return event
+
+    def updateLinkStats(self, summaries):
+        """Write the link statistics of the devices in a transaction.
+
+        linkstatsモジュールの行で'LINK_STATS'テーブルを更新します。
+        FRAMES_TOTALとSUB_TELEGRAMS_TOTALは、行の値を加算します。
+
+        Update the 'LINK_STATS' table by the rows of the linkstats module.
+        The values of FRAMES_TOTAL and SUB_TELEGRAMS_TOTAL are added.
+        """
+
+        sql_update = "UPDATE LINK_STATS SET FRAMES = ?, DBM_MIN = ?, DBM_AVG = ?, " + \
+            "DBM_MAX = ?, DBM_P10 = ?, DBM_P50 = ?, DBM_P90 = ?, SUB_TELEGRAMS_AVG = ?, " + \
+            "INTERVAL = ?, EXPECTED_FRAMES = ?, LOSS = ?, " + \
+            "FRAMES_TOTAL = FRAMES_TOTAL + ?, SUB_TELEGRAMS_TOTAL = SUB_TELEGRAMS_TOTAL + ?, " + \
+            "BEGIN_AT = ?, RECEIVED_AT = ? WHERE ORIGINATOR_ID = ? AND GATEWAY = ?"
+        sql_insert = "INSERT INTO LINK_STATS (" + self.SQL_LINK_STATS_COLUMNS + \
+            ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+        try:
+            for summary in summaries:
+                summary = (self.toOriginatorID(summary[0]),) + summary[1:]
+                cur = self.conn.execute(sql_update, summary[2:] + summary[:2])
+                if cur.rowcount == 0:
+                    self.conn.execute(sql_insert, summary)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            self.metric_errors.inc()
+            self.conn.rollback()
+            return False
+
+        return True
+
+    def selectLinkStats(self, originator_id=None):
+        """Select the link statistics of each device and gateway.
+
+        デバイスとゲートウェイ毎の電波の品質('LINK_STATS'の行)のリストを
+        取得します。originator_idを指定した場合は、そのデバイスだけです。
+
+        Select the list of the link quality (the rows of 'LINK_STATS') of
+        each device and gateway. If originator_id is given, only the device.
+        """
+
+        sql = "SELECT " + self.SQL_LINK_STATS_COLUMNS + " FROM LINK_STATS"
+        params = ()
+        if originator_id is not None:
+            sql += " WHERE ORIGINATOR_ID = ?"
+            params = (self.toOriginatorID(originator_id),)
+        sql += " ORDER BY GATEWAY, ORIGINATOR_ID"
+
+        try:
+            return self.conn.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+    def selectGatewayLinkStats(self):
+        """Select the link statistics of each gateway.
+
+        ゲートウェイ毎に、(GATEWAY, デバイス数, フレーム数, dBmの最小, 平均, 最大,
+        期待するフレーム数, 推定したパケットロス率) のリストを取得します。
+
+        Select the list of (GATEWAY, devices, frames, minimum, average and
+        maximum of dBm, expected frames, estimated packet loss) of each gateway.
+        """
+
+        sql = "SELECT GATEWAY, COUNT(*), SUM(FRAMES), MIN(DBM_MIN), " + \
+            "SUM(DBM_AVG * FRAMES) / SUM(FRAMES), MAX(DBM_MAX), " + \
+            "SUM(IFNULL(EXPECTED_FRAMES, FRAMES)), " + \
+            "1.0 - CAST(SUM(FRAMES) AS REAL) / SUM(IFNULL(EXPECTED_FRAMES, FRAMES)) " + \
+            "FROM LINK_STATS GROUP BY GATEWAY ORDER BY GATEWAY"
+
+        try:
+            return self.conn.execute(sql).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+    def selectWateringEventsAfter(self, received_at):
+        # the watering events of all devices received after received_at
+        sql = "SELECT ORIGINATOR_ID, SOIL_MOISTURE, SOIL_MOISTURE_BEFORE, " + \
+            "RECEIVED_AT FROM WATERING_EVENTS WHERE RECEIVED_AT > ? ORDER BY RECEIVED_AT"
+
+        try:
+            return self.conn.execute(sql, (received_at,)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+    def selectWateringEvents(self, originator_id, begin_at, end_at):
+        # the watering events of the time range in the order of the receive time
+        sql = "SELECT ORIGINATOR_ID, SOIL_MOISTURE, SOIL_MOISTURE_BEFORE, " + \
+            "RECEIVED_AT FROM WATERING_EVENTS " + \
+            "WHERE ORIGINATOR_ID = ? AND RECEIVED_AT >= ? AND RECEIVED_AT < ? " + \
+            "ORDER BY RECEIVED_AT"
+
+        try:
+            return self.conn.execute(
+                sql, (self.toOriginatorID(originator_id), begin_at, end_at)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+    def getEpochMillis(self):
+        return int(self.clock.time() * 1000)
 
-        return sensor_list
+    def toOriginatorID(self, originator_id):
+        # ORIGINATOR_ID is stored as the bytes of the parser.
+        if isinstance(originator_id, str):
+            return originator_id.encode('utf-8')
+        return originator_id
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+"""Create the daily digest of each plant.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+デバイス毎に1日のまとめ(気温と湿度の範囲、土壌水分量の傾向、水やりの回数、
+電波の品質)を作成します。digest.py は単独で動作するアプリケーションです。
+以下のように実行してください。(cronで毎晩実行できます)
+
+$ python3 ./digest.py
+$ python3 ./digest.py --date 2017-06-01 --days 30 --output digest.jsonl
+$ python3 ./digest.py --tweet
+
+センサーデータはPlantTwitterDatastore.iterColumns()で列のチャンク毎に
+NumPyの配列に読み込み、期間の全ての日の統計をまとめてベクトル演算で
+計算するので、1年分のデータでもPythonの行毎のループは行いません。
+メッセージはconfig.ini の[Message]のMESSAGE_TABLE_DIGEST_*のテンプレートで
+作成します。--outputを指定すると統計とメッセージをJSON Linesで追記し、
+--tweetを指定するとoutboxモジュールでツイートします。(同じ日のまとめは
+一度だけです)
+NumPyが必要です。($ sudo apt-get install python3-numpy)
+
+Create the digest of a day of each device (range of the temperature and the
+humidity, trend of the soil moisture, number of the waterings and the radio
+link quality). This application works standalone. you can run as follows.
+(You can run it every night by cron)
+
+$ python3 ./digest.py
+$ python3 ./digest.py --date 2017-06-01 --days 30 --output digest.jsonl
+$ python3 ./digest.py --tweet
+
+The sensor data is read into NumPy arrays in column chunks by
+PlantTwitterDatastore.iterColumns(), and the statistics of all days of the
+range are computed together by vector operations, so there is no loop over
+the Python rows even for the data of a year.
+The messages are created by the MESSAGE_TABLE_DIGEST_* templates of the
+[Message] section of the config.ini file. With --output, the statistics and
+the message are appended in JSON Lines, and with --tweet, the message is
+tweeted by the outbox module. (The digest of a day is tweeted only once)
+NumPy is required. ($ sudo apt-get install python3-numpy)
+
+"""
+
+import json
+import time
+import argparse
+import datetime
+
+import numpy as np
+
+from config import cmConfig
+from logger import cmLogger
+from datastore import PlantTwitterDatastore
+from message import PlantTwitterMessage
+from outbox import PlantTwitterOutbox
+
+
+class PlantTwitterDigest():
+
+    HOUR_MILLIS = 60 * 60 * 1000
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+
+    def getDayBounds(self, date, days):
+        # epoch milliseconds of the local midnights: days + 1 bounds
+        bounds = []
+        for i in range(days + 1):
+            day = date + datetime.timedelta(days=i)
+            bounds.append(int(time.mktime(day.timetuple())) * 1000)
+        return np.array(bounds, dtype=np.int64)
+
+    def readColumns(self, data_store, originator_id, begin_at, end_at):
+        """Read the sensor values of the range into NumPy arrays.
+
+        期間のセンサーデータを列のチャンク毎に読み込んで、列毎の配列のリストを
+        返します。(PlantTwitterDatastore.COLUMN_INDEX_*、値がない場合はNaN)
+
+        Read the sensor values of the range in column chunks, and return the
+        list of the arrays of the columns.
+        (PlantTwitterDatastore.COLUMN_INDEX_*, NaN if absent)
+        """
+
+        chunks = ([], [], [], [], [])
+        for columns in data_store.iterColumns(originator_id, begin_at, end_at):
+            chunks[0].append(np.array(
+                columns[data_store.COLUMN_INDEX_RECEIVED_AT], dtype=np.int64))
+            for i in range(1, len(chunks)):
+                chunks[i].append(np.array(columns[i], dtype=np.float64))
+
+        if not chunks[0]:
+            return [np.zeros(0, dtype=np.int64)] + \
+                [np.zeros(0, dtype=np.float64) for i in range(1, len(chunks))]
+        return [np.concatenate(c) for c in chunks]
+
+    def sumDays(self, values, starts, ends):
+        cumsum = np.concatenate(([0], np.cumsum(values)))
+        return cumsum[ends] - cumsum[starts]
+
+    def reduceDays(self, values, starts, ends):
+        """Return (count, minimum, average, maximum) of each day.
+
+        日毎の値の数、最小、平均、最大の配列を返します。NaNは除外します。
+
+        Return the arrays of the count, the minimum, the average and the
+        maximum of each day. NaN is excluded.
+        """
+
+        valid = ~np.isnan(values)
+        count = self.sumDays(valid, starts, ends)
+        total = self.sumDays(np.where(valid, values, 0.0), starts, ends)
+
+        minimum = np.full(len(starts), np.nan)
+        maximum = np.full(len(starts), np.nan)
+        if len(values):
+            # the days are contiguous, and the empty days are masked.
+            # a NaN at the end is the start of the empty days after the data:
+            # the last day with the data still reduces to the end of values.
+            padded = np.append(values, np.nan)
+            minimum = np.where(count > 0, np.fmin.reduceat(padded, starts), np.nan)
+            maximum = np.where(count > 0, np.fmax.reduceat(padded, starts), np.nan)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            average = np.where(count > 0, total / count, np.nan)
+
+        return (count, minimum, average, maximum)
+
+    def computeDigests(self, columns, bounds, watering_times):
+        """Compute the statistics of each day.
+
+        日毎の統計を計算して、統計の名前と日毎の配列の辞書を返します。
+
+        Compute the statistics of each day, and return the dictionary of the
+        name of the statistic and the array of each day.
+        """
+
+        received_at = columns[PlantTwitterDatastore.COLUMN_INDEX_RECEIVED_AT]
+        starts = np.searchsorted(received_at, bounds[:-1])
+        ends = np.searchsorted(received_at, bounds[1:])
+        frames = ends - starts
+
+        digest = {'frames': frames}
+        for name, index in (('temperature', PlantTwitterDatastore.COLUMN_INDEX_TEMPERATURE),
+                            ('humidity', PlantTwitterDatastore.COLUMN_INDEX_HUMIDITY),
+                            ('soil_moisture', PlantTwitterDatastore.COLUMN_INDEX_SOIL_MOISTURE),
+                            ('dbm', PlantTwitterDatastore.COLUMN_INDEX_DBM)):
+            (digest[name + '_count'], digest[name + '_min'], digest[name + '_avg'],
+             digest[name + '_max']) = self.reduceDays(columns[index], starts, ends)
+
+        # soil moisture: the first and the last value, and the trend per hour
+        soil = columns[PlantTwitterDatastore.COLUMN_INDEX_SOIL_MOISTURE]
+        valid_index = np.flatnonzero(~np.isnan(soil))
+        first = np.searchsorted(valid_index, starts)
+        last = np.searchsorted(valid_index, ends) - 1
+        found = first <= last
+        digest['soil_moisture_first'] = np.full(len(starts), np.nan)
+        digest['soil_moisture_last'] = np.full(len(starts), np.nan)
+        if len(valid_index):
+            digest['soil_moisture_first'] = np.where(
+                found, soil[valid_index[np.minimum(first, len(valid_index) - 1)]], np.nan)
+            digest['soil_moisture_last'] = np.where(
+                found, soil[valid_index[np.maximum(last, 0)]], np.nan)
+        digest['soil_moisture_trend'] = self.computeTrend(
+            received_at, soil, bounds, starts, ends, frames)
+
+        # packet loss: the expected frames by the median of the reporting intervals
+        intervals = np.diff(received_at)
+        intervals = intervals[intervals > 0]
+        expected = frames.astype(np.float64)
+        if len(intervals):
+            interval = np.median(intervals)
+            span = np.where(frames > 0, received_at[np.minimum(ends, len(received_at)) - 1] -
+                            received_at[np.minimum(starts, len(received_at) - 1)], 0)
+            expected = np.maximum(frames, np.round(span / interval) + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            digest['loss'] = np.where(frames > 0, 1 - frames / expected, np.nan)
+
+        # waterings
+        digest['waterings'] = np.diff(np.searchsorted(
+            np.array(watering_times, dtype=np.int64), bounds))
+
+        return digest
+
+    def computeTrend(self, received_at, values, bounds, starts, ends, frames):
+        # the slope of the least squares line of each day (value per hour)
+        day = np.repeat(np.arange(len(starts)), frames)
+        hours = (received_at - bounds[day]) / self.HOUR_MILLIS
+        valid = ~np.isnan(values)
+        y = np.where(valid, values, 0.0)
+        x = np.where(valid, hours, 0.0)
+
+        n = self.sumDays(valid, starts, ends)
+        sum_x = self.sumDays(x, starts, ends)
+        sum_y = self.sumDays(y, starts, ends)
+        sum_xy = self.sumDays(x * y, starts, ends)
+        sum_xx = self.sumDays(x * x, starts, ends)
+
+        denominator = n * sum_xx - sum_x * sum_x
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where((n > 1) & (denominator > 0),
+                            (n * sum_xy - sum_x * sum_y) / denominator, np.nan)
+
+    def createDigests(self, data_store, originator_id, device_model, date, days=1):
+        """Create the digests of the days of the device.
+
+        dateからdays日分の、デバイスの日毎のまとめ(統計とメッセージの辞書)の
+        リストを返します。
+
+        Return the list of the digests (dictionary of the statistics and the
+        message) of each day of days from date.
+        """
+
+        bounds = self.getDayBounds(date, days)
+        begin_time = time.perf_counter()
+
+        columns = self.readColumns(data_store, originator_id, int(bounds[0]), int(bounds[-1]))
+        watering_times = [e[data_store.ROW_INDEX_WATERING_RECEIVED_AT]
+                          for e in data_store.selectWateringEvents(
+                              originator_id, int(bounds[0]), int(bounds[-1]))]
+        read_time = time.perf_counter()
+
+        stats = self.computeDigests(columns, bounds, watering_times)
+
+        self.logger.debug("digest:{0} rows={1} read={2:.3f} sec compute={3:.3f} sec".format(
+            originator_id, len(columns[0]), read_time - begin_time,
+            time.perf_counter() - read_time))
+
+        digests = []
+        for i in range(days):
+            digest = {'id': originator_id, 'device_model': device_model,
+                      'date': (date + datetime.timedelta(days=i)).strftime('%Y-%m-%d')}
+            for name, values in sorted(stats.items()):
+                value = values[i].item()
+                digest[name] = None if value != value else value
+            digest['message'] = self.createMessage(digest)
+            digests.append(digest)
+
+        return digests
+
+    def createMessage(self, digest):
+        templates = self.config.option_list['Message']
+        device_model = digest['device_model']
+        message_opt = ''
+
+        if digest['frames'] == 0:
+            message_opt = templates['MESSAGE_TABLE_DIGEST_NO_DATA']
+
+        else:
+            if digest['temperature_count']:
+                message_opt += self.formatTemplate(
+                    templates['MESSAGE_TABLE_DIGEST_TEMPERATURE'], digest['temperature_min'],
+                    digest['temperature_max'], digest['temperature_avg'])
+
+            if device_model == 'STM431JH' and digest['humidity_count']:
+                message_opt += self.formatTemplate(
+                    templates['MESSAGE_TABLE_DIGEST_HUMIDITY'], digest['humidity_min'],
+                    digest['humidity_max'], digest['humidity_avg'])
+
+            if device_model == 'STM431JS' and digest['soil_moisture_count']:
+                message_opt += self.formatTemplate(
+                    templates['MESSAGE_TABLE_DIGEST_SOILMOISTURE'],
+                    digest['soil_moisture_first'], digest['soil_moisture_last'],
+                    digest['soil_moisture_trend'] or 0.0)
+                message_opt += self.formatTemplate(
+                    templates['MESSAGE_TABLE_DIGEST_WATERING'], digest['waterings'])
+
+            message_opt += self.formatTemplate(
+                templates['MESSAGE_TABLE_DIGEST_LINK'], digest['dbm_avg'], digest['dbm_min'],
+                digest['frames'], (digest['loss'] or 0.0) * 100)
+
+        date = datetime.datetime.strptime(digest['date'], '%Y-%m-%d')
+        message = self.formatTemplate(templates['MESSAGE_TABLE_DIGEST'],
+                                      date.strftime('%m/%d'), message_opt)
+        message += ' ' + templates['MESSAGE_TABLE_HASH_TAG']
+
+        return message
+
+    def formatTemplate(self, template, *values):
+        # same as the templates of the message module: {0}, {1}, ...
+        for i, value in enumerate(values):
+            if isinstance(value, float):
+                value = round(value, 1)
+            template = template.replace('{' + str(i) + '}', str(value))
+        return template
+
+
+if __name__ == '__main__':
+
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+
+    arg_parser = argparse.ArgumentParser(description='Create the daily digest of each plant.')
+    arg_parser.add_argument('--id', help='originator id (default: all devices)')
+    arg_parser.add_argument('--date', default=yesterday.strftime('%Y-%m-%d'),
+                            help="first day: 'YYYY-mm-dd' (default: yesterday)")
+    arg_parser.add_argument('--days', type=int, default=1, help='number of days')
+    arg_parser.add_argument('--output', help='append the digests in JSON Lines to the file')
+    arg_parser.add_argument('--tweet', action='store_true', help='tweet the digests')
+    args = arg_parser.parse_args()
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.debug("--- start: {0} ----".format(__file__))
+
+    config = cmConfig()
+    date = datetime.datetime.strptime(args.date, '%Y-%m-%d')
+
+    data_store = PlantTwitterDatastore(logger)
+    data_store.openConnection(read_only=True)
+
+    eo_digest = PlantTwitterDigest(logger)
+    digests = []
+    for b_sensor_id, device_model in config.device_list.items():
+        if args.id and b_sensor_id.decode('utf-8') != args.id.lower():
+            continue
+        if device_model not in PlantTwitterMessage.SUPPORTED_DEVICES:
+            continue
+        digests += eo_digest.createDigests(
+            data_store, b_sensor_id.decode('utf-8'), device_model, date, args.days)
+
+    data_store.closeConnection()
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for digest in digests:
+                f.write(json.dumps(digest, ensure_ascii=False) + '\n')
+    elif args.tweet is False:
+        for digest in digests:
+            print(digest['message'])
+
+    if args.tweet:
+        outbox = PlantTwitterOutbox(logger)
+        outbox.openConnection()
+        for digest in digests:
+            outbox.enqueueMessage(digest['message'], outbox.createKey(
+                digest['id'], 'digest', digest['date']))
+        outbox.closeConnection()
+
+    logger.debug("--- end: {0} ----".format(__file__))
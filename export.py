@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""Export the sensor data of the database.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+データベースに保存したセンサーデータを、指定したデバイスと期間で
+ファイルに出力します。export.py は単独で動作するアプリケーションです。
+以下のように実行してください。
+
+$ python3 ./export.py --format csv --begin '2017-01-01 00:00:00' --output logs.csv
+$ python3 ./export.py --id 040154f1 --format jsonl --gzip --output logs.jsonl.gz
+
+出力形式は、CSV(csv)、JSON Lines(jsonl)、カラム形式のバイナリ(columnar)です。
+データはPlantTwitterDatastore.iterRecords()でチャンク毎に読み込むので、
+期間の大きさに関係なくメモリ使用量は一定で、receiver.py の書き込みを
+ブロックしません。
+
+Export the sensor data stored in the database to a file by the device and
+the time range. This application works standalone. you can run as follows.
+
+$ python3 ./export.py --format csv --begin '2017-01-01 00:00:00' --output logs.csv
+$ python3 ./export.py --id 040154f1 --format jsonl --gzip --output logs.jsonl.gz
+
+The output formats are CSV (csv), JSON Lines (jsonl) and columnar binary
+(columnar). The data is read in chunks by PlantTwitterDatastore.iterRecords(),
+so the memory usage stays flat regardless of the size of the range, and the
+writer of receiver.py is not blocked.
+
+Columnar binary format:
+    magic b'PTCOL1\\n', a JSON line of the column names and types,
+    then blocks of each chunk:
+        row count: uint32 (little endian), 0 is the end of the file
+        each column:
+            null bitmap: (row count + 7) // 8 bytes
+            int: int64 array, real: float64 array,
+            text: uint32 array of the lengths, and the utf-8 bytes
+"""
+
+import io
+import sys
+import csv
+import json
+import gzip
+import struct
+import argparse
+import datetime
+from array import array
+
+from config import cmConfig
+from logger import cmLogger
+from datastore import PlantTwitterDatastore
+
+
+class PlantTwitterExport():
+
+    EXPORT_FORMATS = ('csv', 'jsonl', 'columnar')
+
+    # exported columns: name, type, row index of PlantTwitterDatastore
+    EXPORT_COLUMNS = (
+        ('ID', 'int', PlantTwitterDatastore.ROW_INDEX_ID),
+        ('ORIGINATOR_ID', 'text', PlantTwitterDatastore.ROW_INDEX_ORIGINATOR_ID),
+        ('DEVICE_MODEL', 'text', PlantTwitterDatastore.ROW_INDEX_DEVICE_MODEL),
+        ('TELEGRAM_TYPE', 'text', PlantTwitterDatastore.ROW_INDEX_TELEGRAM_TYPE),
+        ('DB_0', 'text', PlantTwitterDatastore.ROW_INDEX_DB_0),
+        ('DB_1', 'text', PlantTwitterDatastore.ROW_INDEX_DB_1),
+        ('DB_2', 'text', PlantTwitterDatastore.ROW_INDEX_DB_2),
+        ('DB_3', 'text', PlantTwitterDatastore.ROW_INDEX_DB_3),
+        ('DBM', 'int', PlantTwitterDatastore.ROW_INDEX_DBM),
+        ('TEMPERATURE', 'real', PlantTwitterDatastore.ROW_INDEX_TEMPERATURE),
+        ('SOIL_MOISTURE', 'int', PlantTwitterDatastore.ROW_INDEX_SOIL_MOISTURE),
+        ('HUMIDITY', 'int', PlantTwitterDatastore.ROW_INDEX_HUMIDITY),
+        ('CONTACT_SWITCH', 'text', PlantTwitterDatastore.ROW_INDEX_CONTACT_SWITCH),
+        ('ROCKER_SWITCH', 'text', PlantTwitterDatastore.ROW_INDEX_ROCKER_SWITCH),
+        ('CREATE_AT', 'text', PlantTwitterDatastore.ROW_INDEX_CREATE_AT),
+        ('RECEIVED_AT', 'int', PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT),
+    )
+
+    COLUMNAR_MAGIC = b'PTCOL1\n'
+
+    def __init__(self, logger, chunk_rows=1000):
+        self.logger = logger
+        self.chunk_rows = chunk_rows
+
+    def iterChunks(self, data_store, originator_id, begin_at, end_at):
+        """Iterate the normalized rows in chunks.
+
+        行を出力用の値(bytesは文字列、空の値はNone)に変換して、チャンク毎に返します。
+
+        Iterate the rows converted to the output values (bytes to str, and
+        empty values to None) in chunks.
+        """
+
+        chunk = []
+        for r in data_store.iterRecords(originator_id, begin_at, end_at, self.chunk_rows):
+            values = []
+            for name, type, index in self.EXPORT_COLUMNS:
+                v = r[index]
+                if isinstance(v, bytes):
+                    v = v.decode('utf-8')
+                if v == '':
+                    v = None
+                values.append(v)
+            chunk.append(values)
+
+            if len(chunk) >= self.chunk_rows:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    def exportRecords(self, data_store, f, format, originator_id=None, begin_at=0, end_at=None):
+        """Write the records to the binary file object, and return the rows.
+
+        レコードをバイナリモードのファイルオブジェクトに出力して、行数を返します。
+
+        Write the records to the file object of binary mode, and return the
+        number of rows.
+        """
+
+        chunks = self.iterChunks(data_store, originator_id, begin_at, end_at)
+
+        if format == 'csv':
+            rows = self.writeCsv(f, chunks)
+        elif format == 'jsonl':
+            rows = self.writeJsonLines(f, chunks)
+        elif format == 'columnar':
+            rows = self.writeColumnar(f, chunks)
+        else:
+            self.logger.error("export: Unsupported format:{0}".format(format))
+            return 0
+
+        self.logger.info("export: format={0} rows={1}".format(format, rows))
+
+        return rows
+
+    def writeCsv(self, f, chunks):
+        rows = 0
+        text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow([c[0] for c in self.EXPORT_COLUMNS])
+        for chunk in chunks:
+            writer.writerows(chunk)
+            rows += len(chunk)
+        text.flush()
+        text.detach()
+        return rows
+
+    def writeJsonLines(self, f, chunks):
+        rows = 0
+        names = [c[0] for c in self.EXPORT_COLUMNS]
+        for chunk in chunks:
+            lines = [json.dumps(dict(zip(names, values)), ensure_ascii=False)
+                     for values in chunk]
+            f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            rows += len(chunk)
+        return rows
+
+    def writeColumnar(self, f, chunks):
+        rows = 0
+        f.write(self.COLUMNAR_MAGIC)
+        f.write((json.dumps([[c[0], c[1]] for c in self.EXPORT_COLUMNS]) + '\n').encode('utf-8'))
+
+        for chunk in chunks:
+            f.write(struct.pack('<I', len(chunk)))
+            for i, (name, type, index) in enumerate(self.EXPORT_COLUMNS):
+                self.writeColumn(f, type, [values[i] for values in chunk])
+            rows += len(chunk)
+
+        f.write(struct.pack('<I', 0))
+        return rows
+
+    def writeColumn(self, f, type, column):
+        nulls = bytearray((len(column) + 7) // 8)
+        for i, v in enumerate(column):
+            if v is None:
+                nulls[i // 8] |= 1 << (i % 8)
+        f.write(bytes(nulls))
+
+        if type == 'int':
+            f.write(array('q', [0 if v is None else int(v) for v in column]).tobytes())
+        elif type == 'real':
+            f.write(array('d', [0.0 if v is None else float(v) for v in column]).tobytes())
+        else:
+            data = [b'' if v is None else str(v).encode('utf-8') for v in column]
+            f.write(array('I', [len(d) for d in data]).tobytes())
+            f.write(b''.join(data))
+
+
+def parseTime(value):
+    # epoch milliseconds or localtime 'YYYY-mm-dd HH:MM:SS'
+    if value.isdigit():
+        return int(value)
+    return int(datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp() * 1000)
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Export the sensor data.')
+    arg_parser.add_argument('--id', help='originator id (default: all devices)')
+    arg_parser.add_argument('--begin', default='0',
+                            help="begin time: 'YYYY-mm-dd HH:MM:SS' or epoch milliseconds")
+    arg_parser.add_argument('--end', help="end time: 'YYYY-mm-dd HH:MM:SS' or epoch milliseconds")
+    arg_parser.add_argument('--format', default='csv', choices=PlantTwitterExport.EXPORT_FORMATS)
+    arg_parser.add_argument('--gzip', action='store_true', help='compress the output')
+    arg_parser.add_argument('--output', help='output file (default: standard output)')
+    args = arg_parser.parse_args()
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.debug("--- start: {0} ----".format(__file__))
+
+    begin_at = parseTime(args.begin)
+    end_at = parseTime(args.end) if args.end else None
+    originator_id = args.id.lower() if args.id else None
+
+    if args.output:
+        out_file = open(args.output, 'wb')
+    else:
+        out_file = sys.stdout.buffer
+
+    if args.gzip:
+        export_file = gzip.GzipFile(fileobj=out_file, mode='wb')
+    else:
+        export_file = out_file
+
+    data_store = PlantTwitterDatastore(logger)
+    data_store.openConnection()
+
+    eo_export = PlantTwitterExport(logger)
+    eo_export.exportRecords(data_store, export_file, args.format,
+                            originator_id, begin_at, end_at)
+
+    data_store.closeConnection()
+
+    if args.gzip:
+        export_file.close()
+    if args.output:
+        out_file.close()
+    else:
+        out_file.flush()
+
+    logger.debug("--- end: {0} ----".format(__file__))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""Per-frame latency tracing from the serial port to the tweet.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+受信したフレーム毎に、各段階の時刻(time.monotonic())を記録します。
+    first_byte : receivePacket()が同期バイトを読んだ時刻
+    framed     : フレームの受信が終わった時刻
+    parsed     : ESP3/ERP2の解析が終わった時刻
+    decoded    : センサーの値を取得した時刻
+    committed  : データベースにコミットした時刻
+    tweeted    : フレームの値からメッセージを作成した時刻 (daemon.py)
+first_byteからの経過時間は、metricsモジュールの
+plant_twitter_frame_latency_seconds{stage}に集計します。
+committedまでの時間がPROFILER_SLOW_FRAME_SECONDSを超えたフレームは、
+各段階の時間を slow_frames.log に出力します。
+
+Record the time (time.monotonic()) of each stage of each received frame.
+    first_byte : receivePacket() read the sync byte
+    framed     : the frame is received
+    parsed     : ESP3/ERP2 is parsed
+    decoded    : the sensor values are decoded
+    committed  : committed to the database
+    tweeted    : a message is created from the values of the frame (daemon.py)
+The time from first_byte is collected in plant_twitter_frame_latency_seconds
+{stage} of the metrics module.
+The time of each stage of a frame that takes more than
+PROFILER_SLOW_FRAME_SECONDS to be committed is written to slow_frames.log.
+"""
+
+import time
+import threading
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+
+
+class PlantTwitterFrameTrace():
+
+    STAGES = ('first_byte', 'framed', 'parsed', 'decoded', 'committed', 'tweeted')
+
+    def __init__(self, first_byte_at=None):
+        if first_byte_at is None:
+            first_byte_at = time.monotonic()
+        # stage -> monotonic time
+        self.marks = {'first_byte': first_byte_at}
+
+    def mark(self, stage):
+        self.marks[stage] = time.monotonic()
+
+    def getLatency(self, stage):
+        # seconds from the first byte, or None if not reached
+        if stage not in self.marks:
+            return None
+        return self.marks[stage] - self.marks['first_byte']
+
+
+class PlantTwitterFrameTracer():
+
+    TRACE_SLOW_FRAME_FILE = '/slow_frames.log'
+
+    # the tweet is created every 30 minutes or so.
+    TWEETED_BUCKETS = (1.0, 10.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0)
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        self.slow_frame_seconds = float(config.option_list[
+            'Profiler']['PROFILER_SLOW_FRAME_SECONDS'])
+        self.slow_frame_file = config.option_list['DEFAULT'][
+            'DATA_FILE_PATH'] + self.TRACE_SLOW_FRAME_FILE
+
+        metrics = cmMetrics()
+        self.metric_latency = {}
+        for stage in PlantTwitterFrameTrace.STAGES[1:]:
+            buckets = self.TWEETED_BUCKETS if stage == 'tweeted' else None
+            self.metric_latency[stage] = metrics.histogram(
+                'plant_twitter_frame_latency_seconds',
+                'Time from the first byte of a frame to each stage.',
+                {'stage': stage}, buckets)
+        self.metric_slow_frames = metrics.counter(
+            'plant_twitter_slow_frames_total', 'Frames slower than the threshold.')
+
+        self.lock = threading.Lock()
+
+    def finishFrame(self, trace, originator_id=b''):
+        """Collect the latency of the registered frame.
+
+        登録が終わったフレームの経過時間を集計して、遅いフレームを記録します。
+
+        Collect the latency of the registered frame, and log it if slow.
+        """
+
+        if trace is None:
+            return
+
+        for stage in ('framed', 'parsed', 'decoded', 'committed'):
+            latency = trace.getLatency(stage)
+            if latency is not None:
+                self.metric_latency[stage].observe(latency)
+
+        latency = trace.getLatency('committed')
+        if latency is not None and latency > self.slow_frame_seconds:
+            self.metric_slow_frames.inc()
+            self.writeSlowFrame(trace, originator_id)
+
+    def finishTweet(self, trace):
+        if trace is None:
+            return
+        trace.mark('tweeted')
+        self.metric_latency['tweeted'].observe(trace.getLatency('tweeted'))
+
+    def writeSlowFrame(self, trace, originator_id):
+        if isinstance(originator_id, bytes):
+            originator_id = originator_id.decode('utf-8')
+
+        # milliseconds of each stage from the previous one
+        stages = []
+        previous_at = trace.marks['first_byte']
+        for stage in PlantTwitterFrameTrace.STAGES[1:]:
+            if stage in trace.marks:
+                stages.append("{0}={1:.1f}".format(
+                    stage, (trace.marks[stage] - previous_at) * 1000))
+                previous_at = trace.marks[stage]
+
+        with self.lock:
+            with open(self.slow_frame_file, 'a') as f:
+                f.write("{0} id={1} total={2:.1f} {3}\n".format(
+                    time.strftime('%Y-%m-%d %H:%M:%S'), originator_id,
+                    trace.getLatency('committed') * 1000, ' '.join(stages)))
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""Radio link quality statistics of each device.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+パケット受信ごとに、デバイスとゲートウェイ(SERIAL_PORT)毎の電波の品質を
+更新します。直近LINK_STATS_WINDOW個のフレームについて、dBmの最小・平均・
+最大・パーセンタイル(10, 50, 90)、サブテレグラム数の平均、観測した送信間隔
+(間隔の中央値)から推定したパケットロス率を保持します。値はソート済みの
+リストで保持するので、1回の更新はO(log n)です。
+統計はLINK_STATS_INTERVAL秒毎に、registerモジュールが'LINK_STATS'テーブルに
+書き込みます。テーブルはデバイス毎に1行なので、O(デバイス数)で読み込めます。
+時間枠は再起動すると空から始まりますが、累計のフレーム数とサブテレグラム数は
+テーブルに加算されます。最後のフレームより古いフレーム(スプールの再生など)は
+無視します。
+
+Update the radio link quality of each device and gateway (SERIAL_PORT) on
+every received packet. For the last LINK_STATS_WINDOW frames, keep the
+minimum, the average, the maximum and the percentiles (10, 50, 90) of dBm,
+the average of the sub telegrams, and the packet loss estimated from the
+observed reporting interval (the median of the intervals). The values are
+kept in sorted lists, so an update costs O(log n).
+The register module writes the statistics into the 'LINK_STATS' table every
+LINK_STATS_INTERVAL seconds. The table has a row of each device, so it can
+be read in O(devices).
+The window starts empty after a restart, but the total frames and sub
+telegrams are added to the table. A frame older than the last one (replayed
+from the spool and so on) is ignored.
+
+"""
+
+import bisect
+from collections import deque
+
+from config import cmConfig
+from logger import cmLogger
+
+
+class PlantTwitterLinkWindow():
+
+    # percentiles of dBm: nearest rank
+    LINK_PERCENTILES = (10, 50, 90)
+
+    def __init__(self, window_size):
+        self.window_size = window_size
+
+        # deque of (received_at, dbm, sub telegrams, interval from the previous frame)
+        self.frames = deque()
+        # sorted dBm and intervals in the window: the interval of the head is not included.
+        self.dbm_sorted = []
+        self.intervals_sorted = []
+        self.dbm_sum = 0
+        self.sub_telegrams_sum = 0
+
+        # totals not written yet
+        self.frames_total = 0
+        self.sub_telegrams_total = 0
+
+    def pushFrame(self, dbm, sub_telegrams, received_at):
+        # a replayed frame is older than the last one: the window keeps the order.
+        if self.frames and received_at <= self.frames[-1][0]:
+            return
+
+        interval = None
+        if self.frames:
+            interval = received_at - self.frames[-1][0]
+            bisect.insort(self.intervals_sorted, interval)
+
+        self.frames.append((received_at, dbm, sub_telegrams, interval))
+        bisect.insort(self.dbm_sorted, dbm)
+        self.dbm_sum += dbm
+        self.sub_telegrams_sum += sub_telegrams
+
+        self.frames_total += 1
+        self.sub_telegrams_total += sub_telegrams
+
+        # evict the oldest frame
+        if len(self.frames) > self.window_size:
+            (received_at, dbm, sub_telegrams, interval) = self.frames.popleft()
+            del self.dbm_sorted[bisect.bisect_left(self.dbm_sorted, dbm)]
+            self.dbm_sum -= dbm
+            self.sub_telegrams_sum -= sub_telegrams
+
+            # the new head has no previous frame in the window
+            interval = self.frames[0][3]
+            del self.intervals_sorted[bisect.bisect_left(self.intervals_sorted, interval)]
+
+    def getPercentile(self, percentile):
+        return self.dbm_sorted[min(len(self.dbm_sorted) - 1,
+                                   len(self.dbm_sorted) * percentile // 100)]
+
+    def getLoss(self):
+        """Estimate the packet loss from the observed reporting interval.
+
+        送信間隔の中央値から期待するフレーム数を求めて、
+        (期待するフレーム数, ロス率)を返します。間隔が分からない場合は(None, None)です。
+
+        Return (expected frames, loss rate) from the median of the intervals.
+        If the interval is unknown, return (None, None).
+        """
+
+        if not self.intervals_sorted:
+            return (None, None)
+        interval = self.intervals_sorted[len(self.intervals_sorted) // 2]
+        if interval <= 0:
+            return (None, None)
+
+        span = self.frames[-1][0] - self.frames[0][0]
+        expected = max(len(self.frames), int(round(span / interval)) + 1)
+        return (expected, 1 - len(self.frames) / expected)
+
+    def getSummary(self, originator_id, gateway):
+        # a row of the LINK_STATS table: the totals are the increments.
+        frames = len(self.frames)
+        interval = None
+        if self.intervals_sorted:
+            interval = self.intervals_sorted[len(self.intervals_sorted) // 2]
+        (expected, loss) = self.getLoss()
+
+        summary = (originator_id, gateway, frames,
+                   self.dbm_sorted[0], self.dbm_sum / frames, self.dbm_sorted[-1]) + \
+            tuple(self.getPercentile(p) for p in self.LINK_PERCENTILES) + \
+            (self.sub_telegrams_sum / frames, interval, expected, loss,
+             self.frames_total, self.sub_telegrams_total,
+             self.frames[0][0], self.frames[-1][0])
+
+        return summary
+
+    def clearTotals(self):
+        self.frames_total = 0
+        self.sub_telegrams_total = 0
+
+
+class PlantTwitterLinkStats():
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        self.window_size = int(config.option_list['LinkStats']['LINK_STATS_WINDOW'])
+        self.write_interval = int(float(config.option_list['LinkStats'][
+                                  'LINK_STATS_INTERVAL']) * 1000)
+        # the gateway receiving the frames
+        self.gateway = config.option_list['DEFAULT']['SERIAL_PORT']
+
+        # originator id -> PlantTwitterLinkWindow
+        self.links = {}
+        # originator ids updated after the last write
+        self.updated = set()
+        self.written_at = 0
+
+    def updateLink(self, originator_id, dbm, sub_telegrams, received_at):
+        link = self.links.get(originator_id)
+        if link is None:
+            link = self.links[originator_id] = PlantTwitterLinkWindow(self.window_size)
+        link.pushFrame(dbm, sub_telegrams, received_at)
+        self.updated.add(originator_id)
+
+    def getSummary(self, originator_id):
+        link = self.links.get(originator_id)
+        if link is None:
+            return None
+        return link.getSummary(originator_id, self.gateway)
+
+    def popSummaries(self, received_at):
+        """Return the summaries to write, if LINK_STATS_INTERVAL passed.
+
+        前回の書き込みからLINK_STATS_INTERVAL秒が経過した場合は、更新された
+        デバイスの'LINK_STATS'テーブルの行のリストを返します。それ以外は空の
+        リストを返します。
+
+        Return the list of the rows of the 'LINK_STATS' table of the updated
+        devices, if LINK_STATS_INTERVAL passed since the last write.
+        Otherwise return an empty list.
+        """
+
+        if received_at - self.written_at < self.write_interval:
+            return []
+        self.written_at = received_at
+
+        summaries = []
+        for originator_id in sorted(self.updated):
+            summaries.append(self.getSummary(originator_id))
+            self.links[originator_id].clearTotals()
+        self.updated.clear()
+
+        self.logger.debug("link stats: write devices:{0}".format(len(summaries)))
+
+        return summaries
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Detect the silent devices by the deadline of each device.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+config.ini のデバイスリストのデバイス毎に、受信間隔から次のパケットの期限を
+求めて、期限を過ぎたデバイスを検知します。(電池切れ、電波の範囲外など)
+期限は受信間隔の指数移動平均(約LIVENESS_SAMPLES個)のLIVENESS_FACTOR倍で、
+間隔が分からない間はLIVENESS_DEFAULT_TIMEOUT秒です。期限を過ぎた間隔は期限までとして
+平均するので、一度の停止で期限が大きく延びることはありません。
+LIVENESS_EVENT_MODELSのデバイスモデル(PTM210Jなど、押された時だけ送信する
+デバイス)は間隔が一定ではないので、常にLIVENESS_DEFAULT_TIMEOUT秒です。
+期限はタイマーホイール(LIVENESS_TICK秒のスロットがLIVENESS_SLOTS個)で
+管理するので、パケット受信ごとの更新はO(1)で、データベースの定期的な
+検索は行いません。ホイールの1周より先の期限は、周回のたびに確認します。
+期限を過ぎると'silent'、その後にパケットを受信すると'alive'のイベントを返し、
+registerモジュールが'LIVENESS_EVENTS'テーブルに登録します。
+
+Detect the devices past the deadline of the next packet (the energy harvester
+ran dry, out of the radio range and so on). The deadline of each device in the
+device list of the config.ini file is LIVENESS_FACTOR times the exponential
+moving average of the intervals (over about LIVENESS_SAMPLES intervals), or
+LIVENESS_DEFAULT_TIMEOUT seconds while the interval is unknown. An interval
+past the deadline is averaged as the deadline, so an outage does not stretch
+the deadline much.
+The device models of LIVENESS_EVENT_MODELS (PTM210J and so on, which send
+only when pressed) have no regular interval, and their deadline is always
+LIVENESS_DEFAULT_TIMEOUT seconds.
+The deadlines are kept in a timer wheel (LIVENESS_SLOTS slots of LIVENESS_TICK
+seconds), so an update on a packet costs O(1), and the database is not
+scanned periodically. A deadline beyond a turn of the wheel is checked on
+every turn.
+When the deadline passes, a 'silent' event is returned, and when a packet is
+received after it, an 'alive' event. The register module registers the
+events into the 'LIVENESS_EVENTS' table.
+
+"""
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+
+
+class PlantTwitterLivenessMonitor():
+
+    LIVENESS_SILENT = 'silent'
+    LIVENESS_ALIVE = 'alive'
+
+    def __init__(self, logger, now_at):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.factor = float(self.config.option_list['Liveness']['LIVENESS_FACTOR'])
+        self.default_timeout = int(float(self.config.option_list['Liveness'][
+                                   'LIVENESS_DEFAULT_TIMEOUT']) * 1000)
+        # weight of a new interval: the span of LIVENESS_SAMPLES intervals
+        self.alpha = 2 / (int(self.config.option_list['Liveness']['LIVENESS_SAMPLES']) + 1)
+        models = self.config.option_list['Liveness']['LIVENESS_EVENT_MODELS'].replace(' ', '')
+        self.event_models = set(m.upper() for m in models.split(',') if m)
+        self.tick = int(float(self.config.option_list['Liveness']['LIVENESS_TICK']) * 1000)
+
+        # timer wheel: slot -> set of originator ids
+        self.wheel = [set() for i in range(int(self.config.option_list['Liveness'][
+                                               'LIVENESS_SLOTS']))]
+        # the next tick to expire: the ticks before it are passed.
+        self.cursor = now_at // self.tick
+
+        # originator id -> deadline, slot, the last receive time, the average interval
+        self.deadlines = {}
+        self.slots = {}
+        self.received_at = {}
+        self.intervals = {}
+        self.silent = set()
+
+        metrics = cmMetrics()
+        self.metric_silent = metrics.counter(
+            'plant_twitter_device_silent_total', 'Devices past the deadline of the next packet.')
+        metrics.gauge('plant_twitter_devices_silent',
+                      'Devices silent now.').setFunction(lambda: len(self.silent))
+
+        # the devices not received yet
+        for originator_id in self.config.device_list:
+            self.schedule(originator_id, now_at + self.default_timeout)
+
+    def getTimeout(self, originator_id):
+        interval = self.intervals.get(originator_id)
+        if interval is None:
+            return self.default_timeout
+        return int(interval * self.factor)
+
+    def updateInterval(self, originator_id, interval):
+        # the devices sending only on an event have no interval to learn.
+        if self.config.device_list.get(originator_id) in self.event_models:
+            return
+        # an interval past the deadline counts up to the deadline.
+        interval = min(interval, self.getTimeout(originator_id))
+        average = self.intervals.get(originator_id)
+        if average is None:
+            self.intervals[originator_id] = interval
+        else:
+            self.intervals[originator_id] = average + self.alpha * (interval - average)
+
+    def schedule(self, originator_id, deadline):
+        slot = max(deadline // self.tick, self.cursor) % len(self.wheel)
+        if originator_id in self.slots:
+            self.wheel[self.slots[originator_id]].discard(originator_id)
+        self.wheel[slot].add(originator_id)
+        self.slots[originator_id] = slot
+        self.deadlines[originator_id] = deadline
+
+    def updateDevice(self, originator_id, received_at):
+        """Move the deadline of the device, and return an event if alive again.
+
+        デバイスの期限を更新します。'silent'のデバイスの場合はイベント
+        (originator_id, 'alive', 前回の受信時刻, 期限までの時間, received_at)
+        を返します。それ以外はNoneを返します。
+
+        Move the deadline of the device. If the device was silent, return an
+        event (originator_id, 'alive', the last receive time, the timeout,
+        received_at). Otherwise return None.
+        """
+
+        event = None
+        last_received_at = self.received_at.get(originator_id)
+
+        if last_received_at is not None:
+            # a replayed frame is older than the last one.
+            if received_at <= last_received_at:
+                return None
+            self.updateInterval(originator_id, received_at - last_received_at)
+
+        if originator_id in self.silent:
+            self.silent.discard(originator_id)
+            event = (originator_id, self.LIVENESS_ALIVE, last_received_at,
+                     self.getTimeout(originator_id), received_at)
+            self.logger.info("device alive:id={0}".format(originator_id))
+
+        self.received_at[originator_id] = received_at
+        self.schedule(originator_id, received_at + self.getTimeout(originator_id))
+
+        return event
+
+    def expireDevices(self, now_at):
+        """Return the events of the devices past the deadline.
+
+        経過したスロットを進めて、期限を過ぎたデバイスのイベント
+        (originator_id, 'silent', 最後の受信時刻, 期限までの時間, 期限)
+        のリストを返します。
+
+        Advance the wheel over the passed ticks, and return the list of the
+        events (originator_id, 'silent', the last receive time, the timeout,
+        the deadline) of the devices past the deadline.
+        """
+
+        events = []
+        now_tick = now_at // self.tick
+
+        # a turn of the wheel visits all the slots.
+        if now_tick - self.cursor > len(self.wheel):
+            self.cursor = now_tick - len(self.wheel)
+
+        while self.cursor < now_tick:
+            slot = self.wheel[self.cursor % len(self.wheel)]
+            for originator_id in [i for i in slot if self.deadlines[i] <= now_at]:
+                slot.discard(originator_id)
+                del self.slots[originator_id]
+                self.silent.add(originator_id)
+                self.metric_silent.inc()
+
+                last_received_at = self.received_at.get(originator_id)
+                events.append((originator_id, self.LIVENESS_SILENT, last_received_at,
+                               self.getTimeout(originator_id),
+                               self.deadlines.pop(originator_id)))
+                self.logger.error("device silent:id={0} last received={1}".format(
+                    originator_id, last_received_at))
+            self.cursor += 1
+
+        return events
@@ -11,6 +11,10 @@ STM431JS(with Soil Moisture): A5-10-03
 STM431J: A5-02-05
 STM431JH(with HSM100): A5-04-01
 
+データベースから読み込んだデバイス毎の直近の行はメモリに保持して、次回は
+追加された行(前回の最後の行IDより後)だけを読み込みます。
+readDevices()はツイートする複数のデバイスをまとめて読み込みます。
+
 Get sensor data from the database, and create a message from the
 condition of the sensor data.
 Operating check devices are as follows.
@@ -19,13 +23,17 @@ STM431JS(with Soil Moisture): A5-10-03
 STM431J: A5-02-05
 STM431JH(with HSM100): A5-04-01
 
+The recent rows of each device read from the database are kept in memory,
+and only the added rows (after the last row ID of the previous read) are read
+next time. readDevices() reads the devices of a tweet pass at once.
+
 """
 
-import time
-import datetime
+from collections import deque
 
 from config import cmConfig
 from logger import cmLogger
+from clock import PlantTwitterClock
 from datastore import PlantTwitterDatastore
 
 
@@ -33,18 +41,42 @@ class PlantTwitterMessage():
 
     SUPPORTED_DEVICES = ('STM431J', 'STM431JS', 'STM431JH')
 
+    # rows of a device: same as PlantTwitterDatastore.selectRecord()
+    TAIL_CACHE_ROWS = 60
+    TAIL_CACHE_MINUTES = 60
+
     sensor_logs = []
 
-    def __init__(self, logger):
+    def __init__(self, logger, readings=None, clock=None):
         self.logger = logger
         self.config = cmConfig()
+        self.clock = PlantTwitterClock() if clock is None else clock
+
+        # shared state of daemon.py: read in place of the database.
+        self.readings = readings
+
+        # (originator id, device model) -> (deque of the recent rows, the latest
+        # is the last, the last row ID read)
+        self.tail_cache = {}
 
         self.soil_moisture_dry = int(self.config.option_list['Message'][
                                      'MESSAGE_CONDITION_SOIL_MOISTURE_DRY'])
         self.soil_moisture_a_little_dry = int(self.config.option_list['Message'][
                                               'MESSAGE_CONDITION_SOIL_MOISTURE_A_LITLE_DRY'])
+        self.watering_minutes = int(self.config.option_list['Message'][
+                                    'MESSAGE_CONDITION_WATERING_MINUTES'])
+
+    def createMessage(self, sensor_id, device_model, prefetched=None):
+        """Create a message of the device.
 
-    def createMessage(self, sensor_id, device_model):
+        デバイスのメッセージを作成して、(メッセージ, 水やり中)を返します。
+        prefetchedはreadDevices()が返したデバイスの(行のリスト, 水やりイベント)で、
+        指定した場合はデータベースを読み込みません。
+
+        Create a message of the device, and return (message, watering).
+        prefetched is (list of the rows, watering event) of the device returned
+        by readDevices(). If it is given, the database is not read.
+        """
 
         message = ''
         message_opt = ''
@@ -58,20 +90,19 @@ class PlantTwitterMessage():
             return (message, now_watering)
 
         # Get sensor data from the database
-        sensor_rows = self.readSensorLogs(sensor_id, device_model)
+        if prefetched is not None:
+            (self.sensor_logs, watering_event) = prefetched
+            sensor_rows = len(self.sensor_logs)
+        else:
+            sensor_rows = self.readSensorLogs(sensor_id, device_model)
         if sensor_rows == 0:
             self.logger.debug("createMessage: no sensor logs.")
             return (message, now_watering)
 
-        data_store = PlantTwitterDatastore(self.logger)
-        sensor_time = time.strptime(
-            self.sensor_logs[0][data_store.ROW_INDEX_CREATE_AT], '%Y-%m-%d %H:%M:%S')
-        sensor_datetime = datetime.datetime(sensor_time.tm_year, sensor_time.tm_mon,
-                                            sensor_time.tm_mday, sensor_time.tm_hour,
-                                            sensor_time.tm_min, sensor_time.tm_sec)
+        data_store = PlantTwitterDatastore(self.logger, self.clock)
 
         # Create a hash hag of Twitter
-        now_datetime = datetime.datetime.today()
+        now_datetime = self.clock.today()
         message_hashtag = now_datetime.strftime(
             " %m/%d %H:%M ") + self.config.option_list['Message']['MESSAGE_TABLE_HASH_TAG']
 
@@ -82,28 +113,14 @@ class PlantTwitterMessage():
                 0][data_store.ROW_INDEX_SOIL_MOISTURE]
 
             # Soil moisture conditions. : water the plant within 30 minutes
-            for sensor_row in self.sensor_logs:
-
-                past_sensor_soilmoisture = sensor_row[
-                    data_store.ROW_INDEX_SOIL_MOISTURE]
-
-                past_time = time.strptime(
-                    sensor_row[data_store.ROW_INDEX_CREATE_AT], '%Y-%m-%d %H:%M:%S')
-                past_datetime = datetime.datetime(past_time.tm_year, past_time.tm_mon,
-                                                  past_time.tm_mday, past_time.tm_hour,
-                                                  past_time.tm_min, past_time.tm_sec)
-
-                if now_datetime - past_datetime > datetime.timedelta(minutes=30):
-                    break
-
-                if (sensor_soilmoisture - past_sensor_soilmoisture) > 10 and \
-                        sensor_soilmoisture >= self.soil_moisture_dry:
-
-                    message_opt = self.config.option_list['Message'][
-                        'MESSAGE_TABLE_SOILMOISTURE_THANKYOU']
-                    message_opt = message_opt.replace(
-                        '{0}', str(sensor_soilmoisture))
-                    now_watering = True
+            if prefetched is None:
+                watering_event = self.readWateringEvent(sensor_id)
+            if watering_event is not None:
+                message_opt = self.config.option_list['Message'][
+                    'MESSAGE_TABLE_SOILMOISTURE_THANKYOU']
+                message_opt = message_opt.replace(
+                    '{0}', str(sensor_soilmoisture))
+                now_watering = True
 
             # Soil moisture conditions. : no water the plant within 30 minutes
             if message_opt == '':
@@ -181,19 +198,122 @@ class PlantTwitterMessage():
 
         rows_count = 0
 
-        data_store = PlantTwitterDatastore(self.logger)
+        if self.readings is not None:
+            self.sensor_logs = self.readings.selectRecord(sensor_id, device_model)
+            self.logger.debug("readSensorLogs: readings rows={0}".format(len(self.sensor_logs)))
+            return len(self.sensor_logs)
+
+        data_store = PlantTwitterDatastore(self.logger, self.clock)
         data_store.openConnection()
 
-        self.sensor_logs = data_store.selectRecord(sensor_id, device_model)
+        # only the rows after the cached rows
+        key = (data_store.toOriginatorID(sensor_id), device_model)
+        new_rows = data_store.selectRecordsAfter(
+            sensor_id, device_model, self.tail_cache.get(key, (None, 0))[1],
+            self.TAIL_CACHE_ROWS)
+
+        data_store.closeConnection()
+
+        self.sensor_logs = self.mergeTailCache(key, new_rows)
         rows_count = len(self.sensor_logs)
 
-        self.logger.debug("readSensorLogs: rows={0}".format(rows_count))
-        for r in self.sensor_logs:
-            id = r[data_store.ROW_INDEX_ORIGINATOR_ID]
-            create_at = r[data_store.ROW_INDEX_CREATE_AT]
-            temp = r[data_store.ROW_INDEX_TEMPERATURE]
-            soil = r[data_store.ROW_INDEX_SOIL_MOISTURE]
+        self.logger.debug("readSensorLogs: rows={0} new rows={1}".format(
+            rows_count, len(new_rows)))
+
+        return rows_count
+
+    def readDevices(self, devices):
+        """Read the rows and the watering events of the devices at once.
+
+        devicesのデバイス[(sensor_id, device_model)]の直近の行と水やりイベントを
+        1つの接続とデバイス数によらないクエリで読み込んで、createMessage()の
+        prefetchedに渡す{sensor_id: (行のリスト, 水やりイベント)}を返します。
+        daemon.pyの共有の状態を使う場合と、対応していないデバイスは含みません。
+
+        Read the recent rows and the watering events of the devices
+        [(sensor_id, device_model)] on a connection by the queries not
+        depending on the number of the devices, and return
+        {sensor_id: (list of the rows, watering event)} to pass to
+        prefetched of createMessage(). The shared state of daemon.py and the
+        unsupported devices are not included.
+        """
+
+        prefetched = {}
+        devices = [(i, m) for (i, m) in devices if m in self.SUPPORTED_DEVICES]
+        if self.readings is not None or not devices:
+            return prefetched
+
+        data_store = PlantTwitterDatastore(self.logger, self.clock)
+        data_store.openConnection()
+
+        # the rows after the oldest cached row ID of the devices
+        keys = dict((i, (data_store.toOriginatorID(i), m)) for (i, m) in devices)
+        last_ids = dict((i, self.tail_cache.get(keys[i], (None, 0))[1]) for i in keys)
+        recent_rows = data_store.selectRecentRecords(
+            devices, min(last_ids.values()), self.TAIL_CACHE_ROWS)
+
+        # the latest event of each device in the minutes
+        events = {}
+        for event in data_store.selectWateringEventsAfter(
+                data_store.getEpochMillis() - self.watering_minutes * 60 * 1000):
+            events[event[data_store.ROW_INDEX_WATERING_ORIGINATOR_ID]] = event
 
         data_store.closeConnection()
 
-        return rows_count
+        for (sensor_id, rows) in recent_rows.items():
+            new_rows = [r for r in rows if r[data_store.ROW_INDEX_ID] > last_ids[sensor_id]]
+            prefetched[sensor_id] = (self.mergeTailCache(keys[sensor_id], new_rows),
+                                     events.get(keys[sensor_id][0]))
+
+        self.logger.debug("readDevices: devices={0} new rows={1}".format(
+            len(devices), sum(len(r) for r in recent_rows.values())))
+
+        return prefetched
+
+    def mergeTailCache(self, key, new_rows):
+        """Add the new rows to the cache, and return the rows of the device.
+
+        新しい行(新しい順)をデバイスの直近の行に追加して、古い行を削除し、
+        selectRecord()と同じ新しい順の行のリストを返します。
+
+        Add the new rows (from the latest) to the recent rows of the device,
+        evict the old rows, and return the list of the rows from the latest
+        same as selectRecord().
+        """
+
+        (rows, last_id) = self.tail_cache.get(key, (deque(), 0))
+
+        if new_rows:
+            last_id = max(last_id, max(r[PlantTwitterDatastore.ROW_INDEX_ID] for r in new_rows))
+            # a replayed row may be older than the cached rows.
+            if rows and rows[-1][PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT] > \
+                    new_rows[-1][PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT]:
+                rows = deque(sorted(list(rows) + new_rows,
+                                    key=lambda r: r[PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT]))
+            else:
+                rows.extend(reversed(new_rows))
+
+        # evict the rows older than the window
+        begin_at = int(self.clock.time() * 1000) - self.TAIL_CACHE_MINUTES * 60 * 1000
+        while rows and (len(rows) > self.TAIL_CACHE_ROWS or
+                        rows[0][PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT] <= begin_at):
+            rows.popleft()
+        self.tail_cache[key] = (rows, last_id)
+
+        return list(reversed(rows))
+
+    def readWateringEvent(self, sensor_id):
+
+        if self.readings is not None:
+            return self.readings.selectWateringEvent(sensor_id, self.watering_minutes)
+
+        data_store = PlantTwitterDatastore(self.logger, self.clock)
+        data_store.openConnection()
+
+        event = data_store.selectWateringEvent(
+            sensor_id, self.watering_minutes)
+        self.logger.debug("readWateringEvent: event={0}".format(event))
+
+        data_store.closeConnection()
+
+        return event
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""Metrics of the application
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+受信パケット数、CRCエラー数、未登録デバイス数、キューの長さ、データベースの
+コミット時間、ツイートの送信数などのメトリクスを集計します。
+cmMetricsはプロセス内で共有されるレジストリで、Counter(累積値)、
+Gauge(現在値)、Histogram(分布)を作成します。値の更新は属性の加算だけなので、
+受信処理の負荷はほとんどありません。
+cmMetricsServerは、メトリクスをPrometheusのテキスト形式でローカルのHTTPポートに
+公開します。config.ini の[Metrics]で設定してください。
+
+    /metrics : Prometheusのテキスト形式のメトリクス
+    /healthz : プロセスが動作していれば200
+    /readyz  : すべてのコンポーネントが準備完了なら200、それ以外は503
+
+Collect the metrics such as received packets, CRC errors, unknown devices,
+queue length, commit time of the database and sent tweets.
+cmMetrics is the registry shared in the process, and creates Counter
+(cumulative value), Gauge (current value) and Histogram (distribution).
+Updating a value only adds to an attribute, so the overhead on the receiving
+path is very small.
+cmMetricsServer serves the metrics in the Prometheus text format on a local
+HTTP port. Configure it in the [Metrics] section of the config.ini file.
+
+    /metrics : metrics in the Prometheus text format
+    /healthz : 200 while the process is running
+    /readyz  : 200 if all components are ready, otherwise 503
+
+"""
+
+import time
+import bisect
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from config import cmConfig
+from logger import cmLogger
+
+
+class cmCounter():
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def collect(self, name, labels):
+        return ["{0}{1} {2}".format(name, labels, self.value)]
+
+
+class cmGauge():
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+    def setFunction(self, function):
+        # the value is read from the function when collected.
+        self.function = function
+
+    def collect(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            value = self.function()
+        return ["{0}{1} {2}".format(name, labels, value)]
+
+
+class cmHistogram():
+
+    # default buckets (seconds)
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                       0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.DEFAULT_BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def collect(self, name, labels):
+        lines = []
+        label_prefix = labels[:-1] + ',' if labels else '{'
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('{0}_bucket{1}le="{2}"}} {3}'.format(
+                name, label_prefix, bucket, cumulative))
+        lines.append("{0}_sum{1} {2}".format(name, labels, self.sum))
+        lines.append("{0}_count{1} {2}".format(name, labels, self.count))
+        return lines
+
+
+class cmMetrics():
+
+    # shared in the process: name -> [type, help, {labels: metric}]
+    registry = {}
+    registry_lock = threading.Lock()
+
+    # readiness of components: name -> ready
+    components = {}
+
+    start_time = time.time()
+
+    def getMetric(self, metric_class, metric_type, name, help, labels, *args):
+        labels_text = ''
+        if labels:
+            labels_text = '{' + ','.join('{0}="{1}"'.format(k, v)
+                                         for k, v in sorted(labels.items())) + '}'
+
+        entry = self.registry.get(name)
+        if entry is not None and labels_text in entry[2]:
+            return entry[2][labels_text]
+
+        with self.registry_lock:
+            entry = self.registry.setdefault(name, [metric_type, help, {}])
+            if labels_text not in entry[2]:
+                entry[2][labels_text] = metric_class(*args)
+            return entry[2][labels_text]
+
+    def counter(self, name, help, labels=None):
+        return self.getMetric(cmCounter, 'counter', name, help, labels)
+
+    def gauge(self, name, help, labels=None):
+        return self.getMetric(cmGauge, 'gauge', name, help, labels)
+
+    def histogram(self, name, help, labels=None, buckets=None):
+        return self.getMetric(cmHistogram, 'histogram', name, help, labels, buckets)
+
+    def setReady(self, component, ready=True):
+        self.components[component] = ready
+
+    def isReady(self):
+        return len(self.components) > 0 and all(self.components.values())
+
+    def render(self):
+        """Render the metrics in the Prometheus text format.
+
+        メトリクスをPrometheusのテキスト形式で出力します。
+
+        Render the metrics in the Prometheus text format.
+        """
+
+        lines = []
+        with self.registry_lock:
+            entries = sorted(self.registry.items())
+
+        for name, (metric_type, help, metrics) in entries:
+            lines.append("# HELP {0} {1}".format(name, help))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            for labels, metric in sorted(metrics.items()):
+                lines.extend(metric.collect(name, labels))
+
+        lines.append("# HELP plant_twitter_up_seconds Seconds since the process started.")
+        lines.append("# TYPE plant_twitter_up_seconds gauge")
+        lines.append("plant_twitter_up_seconds {0:.3f}".format(
+            time.time() - self.start_time))
+
+        lines.append("# HELP plant_twitter_component_ready Readiness of the components.")
+        lines.append("# TYPE plant_twitter_component_ready gauge")
+        for component, ready in sorted(self.components.items()):
+            lines.append('plant_twitter_component_ready{{component="{0}"}} {1}'.format(
+                component, int(ready)))
+
+        return '\n'.join(lines) + '\n'
+
+
+class cmMetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        metrics = cmMetrics()
+
+        if self.path == '/metrics':
+            self.sendText(200, metrics.render(),
+                          'text/plain; version=0.0.4; charset=utf-8')
+        elif self.path == '/healthz':
+            self.sendText(200, 'ok\n')
+        elif self.path == '/readyz':
+            lines = ["{0} {1}".format(c, 'ready' if r else 'not ready')
+                     for c, r in sorted(metrics.components.items())]
+            if metrics.isReady():
+                self.sendText(200, '\n'.join(lines) + '\n')
+            else:
+                self.sendText(503, '\n'.join(lines) + '\n')
+        else:
+            self.sendText(404, 'not found\n')
+
+    def sendText(self, code, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class cmMetricsServer():
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+        self.server = None
+
+        self.enabled = self.config.option_list[
+            'Metrics']['METRICS_ENABLED'] == 'True'
+        self.address = self.config.option_list['Metrics']['METRICS_ADDRESS']
+
+    def startServer(self, port_key):
+        """Start the metrics server in a thread.
+
+        port_keyで指定したconfig.ini のポート番号でHTTPサーバーを起動します。
+
+        Start the HTTP server on the port of port_key in the config.ini file.
+        """
+
+        if self.enabled is False:
+            return False
+
+        port = int(self.config.option_list['Metrics'][port_key])
+
+        try:
+            self.server = HTTPServer((self.address, port), cmMetricsHandler)
+        except OSError as e:
+            self.logger.error("metrics: Cannot start server:{0}:{1}:{2}".format(
+                self.address, port, e))
+            return False
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.logger.info("metrics: start server:{0}:{1}".format(self.address, port))
+
+        return True
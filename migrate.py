@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+"""Migrate the database to the latest schema.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+データベースのスキーマを最新のバージョンに更新します。
+スキーマのバージョンはsqliteの'PRAGMA user_version'に保存され、未適用の
+マイグレーションだけを順番に実行します。migrate.py は単独で動作する
+アプリケーションです。以下のように実行してください。
+
+$ python3 ./migrate.py
+
+setup_db.sh でデータベースを作成した場合は、--walを指定して自動的に実行されます。
+データの更新は一定の行数ごとにコミットするので、receiver.py を停止せずに
+実行できます。
+--walを指定すると、データベースをWALモードにします。(backup.py)
+
+Migrate the schema of the database to the latest version.
+The schema version is stored in 'PRAGMA user_version' of sqlite, and only
+the migrations not applied yet are executed in order.
+This application works standalone. you can run as follows.
+
+$ python3 ./migrate.py
+
+setup_db.sh runs it with --wal automatically when it creates the database.
+The data updates are committed every batch of rows, so you can run it
+without stopping receiver.py.
+--wal sets the database to the WAL mode. (backup.py)
+
+Version 1:
+    SENSORLOGS.RECEIVED_AT INTEGER: receive time of the packet
+        (epoch milliseconds), backfilled from CREATE_AT.
+    INDEX IDX_SENSORLOGS_RECEIVED_AT ON SENSORLOGS (ORIGINATOR_ID, RECEIVED_AT)
+
+Version 2:
+    TABLE WATERING_EVENTS: watering events detected by the register module.
+    INDEX IDX_WATERING_EVENTS_RECEIVED_AT ON WATERING_EVENTS (ORIGINATOR_ID, RECEIVED_AT)
+
+Version 3:
+    TABLE DEVICE_MODELS: lookup table of the device models.
+    TABLE SENSORLOGS: typed schema. The rows are copied to a new table in
+        batches, and the tables are swapped in a short transaction.
+        ORIGINATOR_ID INTEGER, DEVICE_MODEL_ID INTEGER, PAYLOAD BLOB (DB_0..DB_3),
+        TEMPERATURE/HUMIDITY REAL, NULL for the absent values, no CREATE_AT.
+    INDEX IDX_SENSORLOGS_RECEIVED_AT ON SENSORLOGS (ORIGINATOR_ID, RECEIVED_AT)
+    The file size is reduced after VACUUM: run "python3 ./migrate.py --vacuum"
+    while receiver.py is stopped.
+
+Version 4:
+    TABLE LINK_STATS: link quality of each device and gateway written by the
+        register module. (linkstats.py)
+
+Version 5:
+    TABLE LIVENESS_EVENTS: silent and alive events of the devices detected by
+        the register module. (liveness.py)
+    INDEX IDX_LIVENESS_EVENTS_RECEIVED_AT ON LIVENESS_EVENTS (ORIGINATOR_ID, RECEIVED_AT)
+
+Version 6:
+    TABLE ARCHIVE_BLOCKS: compressed blocks of the old SENSORLOGS rows moved
+        by archive.py. (archivestore.py)
+    INDEX IDX_ARCHIVE_BLOCKS_BEGIN_AT ON ARCHIVE_BLOCKS (ORIGINATOR_ID, BEGIN_AT)
+"""
+
+import sqlite3
+import argparse
+import binascii
+
+from config import cmConfig
+from logger import cmLogger
+
+
+class PlantTwitterMigration():
+
+    DATA_STORE_FILE = '/sensorlogs.db'
+
+    # number of rows updated in a transaction
+    MIGRATION_BATCH_ROWS = 10000
+
+    # device models of version 3: ID, DEVICE_MODEL
+    DEVICE_MODELS = ((1, 'STM431JS'), (2, 'STM431J'), (3, 'STM431JH'),
+                     (4, 'PTM210J'), (5, 'STM429J'))
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        self.db_file = config.option_list['DEFAULT'][
+            'DATA_FILE_PATH'] + self.DATA_STORE_FILE
+
+        # migration of each schema version
+        self.migrations = (
+            self.migrateVersion1,
+            self.migrateVersion2,
+            self.migrateVersion3,
+            self.migrateVersion4,
+            self.migrateVersion5,
+            self.migrateVersion6,
+        )
+
+    def getVersion(self, conn):
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def setVersion(self, conn, version):
+        conn.execute("PRAGMA user_version = {0:d}".format(version))
+        conn.commit()
+
+    def getColumns(self, conn, table):
+        return [r[1] for r in conn.execute("PRAGMA table_info({0})".format(table))]
+
+    def migrate(self):
+        """Execute the migrations not applied yet.
+
+        未適用のマイグレーションを実行します。
+
+        Execute the migrations not applied yet.
+        """
+
+        conn = sqlite3.connect(self.db_file)
+
+        try:
+            version = self.getVersion(conn)
+            self.logger.info("migrate: current version:{0}".format(version))
+
+            for v in range(version, len(self.migrations)):
+                self.logger.info("migrate: start version:{0}".format(v + 1))
+                self.migrations[v](conn)
+                self.setVersion(conn, v + 1)
+                self.logger.info("migrate: end version:{0}".format(v + 1))
+
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return False
+
+        finally:
+            conn.close()
+
+        return True
+
+    def migrateVersion1(self, conn):
+        """Add the receive time of epoch milliseconds.
+
+        受信時刻(エポックミリ秒)のRECEIVED_AT列を追加して、既存の行は
+        CREATE_ATから値を設定します。
+
+        Add RECEIVED_AT column of the receive time (epoch milliseconds), and
+        set it of the existing rows from CREATE_AT.
+        """
+
+        if 'RECEIVED_AT' not in self.getColumns(conn, 'SENSORLOGS'):
+            conn.execute("ALTER TABLE SENSORLOGS ADD COLUMN RECEIVED_AT INTEGER")
+            conn.commit()
+
+        # backfill: CREATE_AT is the localtime text.
+        sql = "UPDATE SENSORLOGS SET RECEIVED_AT = " + \
+            "CAST(STRFTIME('%s', CREATE_AT, 'utc') AS INTEGER) * 1000 " + \
+            "WHERE ID >= ? AND ID < ? AND RECEIVED_AT IS NULL"
+
+        (min_id, max_id) = conn.execute(
+            "SELECT MIN(ID), MAX(ID) FROM SENSORLOGS").fetchone()
+        if min_id is not None:
+            for begin_id in range(min_id, max_id + 1, self.MIGRATION_BATCH_ROWS):
+                cur = conn.execute(
+                    sql, (begin_id, begin_id + self.MIGRATION_BATCH_ROWS))
+                conn.commit()
+                self.logger.debug("migrate: backfill RECEIVED_AT:id={0} rows={1}".format(
+                    begin_id, cur.rowcount))
+
+        conn.execute("CREATE INDEX IF NOT EXISTS IDX_SENSORLOGS_RECEIVED_AT " +
+                     "ON SENSORLOGS (ORIGINATOR_ID, RECEIVED_AT)")
+        conn.commit()
+
+    def migrateVersion2(self, conn):
+        """Add the table of watering events.
+
+        水やりイベントの'WATERING_EVENTS'テーブルを追加します。
+
+        Add the 'WATERING_EVENTS' table of watering events.
+        """
+
+        conn.execute("CREATE TABLE IF NOT EXISTS WATERING_EVENTS (" +
+                     "ID INTEGER PRIMARY KEY AUTOINCREMENT, ORIGINATOR_ID TEXT, " +
+                     "SOIL_MOISTURE INTEGER, SOIL_MOISTURE_BEFORE INTEGER, " +
+                     "RECEIVED_AT INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS IDX_WATERING_EVENTS_RECEIVED_AT " +
+                     "ON WATERING_EVENTS (ORIGINATOR_ID, RECEIVED_AT)")
+        conn.commit()
+
+    def migrateVersion3(self, conn):
+        """Convert SENSORLOGS to the typed schema.
+
+        SENSORLOGSを型付きのスキーマに変換します。新しいテーブルに一定の行数ずつ
+        コピーして、最後に残りの行のコピーとテーブルの入れ替えを一つの短い
+        トランザクションで行います。途中で中断しても、再実行するとコピー済みの
+        行の続きから再開します。
+
+        Convert SENSORLOGS to the typed schema. The rows are copied to a new
+        table in batches, and at last the remaining rows are copied and the
+        tables are swapped in a short transaction. If it is interrupted, it
+        resumes after the copied rows when executed again.
+        """
+
+        conn.create_function('PT_ORIGINATOR_ID', 1, self.toOriginatorID)
+        conn.create_function('PT_PAYLOAD', 4, self.toPayload)
+
+        conn.execute("CREATE TABLE IF NOT EXISTS DEVICE_MODELS (" +
+                     "ID INTEGER PRIMARY KEY, DEVICE_MODEL TEXT UNIQUE NOT NULL)")
+        conn.executemany("INSERT OR IGNORE INTO DEVICE_MODELS (ID, DEVICE_MODEL) " +
+                         "VALUES (?, ?)", self.DEVICE_MODELS)
+        conn.execute("INSERT OR IGNORE INTO DEVICE_MODELS (DEVICE_MODEL) " +
+                     "SELECT DISTINCT DEVICE_MODEL FROM SENSORLOGS " +
+                     "WHERE DEVICE_MODEL IS NOT NULL")
+        conn.execute("CREATE TABLE IF NOT EXISTS SENSORLOGS_TYPED (" +
+                     "ID INTEGER PRIMARY KEY AUTOINCREMENT, ORIGINATOR_ID INTEGER, " +
+                     "DEVICE_MODEL_ID INTEGER, TELEGRAM_TYPE TEXT, PAYLOAD BLOB, " +
+                     "DBM INTEGER, TEMPERATURE REAL, SOIL_MOISTURE INTEGER, " +
+                     "HUMIDITY REAL, CONTACT_SWITCH TEXT, ROCKER_SWITCH TEXT, " +
+                     "RECEIVED_AT INTEGER)")
+        conn.commit()
+
+        sql = "INSERT INTO SENSORLOGS_TYPED (ID, ORIGINATOR_ID, DEVICE_MODEL_ID, " + \
+            "TELEGRAM_TYPE, PAYLOAD, DBM, TEMPERATURE, SOIL_MOISTURE, HUMIDITY, " + \
+            "CONTACT_SWITCH, ROCKER_SWITCH, RECEIVED_AT) " + \
+            "SELECT S.ID, PT_ORIGINATOR_ID(S.ORIGINATOR_ID), M.ID, " + \
+            "NULLIF(S.TELEGRAM_TYPE, ''), PT_PAYLOAD(S.DB_0, S.DB_1, S.DB_2, S.DB_3), " + \
+            "NULLIF(S.DBM, ''), NULLIF(S.TEMPERATURE, ''), NULLIF(S.SOIL_MOISTURE, ''), " + \
+            "NULLIF(S.HUMIDITY, ''), NULLIF(S.CONTACT_SWITCH, ''), " + \
+            "NULLIF(S.ROCKER_SWITCH, ''), COALESCE(S.RECEIVED_AT, " + \
+            "CAST(STRFTIME('%s', S.CREATE_AT, 'utc') AS INTEGER) * 1000) " + \
+            "FROM SENSORLOGS S LEFT JOIN DEVICE_MODELS M ON M.DEVICE_MODEL = S.DEVICE_MODEL " + \
+            "WHERE S.ID > ? ORDER BY S.ID LIMIT ?"
+
+        # copy in batches: the receiver keeps inserting to SENSORLOGS.
+        while True:
+            last_id = conn.execute(
+                "SELECT COALESCE(MAX(ID), 0) FROM SENSORLOGS_TYPED").fetchone()[0]
+            cur = conn.execute(sql, (last_id, self.MIGRATION_BATCH_ROWS))
+            conn.commit()
+            self.logger.debug("migrate: copy SENSORLOGS:id={0} rows={1}".format(
+                last_id, cur.rowcount))
+            if cur.rowcount < self.MIGRATION_BATCH_ROWS:
+                break
+
+        # copy the rest, and swap the tables.
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = conn.execute(
+            "SELECT COALESCE(MAX(ID), 0) FROM SENSORLOGS_TYPED").fetchone()[0]
+        conn.execute(sql, (last_id, -1))
+        conn.execute("DROP TABLE SENSORLOGS")
+        conn.execute("ALTER TABLE SENSORLOGS_TYPED RENAME TO SENSORLOGS")
+        conn.execute("CREATE INDEX IDX_SENSORLOGS_RECEIVED_AT " +
+                     "ON SENSORLOGS (ORIGINATOR_ID, RECEIVED_AT)")
+        conn.execute("PRAGMA user_version = 3")
+        conn.commit()
+
+    def migrateVersion4(self, conn):
+        """Add the table of the link statistics.
+
+        デバイスとゲートウェイ毎の電波の品質の'LINK_STATS'テーブルを追加します。
+
+        Add the 'LINK_STATS' table of the link quality of each device and gateway.
+        """
+
+        conn.execute("CREATE TABLE IF NOT EXISTS LINK_STATS (" +
+                     "ORIGINATOR_ID TEXT, GATEWAY TEXT, FRAMES INTEGER, " +
+                     "DBM_MIN INTEGER, DBM_AVG REAL, DBM_MAX INTEGER, DBM_P10 INTEGER, " +
+                     "DBM_P50 INTEGER, DBM_P90 INTEGER, SUB_TELEGRAMS_AVG REAL, " +
+                     "INTERVAL INTEGER, EXPECTED_FRAMES INTEGER, LOSS REAL, " +
+                     "FRAMES_TOTAL INTEGER, SUB_TELEGRAMS_TOTAL INTEGER, " +
+                     "BEGIN_AT INTEGER, RECEIVED_AT INTEGER, " +
+                     "PRIMARY KEY (ORIGINATOR_ID, GATEWAY))")
+        conn.commit()
+
+    def migrateVersion5(self, conn):
+        """Add the table of the liveness events.
+
+        デバイスの'silent', 'alive'イベントの'LIVENESS_EVENTS'テーブルを追加します。
+
+        Add the 'LIVENESS_EVENTS' table of the silent and alive events of the devices.
+        """
+
+        conn.execute("CREATE TABLE IF NOT EXISTS LIVENESS_EVENTS (" +
+                     "ID INTEGER PRIMARY KEY AUTOINCREMENT, ORIGINATOR_ID TEXT, " +
+                     "EVENT TEXT, LAST_RECEIVED_AT INTEGER, TIMEOUT INTEGER, " +
+                     "RECEIVED_AT INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS IDX_LIVENESS_EVENTS_RECEIVED_AT " +
+                     "ON LIVENESS_EVENTS (ORIGINATOR_ID, RECEIVED_AT)")
+        conn.commit()
+
+    def migrateVersion6(self, conn):
+        """Add the table of the archived blocks.
+
+        古いセンサーデータを圧縮したブロックの'ARCHIVE_BLOCKS'テーブルを追加します。
+
+        Add the 'ARCHIVE_BLOCKS' table of the compressed blocks of the old sensor data.
+        """
+
+        conn.execute("CREATE TABLE IF NOT EXISTS ARCHIVE_BLOCKS (" +
+                     "ID INTEGER PRIMARY KEY AUTOINCREMENT, ORIGINATOR_ID TEXT, " +
+                     "DEVICE_MODEL TEXT, MONTH TEXT, ROWS INTEGER, " +
+                     "BEGIN_AT INTEGER, END_AT INTEGER, DATA BLOB)")
+        conn.execute("CREATE INDEX IF NOT EXISTS IDX_ARCHIVE_BLOCKS_BEGIN_AT " +
+                     "ON ARCHIVE_BLOCKS (ORIGINATOR_ID, BEGIN_AT)")
+        conn.commit()
+
+    def toOriginatorID(self, originator_id):
+        # hex text or bytes to integer
+        try:
+            return int(originator_id, 16)
+        except (TypeError, ValueError):
+            return None
+
+    def toPayload(self, *data_dl):
+        # hex text or bytes of DB_0..DB_3 to the raw bytes
+        try:
+            payload = b''.join(binascii.unhexlify(d) for d in data_dl
+                               if d is not None and d != '')
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        return payload if payload else None
+
+    def vacuum(self):
+        """Rebuild the database file to reduce its size.
+
+        データベースファイルを再構築して、サイズを小さくします。
+        実行中はデータベースがロックされるので、receiver.py を停止して
+        実行してください。
+
+        Rebuild the database file to reduce its size.
+        The database is locked while it runs, so stop receiver.py.
+        """
+
+        conn = sqlite3.connect(self.db_file)
+
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return False
+
+        finally:
+            conn.close()
+
+        return True
+
+    def setWalMode(self):
+        """Set the database to the WAL mode.
+
+        データベースをWALモードにします。(設定はファイルに保存されます)
+        読み込み(backup.py など)と書き込みが互いに待たなくなります。
+
+        Set the database to the WAL mode. (The mode is saved in the file)
+        The readers (backup.py and others) and the writer do not wait for
+        each other.
+        """
+
+        conn = sqlite3.connect(self.db_file)
+
+        try:
+            journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return False
+
+        finally:
+            conn.close()
+
+        self.logger.info("migrate: journal mode:{0}".format(journal_mode))
+        return journal_mode == 'wal'
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Migrate the database.')
+    arg_parser.add_argument('--vacuum', action='store_true',
+                            help='rebuild the database file after the migration')
+    arg_parser.add_argument('--wal', action='store_true',
+                            help='set the database to the WAL mode after the migration')
+    args = arg_parser.parse_args()
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.debug("--- start: {0} ----".format(__file__))
+
+    eo_migration = PlantTwitterMigration(logger)
+    if eo_migration.migrate():
+        logger.info("migrate result: Success")
+    else:
+        logger.error("migrate result: Failure")
+
+    if args.vacuum:
+        if eo_migration.vacuum():
+            logger.info("vacuum result: Success")
+        else:
+            logger.error("vacuum result: Failure")
+
+    if args.wal:
+        if eo_migration.setWalMode():
+            logger.info("wal result: Success")
+        else:
+            logger.error("wal result: Failure")
+
+    logger.debug("--- end: {0} ----".format(__file__))
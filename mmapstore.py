@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+"""Memory-mapped time-series storage of the sensor data.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+センサーデータをデバイス毎の追記専用ファイルに固定長レコードで保存する
+ストレージです。config.ini のDATA_STORE_BACKENDを'mmap'にすると、
+PlantTwitterDatastoreのセンサーデータの読み書きにこのストレージを使用します。
+ファイルはDATA_FILE_PATHのtimeseriesディレクトリに、{originator id}.dat の
+名前で作成されます。
+期間の読み込みはファイルをmmapで読み込み、受信時刻を二分探索します。
+レコードは受信順に追記されるので、受信時刻は単調増加であることを前提と
+しています。(システム時刻を戻した場合は、範囲検索の結果が不正確になります)
+行ID(ROW_INDEX_ID)は全デバイスのファイルで通しの番号で、レコードに保存します。
+書き込みは1つのプロセス(receiver.py)だけで、開始時の全レコード数から続けて
+番号を付けます。行IDを保存する前のレコード(0)は、ファイル内の位置+1です。
+
+Storage of the sensor data in an append-only file of fixed-size records for
+each device. If DATA_STORE_BACKEND of the config.ini file is 'mmap',
+PlantTwitterDatastore reads and writes the sensor data in this storage.
+The files are created as {originator id}.dat in the timeseries directory of
+DATA_FILE_PATH.
+Time ranges are read by mapping the file with mmap and a binary search on
+the receive time. The records are appended in the receive order, so the
+receive time is assumed to be non-decreasing. (If the system clock goes
+back, the range reads may be inaccurate.)
+The row ID (ROW_INDEX_ID) is a number through the files of all devices, and
+is stored in the record. Only a process (receiver.py) writes, and numbers the
+records on from the total records at the start. A record written before the
+row ID was stored (0) has the index in the file + 1.
+
+File header (32 bytes):
+    magic b'PTTS1\\0\\0\\0', device model 16 bytes, reserved 8 bytes
+Record (40 bytes, little endian):
+    RECEIVED_AT int64, payload DB_0..DB_3 4 bytes, payload length uint8,
+    telegram type uint8, DBM int16, TEMPERATURE float64 (NaN: none),
+    HUMIDITY float64 (NaN: none), SOIL_MOISTURE int16 (-1: none),
+    ID uint32 (0: none), pad 2 bytes
+CONTACT_SWITCH and ROCKER_SWITCH are decoded from the payload when read.
+"""
+
+import os
+import mmap
+import math
+import time
+import struct
+import binascii
+
+from config import cmConfig
+from logger import cmLogger
+from clock import PlantTwitterClock
+from profile import EnOceanEquipmentProfile_D5_00_01
+from profile import EnOceanEquipmentProfile_F6_02_04
+
+
+class PlantTwitterMmapStore():
+
+    DATA_STORE_DIRECTORY = '/timeseries'
+
+    FILE_HEADER = struct.Struct('<8s16s8x')
+    FILE_MAGIC = b'PTTS1\0\0\0'
+
+    RECORD = struct.Struct('<q4sBBhddhI2x')
+    RECORD_TIME = struct.Struct('<q')
+
+    TELEGRAM_TYPES = ('RPS', '1BS', '4BS')
+    TELEGRAM_TYPE_UNKNOWN = 255
+
+    def __init__(self, logger, clock=None):
+        self.logger = logger
+        self.clock = PlantTwitterClock() if clock is None else clock
+
+        config = cmConfig()
+        self.data_path = config.option_list['DEFAULT'][
+            'DATA_FILE_PATH'] + self.DATA_STORE_DIRECTORY
+
+        # originator id -> file object for append
+        self.writers = {}
+        # originator id -> (file object, mmap, size)
+        self.readers = {}
+        # the row ID of the last record written, or None before the first
+        self.last_id = None
+
+    def openConnection(self, conn=None):
+        # conn: the connection of PlantTwitterDatastore, not used.
+        if os.path.isdir(self.data_path) is False:
+            os.makedirs(self.data_path)
+
+    def closeConnection(self):
+        for f in self.writers.values():
+            f.close()
+        self.writers = {}
+        for (f, m, size) in self.readers.values():
+            if m is not None:
+                m.close()
+            f.close()
+        self.readers = {}
+
+    def getFileName(self, originator_id):
+        if isinstance(originator_id, bytes):
+            originator_id = originator_id.decode('utf-8')
+        return "{0}/{1}.dat".format(self.data_path, originator_id.lower())
+
+    def getOriginatorIDs(self):
+        if os.path.isdir(self.data_path) is False:
+            return []
+        return sorted(f[:-4].encode('utf-8') for f in os.listdir(self.data_path)
+                      if f.endswith('.dat'))
+
+    def insertRecord(self, *values):
+        (originator_id, device_model, telegram_type, db_0, db_1, db_2, db_3, dbm,
+         temperature, soil_moisture, humidity, contact, rocker, received_at) = values
+
+        payload = b''.join(binascii.unhexlify(d) for d in (db_0, db_1, db_2, db_3) if d != '')
+
+        if telegram_type in self.TELEGRAM_TYPES:
+            type_code = self.TELEGRAM_TYPES.index(telegram_type)
+        else:
+            type_code = self.TELEGRAM_TYPE_UNKNOWN
+
+        if self.last_id is None:
+            self.last_id = self.selectLastID()
+
+        record = self.RECORD.pack(
+            received_at, payload, len(payload), type_code, dbm,
+            float('nan') if temperature == '' else temperature,
+            float('nan') if humidity == '' else humidity,
+            -1 if soil_moisture == '' else soil_moisture, self.last_id + 1)
+
+        f = self.writers.get(originator_id)
+        if f is None:
+            file_name = self.getFileName(originator_id)
+            f = open(file_name, 'ab')
+            if f.tell() == 0:
+                f.write(self.FILE_HEADER.pack(
+                    self.FILE_MAGIC, device_model.encode('utf-8')))
+            self.writers[originator_id] = f
+
+        f.write(record)
+        f.flush()
+        self.last_id += 1
+
+        return True
+
+    def insertRecords(self, values_list):
+        for values in values_list:
+            self.insertRecord(*values)
+        return True
+
+    def getMap(self, originator_id):
+        """Return (mmap, device model, records) of the device file.
+
+        デバイスのファイルのmmap、デバイスモデル、レコード数を返します。
+        ファイルが追記されていた場合はmmapを作り直します。
+
+        Return (mmap, device model, records) of the device file.
+        If the file was appended, the mmap is created again.
+        """
+
+        file_name = self.getFileName(originator_id)
+        if os.path.exists(file_name) is False:
+            return (None, '', 0)
+
+        size = os.path.getsize(file_name)
+        reader = self.readers.get(originator_id)
+        if reader is None or reader[2] != size:
+            if reader is not None:
+                if reader[1] is not None:
+                    reader[1].close()
+                reader[0].close()
+            f = open(file_name, 'rb')
+            m = None
+            if size > 0:
+                m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            reader = (f, m, size)
+            self.readers[originator_id] = reader
+
+        m = reader[1]
+        if m is None or size < self.FILE_HEADER.size:
+            return (None, '', 0)
+
+        (magic, device_model) = self.FILE_HEADER.unpack_from(m, 0)
+        records = (size - self.FILE_HEADER.size) // self.RECORD.size
+
+        return (m, device_model.rstrip(b'\0').decode('utf-8'), records)
+
+    def getReceivedAt(self, m, index):
+        return self.RECORD_TIME.unpack_from(
+            m, self.FILE_HEADER.size + index * self.RECORD.size)[0]
+
+    def searchRecord(self, m, records, received_at):
+        # the first index of the record received at received_at or later
+        low = 0
+        high = records
+        while low < high:
+            middle = (low + high) // 2
+            if self.getReceivedAt(m, middle) < received_at:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def readRecord(self, m, originator_id, device_model, index):
+        (received_at, payload, payload_length, type_code, dbm, temperature,
+         humidity, soil_moisture, row_id) = self.RECORD.unpack_from(
+            m, self.FILE_HEADER.size + index * self.RECORD.size)
+
+        data_dl = [binascii.hexlify(payload[i:i + 1]) for i in range(payload_length)]
+        data_dl += [''] * (4 - payload_length)
+
+        contact = ''
+        rocker = ''
+        if payload_length > 0 and device_model == 'STM429J':
+            if payload[0] == EnOceanEquipmentProfile_D5_00_01.EEP_CONTACT_VALUE_OPEN:
+                contact = 'open'
+            else:
+                contact = 'closed'
+        elif payload_length > 0 and device_model == 'PTM210J':
+            rocker = ','.join(name for name, bits in (
+                ('BI', EnOceanEquipmentProfile_F6_02_04.EEP_ROCKER_BI_PRESSED),
+                ('BO', EnOceanEquipmentProfile_F6_02_04.EEP_ROCKER_BO_PRESSED),
+                ('AI', EnOceanEquipmentProfile_F6_02_04.EEP_ROCKER_AI_PRESSED),
+                ('AO', EnOceanEquipmentProfile_F6_02_04.EEP_ROCKER_AO_PRESSED))
+                if (payload[0] & bits) == bits)
+
+        if type_code < len(self.TELEGRAM_TYPES):
+            telegram_type = self.TELEGRAM_TYPES[type_code]
+        else:
+            telegram_type = ''
+
+        create_at = time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(received_at // 1000))
+
+        return (originator_id, device_model, telegram_type,
+                data_dl[0], data_dl[1], data_dl[2], data_dl[3], dbm,
+                '' if math.isnan(temperature) else temperature,
+                '' if soil_moisture < 0 else soil_moisture,
+                '' if math.isnan(humidity) else humidity,
+                contact, rocker, create_at, received_at, row_id or index + 1)
+
+    def selectRecord(self, originator_id, device_model, rowcount=60):
+        begin_at = int(self.clock.time() * 1000) - 60 * 60 * 1000
+        originator_id = self.toOriginatorID(originator_id)
+
+        (m, file_model, records) = self.getMap(originator_id)
+        if m is None or file_model != device_model:
+            return []
+
+        begin = max(self.searchRecord(m, records, begin_at + 1), records - rowcount)
+
+        return [self.readRecord(m, originator_id, file_model, i)
+                for i in range(records - 1, begin - 1, -1)]
+
+    def selectRecordsAfter(self, originator_id, device_model, last_id, rowcount=60):
+        begin_at = int(self.clock.time() * 1000) - 60 * 60 * 1000
+        originator_id = self.toOriginatorID(originator_id)
+
+        (m, file_model, records) = self.getMap(originator_id)
+        if m is None or file_model != device_model:
+            return []
+
+        begin = max(self.searchRecord(m, records, begin_at + 1), records - rowcount)
+
+        # the row IDs increase in the file.
+        rows = []
+        for i in range(records - 1, begin - 1, -1):
+            r = self.readRecord(m, originator_id, file_model, i)
+            if r[-1] <= last_id:
+                break
+            rows.append(r)
+        return rows
+
+    def selectRecentRecords(self, devices, last_id=0, rowcount=60):
+        return dict((originator_id, self.selectRecordsAfter(
+            originator_id, device_model, last_id, rowcount))
+            for (originator_id, device_model) in devices)
+
+    def selectLatestRecord(self, originator_id):
+        originator_id = self.toOriginatorID(originator_id)
+
+        (m, device_model, records) = self.getMap(originator_id)
+        if m is None or records == 0:
+            return None
+
+        return self.readRecord(m, originator_id, device_model, records - 1)
+
+    def iterRecords(self, originator_id=None, begin_at=0, end_at=None, chunk_rows=1000,
+                    archived=True):
+        # no archive: archived is not used.
+        if end_at is None:
+            end_at = int(self.clock.time() * 1000) + 1
+
+        if originator_id is None:
+            originator_ids = self.getOriginatorIDs()
+        else:
+            originator_ids = [self.toOriginatorID(originator_id)]
+
+        for o_id in originator_ids:
+            (m, device_model, records) = self.getMap(o_id)
+            if m is None:
+                continue
+
+            begin = self.searchRecord(m, records, begin_at)
+            end = self.searchRecord(m, records, end_at)
+            for i in range(begin, end):
+                yield self.readRecord(m, o_id, device_model, i)
+
+    def iterColumns(self, originator_id, begin_at, end_at, chunk_rows):
+        (m, device_model, records) = self.getMap(self.toOriginatorID(originator_id))
+        if m is None:
+            return
+
+        begin = self.searchRecord(m, records, begin_at)
+        end = self.searchRecord(m, records, end_at)
+        for chunk_begin in range(begin, end, chunk_rows):
+            offset = self.FILE_HEADER.size + chunk_begin * self.RECORD.size
+            chunk_end = min(chunk_begin + chunk_rows, end)
+            columns = ([], [], [], [], [])
+            for (received_at, payload, length, type_code, dbm, temperature,
+                 humidity, soil_moisture, row_id) in self.RECORD.iter_unpack(
+                    m[offset:offset + (chunk_end - chunk_begin) * self.RECORD.size]):
+                columns[0].append(received_at)
+                columns[1].append(dbm)
+                columns[2].append(None if math.isnan(temperature) else temperature)
+                columns[3].append(None if math.isnan(humidity) else humidity)
+                columns[4].append(None if soil_moisture < 0 else soil_moisture)
+            yield columns
+
+    def toOriginatorID(self, originator_id):
+        if isinstance(originator_id, str):
+            return originator_id.encode('utf-8')
+        return originator_id
+
+    def selectDownsampledRecords(self, originator_id, begin_at, end_at, step):
+        originator_id = self.toOriginatorID(originator_id)
+
+        (m, device_model, records) = self.getMap(originator_id)
+        if m is None:
+            return []
+
+        downsampled = []
+        sums = None
+        for i in range(self.searchRecord(m, records, begin_at),
+                       self.searchRecord(m, records, end_at)):
+            (received_at, payload, payload_length, type_code, dbm, temperature,
+             humidity, soil_moisture, row_id) = self.RECORD.unpack_from(
+                m, self.FILE_HEADER.size + i * self.RECORD.size)
+
+            step_at = (received_at // step) * step
+            if sums is None or sums[0] != step_at:
+                if sums is not None:
+                    downsampled.append(self.toAverages(sums))
+                # begin time, rows, [sum, count] of dBm, temperature, soil moisture, humidity
+                sums = [step_at, 0, [0, 0], [0, 0], [0, 0], [0, 0]]
+
+            sums[1] += 1
+            for values, v, valid in ((sums[2], dbm, True),
+                                     (sums[3], temperature, not math.isnan(temperature)),
+                                     (sums[4], soil_moisture, soil_moisture >= 0),
+                                     (sums[5], humidity, not math.isnan(humidity))):
+                if valid:
+                    values[0] += v
+                    values[1] += 1
+
+        if sums is not None:
+            downsampled.append(self.toAverages(sums))
+
+        return downsampled
+
+    def toAverages(self, sums):
+        return (sums[0], sums[1]) + tuple(
+            s / c if c > 0 else None for s, c in sums[2:])
+
+    def selectLastID(self):
+        # total records of all devices: the last row ID.
+        total = 0
+        for originator_id in self.getOriginatorIDs():
+            size = os.path.getsize(self.getFileName(originator_id))
+            total += max(size - self.FILE_HEADER.size, 0) // self.RECORD.size
+        return total
+
+    def getDataVersion(self):
+        # changed when a record is appended.
+        return self.selectLastID()
+
+    def hasArchive(self):
+        return False
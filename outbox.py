@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""Durable outbox of tweet messages.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+ツイートするメッセージをデータベースの'OUTBOX'テーブルに保存します。
+メッセージは冪等キー(IDEMPOTENCY_KEY)で一意になるため、同じメッセージを
+二重に登録することはありません。送信はtweetモジュールのdeliverMessages()が
+バックグラウンドで行い、失敗したメッセージは指数バックオフで再送します。
+送信間隔はトークンバケット(PlantTwitterTokenBucket)でTwitter APIの制限内に
+抑えます。送信済みのメッセージはTWEET_OUTBOX_RETENTION_DAYS日後に削除します。
+
+Store the tweet messages in the 'OUTBOX' table of the database.
+A message is unique by its idempotency key, so the same message is never
+queued twice. deliverMessages() of the tweet module sends them in the
+background, and failed messages are retried with exponential backoff.
+The token bucket (PlantTwitterTokenBucket) keeps the sending rate within
+the limits of the Twitter API. The sent messages are deleted after
+TWEET_OUTBOX_RETENTION_DAYS days.
+
+OUTBOX:
+    ID INTEGER PRIMARY KEY AUTOINCREMENT
+    IDEMPOTENCY_KEY TEXT UNIQUE
+    MESSAGE TEXT
+    STATUS TEXT
+    ATTEMPTS INTEGER
+    NEXT_ATTEMPT_AT REAL
+    LAST_ERROR TEXT
+    CREATE_AT TIMESTAMP DEFAULT (DATETIME('now','localtime'))
+    SENT_AT TIMESTAMP
+"""
+
+import random
+import hashlib
+import sqlite3
+import threading
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+from clock import PlantTwitterClock
+
+
+class PlantTwitterOutbox():
+
+    DATA_STORE_FILE = '/sensorlogs.db'
+
+    STATUS_PENDING = 'PENDING'
+    STATUS_SENT = 'SENT'
+    STATUS_FAILED = 'FAILED'
+
+    ROW_INDEX_ID = 0
+    ROW_INDEX_IDEMPOTENCY_KEY = 1
+    ROW_INDEX_MESSAGE = 2
+    ROW_INDEX_ATTEMPTS = 3
+
+    SQL_CREATE_TABLE = "CREATE TABLE IF NOT EXISTS OUTBOX (" + \
+        "ID INTEGER PRIMARY KEY AUTOINCREMENT, " + \
+        "IDEMPOTENCY_KEY TEXT UNIQUE, MESSAGE TEXT, STATUS TEXT, " + \
+        "ATTEMPTS INTEGER DEFAULT 0, NEXT_ATTEMPT_AT REAL DEFAULT 0, " + \
+        "LAST_ERROR TEXT, " + \
+        "CREATE_AT TIMESTAMP DEFAULT (DATETIME('now','localtime')), " + \
+        "SENT_AT TIMESTAMP)"
+
+    def __init__(self, logger, clock=None):
+        self.logger = logger
+        self.conn = None
+        self.clock = PlantTwitterClock() if clock is None else clock
+
+        config = cmConfig()
+        self.db_file = config.option_list['DEFAULT'][
+            'DATA_FILE_PATH'] + self.DATA_STORE_FILE
+
+        self.retry_max = int(config.option_list['Twitter']['TWEET_RETRY_MAX'])
+        self.backoff = float(config.option_list[
+            'Twitter']['TWEET_RETRY_BACKOFF'])
+        self.backoff_max = float(config.option_list[
+            'Twitter']['TWEET_RETRY_BACKOFF_MAX'])
+        self.retention_days = int(config.option_list[
+            'Twitter']['TWEET_OUTBOX_RETENTION_DAYS'])
+
+        self.metric_enqueued = cmMetrics().counter(
+            'plant_twitter_tweets_enqueued_total', 'Messages queued in the outbox.')
+
+    def openConnection(self):
+        self.logger.debug(
+            "outbox: open connection:{0}".format(self.db_file))
+        self.conn = sqlite3.connect(self.db_file)
+        self.conn.execute(self.SQL_CREATE_TABLE)
+        self.conn.commit()
+
+    def closeConnection(self):
+        if isinstance(self.conn, sqlite3.Connection):
+            self.logger.debug(
+                "outbox: close connection:{0}".format(self.db_file))
+            self.conn.close()
+            self.conn = None
+
+    def createKey(self, *parts):
+        """Create an idempotency key from the message parts.
+
+        メッセージの構成要素から冪等キーを作成します。
+
+        Create an idempotency key from the message parts.
+        """
+        digest = hashlib.sha1()
+        for p in parts:
+            digest.update(str(p).encode('utf-8'))
+            digest.update(b'\x00')
+        return digest.hexdigest()
+
+    def enqueueMessage(self, message, key=None):
+        if key is None:
+            key = self.createKey(message)
+
+        sql = "INSERT OR IGNORE INTO OUTBOX (IDEMPOTENCY_KEY, MESSAGE, " + \
+            "STATUS, ATTEMPTS, NEXT_ATTEMPT_AT) VALUES (?, ?, ?, 0, ?)"
+
+        try:
+            cur = self.conn.execute(
+                sql, (key, message, self.STATUS_PENDING, self.clock.time()))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return False
+
+        if cur.rowcount == 0:
+            self.logger.info("outbox: duplicate message:key={0}".format(key))
+        else:
+            self.logger.info("outbox: enqueue message:key={0}".format(key))
+            self.metric_enqueued.inc()
+
+        return True
+
+    def selectDueMessages(self, now=None, rowcount=10):
+        if now is None:
+            now = self.clock.time()
+
+        sql = "SELECT ID, IDEMPOTENCY_KEY, MESSAGE, ATTEMPTS FROM OUTBOX " + \
+            "WHERE STATUS = ? AND NEXT_ATTEMPT_AT <= ? " + \
+            "ORDER BY NEXT_ATTEMPT_AT, ID LIMIT ?"
+
+        try:
+            rows = self.conn.execute(
+                sql, (self.STATUS_PENDING, now, rowcount)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+        return rows
+
+    def countPending(self):
+        sql = "SELECT COUNT(*) FROM OUTBOX WHERE STATUS = ?"
+        try:
+            return self.conn.execute(sql, (self.STATUS_PENDING,)).fetchone()[0]
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return 0
+
+    def markSent(self, message_id):
+        sql = "UPDATE OUTBOX SET STATUS = ?, ATTEMPTS = ATTEMPTS + 1, " + \
+            "LAST_ERROR = NULL, SENT_AT = DATETIME('now','localtime') " + \
+            "WHERE ID = ?"
+
+        try:
+            self.conn.execute(sql, (self.STATUS_SENT, message_id))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return False
+
+        return True
+
+    def pruneMessages(self):
+        """Delete the sent messages older than the retention.
+
+        送信からTWEET_OUTBOX_RETENTION_DAYS日を過ぎたメッセージを削除して、
+        削除した件数を返します。削除したメッセージの冪等キーは再び登録できます。
+
+        Delete the messages sent TWEET_OUTBOX_RETENTION_DAYS days ago or
+        before, and return the number of them. The idempotency keys of the
+        deleted messages can be queued again.
+        """
+        sql = "DELETE FROM OUTBOX WHERE STATUS = ? AND " + \
+            "SENT_AT < DATETIME('now','localtime',?)"
+
+        try:
+            cur = self.conn.execute(
+                sql, (self.STATUS_SENT, '-{0} days'.format(self.retention_days)))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return 0
+
+        if cur.rowcount > 0:
+            self.logger.info("outbox: prune messages:{0}".format(cur.rowcount))
+
+        return cur.rowcount
+
+    def markRetry(self, message_id, attempts, error, retry_after=0):
+        """Schedule the next attempt of a failed message.
+
+        送信に失敗したメッセージの再送時刻を指数バックオフで設定します。
+        再送回数がTWEET_RETRY_MAXを超えた場合は'FAILED'にします。
+
+        Schedule the next attempt of a failed message with exponential backoff.
+        If the attempts exceed TWEET_RETRY_MAX, the message is marked 'FAILED'.
+        """
+        attempts += 1
+
+        if attempts >= self.retry_max:
+            status = self.STATUS_FAILED
+            next_attempt_at = 0
+            self.logger.error("outbox: give up message:id={0} attempts={1}".format(
+                message_id, attempts))
+        else:
+            status = self.STATUS_PENDING
+            delay = min(self.backoff * (2 ** (attempts - 1)), self.backoff_max)
+            delay = max(delay * random.uniform(0.5, 1.0), retry_after)
+            next_attempt_at = self.clock.time() + delay
+            self.logger.info("outbox: retry message:id={0} attempts={1} delay={2:.1f}".format(
+                message_id, attempts, delay))
+
+        sql = "UPDATE OUTBOX SET STATUS = ?, ATTEMPTS = ?, " + \
+            "NEXT_ATTEMPT_AT = ?, LAST_ERROR = ? WHERE ID = ?"
+
+        try:
+            self.conn.execute(sql, (status, attempts, next_attempt_at,
+                                    str(error), message_id))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return False
+
+        return True
+
+
+class PlantTwitterTokenBucket():
+    """Token bucket of the tweet rate limit.
+
+    Twitter APIの送信制限(TWEET_RATE_LIMIT/TWEET_RATE_WINDOW秒)に合わせて
+    トークンを補充します。一度に送信できる数はTWEET_RATE_BURSTまでです。
+
+    Refill the tokens at the rate of the Twitter API limit
+    (TWEET_RATE_LIMIT per TWEET_RATE_WINDOW seconds).
+    At most TWEET_RATE_BURST messages are sent at once.
+    """
+
+    def __init__(self, rate, capacity, clock=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = PlantTwitterClock() if clock is None else clock
+        self.updated_at = self.clock.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Take tokens, and return the seconds to wait if not available.
+
+        トークンを取得します。足りない場合は待ち時間(秒)を返します。
+
+        Take tokens, and return the seconds to wait if not available.
+        """
+        with self.lock:
+            now = self.clock.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+
+            return (tokens - self.tokens) / self.rate
@@ -42,6 +42,7 @@ import binascii
 import struct
 
 from logger import cmLogger
+from metrics import cmMetrics
 
 
 class EnOceanTelegramParser():
@@ -120,6 +121,13 @@ class EnOceanTelegramParser():
     def getDbm(self):
         return self.optional_dbm
 
+    def getSubTelNum(self):
+        return self.optional_subtelnum
+
+    def countCRCError(self, crc):
+        cmMetrics().counter('plant_twitter_crc_errors_total',
+                            'Packets with CRC8 check error.', {'crc': crc}).inc()
+
     def parseTelegramData(self, packet_data):
         self.packet_data = packet_data
         packet_offset = 0
@@ -177,6 +185,7 @@ class EnOceanTelegramParser():
         self.logger.debug("ESP3: crc8 header data:{0}".format(d_data))
         if calc_crc8.calcCRC8(d_data, self.header_crc8h) is not True:
             self.logger.error("ESP3: Invalid packet header CRC8 check error")
+            self.countCRCError('header')
             return False
 
         # check packet length
@@ -305,6 +314,7 @@ class EnOceanTelegramParser():
             self.logger.debug("ERP2: crc8 data:{0}".format(d_data))
             if calc_crc8.calcCRC8(d_data, self.data_crc8) is not True:
                 self.logger.error("ERP2: Invalid packet data CRC8 check error")
+                self.countCRCError('data')
                 return False
 
             # parse optional Data: Number of sub telegram
@@ -335,6 +345,7 @@ class EnOceanTelegramParser():
             if calc_crc8.calcCRC8(d_data, self.header_crc8d) is not True:
                 self.logger.error(
                     "ESP3: Invalid packet data and optonal data CRC8 check error")
+                self.countCRCError('optional')
                 return False
 
         else:
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""Sampling profiler and allocation tracing
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+動作中のアプリケーションのプロファイルを取得します。
+config.ini の[Profiler]でPROFILER_ENABLEDをTrueにするか、SIGUSR1シグナルを
+送ると開始します。もう一度SIGUSR1を送ると停止します。
+
+    $ kill -USR1 {receiver.py のプロセスID}
+
+PlantTwitterProfilerは以下の処理を行います。
+    - 全スレッドのスタックを一定間隔(PROFILER_SAMPLE_INTERVAL)で取得して、
+      フレームグラフ用のcollapsed stacks形式で profile.collapsed に出力します。
+    - PROFILER_TRACEMALLOCがTrueの場合、tracemallocのスナップショットを
+      一定間隔(PROFILER_SNAPSHOT_INTERVAL)で取得して、前回との差分を
+      profile_tracemalloc.log に出力します。
+受信処理の各段階(framing, parsing, decoding, commit)の処理時間は、常に
+metricsモジュールのplant_twitter_stage_secondsに集計されます。
+スタックの取得は別スレッドで行い、間隔のデフォルトは50ミリ秒なので、
+Raspberry Piで常時動作させても負荷はわずかです。
+
+Profile the running application.
+Set PROFILER_ENABLED in the [Profiler] section of the config.ini file to
+True, or send the SIGUSR1 signal to start it. Send SIGUSR1 again to stop it.
+
+    $ kill -USR1 {process id of receiver.py}
+
+PlantTwitterProfiler does the following.
+    - Sample the stacks of all threads every PROFILER_SAMPLE_INTERVAL, and
+      write them to profile.collapsed in the collapsed stacks format for
+      flamegraphs.
+    - If PROFILER_TRACEMALLOC is True, take a tracemalloc snapshot every
+      PROFILER_SNAPSHOT_INTERVAL, and write the difference from the previous
+      one to profile_tracemalloc.log.
+The time of each receiving stage (framing, parsing, decoding, commit) is
+always collected in plant_twitter_stage_seconds of the metrics module.
+The stacks are sampled in a separate thread, every 50 milliseconds by
+default, so it can be left running on a Raspberry Pi.
+
+"""
+
+import os
+import sys
+import time
+import signal
+import threading
+import tracemalloc
+
+from config import cmConfig
+from logger import cmLogger
+
+
+class PlantTwitterProfiler():
+
+    PROFILER_COLLAPSED_FILE = '/profile.collapsed'
+    PROFILER_TRACEMALLOC_FILE = '/profile_tracemalloc.log'
+
+    # tracemalloc: number of frames of a traceback, number of lines written
+    TRACEMALLOC_FRAMES = 10
+    TRACEMALLOC_TOP_STATS = 20
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.enabled = self.config.option_list[
+            'Profiler']['PROFILER_ENABLED'] == 'True'
+        self.sample_interval = float(self.config.option_list[
+            'Profiler']['PROFILER_SAMPLE_INTERVAL'])
+        self.write_interval = float(self.config.option_list[
+            'Profiler']['PROFILER_WRITE_INTERVAL'])
+        self.use_tracemalloc = self.config.option_list[
+            'Profiler']['PROFILER_TRACEMALLOC'] == 'True'
+        self.snapshot_interval = float(self.config.option_list[
+            'Profiler']['PROFILER_SNAPSHOT_INTERVAL'])
+
+        data_path = self.config.option_list['DEFAULT']['DATA_FILE_PATH']
+        self.collapsed_file = data_path + self.PROFILER_COLLAPSED_FILE
+        self.tracemalloc_file = data_path + self.PROFILER_TRACEMALLOC_FILE
+
+        # collapsed stack -> samples
+        self.stacks = {}
+        self.running = False
+        self.thread = None
+        self.snapshot = None
+
+    def setup(self):
+        """Install the signal handler, and start if enabled in config.ini.
+
+        SIGUSR1のシグナルハンドラを設定して、config.ini で有効な場合は開始します。
+        メインスレッドから呼び出してください。
+
+        Install the signal handler of SIGUSR1, and start if enabled in the
+        config.ini file. Call it from the main thread.
+        """
+
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.handleSignal)
+
+        if self.enabled:
+            self.start()
+
+    def handleSignal(self, signum, frame):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.running:
+            return
+
+        # wait for the previous sampler to write the files.
+        if self.thread is not None:
+            self.thread.join()
+
+        self.logger.info("profiler: start:interval={0}".format(self.sample_interval))
+
+        self.stacks = {}
+        if self.use_tracemalloc:
+            tracemalloc.start(self.TRACEMALLOC_FRAMES)
+            self.snapshot = tracemalloc.take_snapshot()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.sampleStacks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.running is False:
+            return
+
+        self.logger.info("profiler: stop")
+
+        # the sampler thread writes the files when it ends.
+        self.running = False
+
+    def sampleStacks(self):
+        """Sample the stacks of all threads.
+
+        全スレッドのスタックを取得します。この関数は、スレッドとして起動されます。
+
+        Sample the stacks of all threads.
+        This function is called by thread object.
+        """
+
+        own_id = threading.get_ident()
+        now = time.monotonic()
+        next_write = now + self.write_interval
+        next_snapshot = now + self.snapshot_interval
+
+        while self.running:
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{0}:{1}".format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+            now = time.monotonic()
+            if now >= next_write:
+                self.writeStacks()
+                next_write = now + self.write_interval
+            if self.use_tracemalloc and now >= next_snapshot:
+                self.writeSnapshot()
+                next_snapshot = now + self.snapshot_interval
+
+            time.sleep(self.sample_interval)
+
+        self.writeStacks()
+        if self.use_tracemalloc:
+            self.writeSnapshot()
+            tracemalloc.stop()
+
+    def writeStacks(self):
+        # write to a temporary file, then replace it.
+        tmp_file = self.collapsed_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write("{0} {1}\n".format(stack, samples))
+        os.replace(tmp_file, self.collapsed_file)
+
+        self.logger.debug("profiler: write stacks:{0}".format(len(self.stacks)))
+
+    def writeSnapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self.snapshot, 'lineno')
+        self.snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        with open(self.tracemalloc_file, 'a') as f:
+            f.write("--- {0} current={1} peak={2}\n".format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), current, peak))
+            for stat in stats[:self.TRACEMALLOC_TOP_STATS]:
+                f.write("{0}\n".format(stat))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Shared in-memory state of the decoded sensor data.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+daemon.py で、register モジュールが登録したセンサーデータと水やりイベントを
+メモリに保持して、tweet モジュールと共有します。
+PlantTwitterReadingsはPlantTwitterDatastoreと同じselectRecord()と
+selectWateringEvent()を持つので、messageモジュールはデータベースの代わりに
+使用できます。デバイスの値は最初に参照したときにデータベースから読み込み、
+以後は登録時に追加されるので、データベースへの問い合わせは行いません。
+水やりイベントを登録すると、tweetモジュールを待機から起こします。(updated)
+現在時刻はmessageモジュールと同じPlantTwitterClockから取得します。
+
+Keep the sensor data and the watering events registered by the register
+module in memory, and share them with the tweet module in daemon.py.
+PlantTwitterReadings has selectRecord() and selectWateringEvent() same as
+PlantTwitterDatastore, so the message module can use it in place of the
+database. The values of a device are loaded from the database when first
+referred, and then added when they are registered, so the database is not
+queried.
+A registered watering event wakes up the tweet module. (updated)
+The current time is got from PlantTwitterClock same as the message module.
+"""
+
+import time
+import threading
+from collections import deque
+
+from config import cmConfig
+from logger import cmLogger
+from clock import PlantTwitterClock
+from datastore import PlantTwitterDatastore
+
+
+class PlantTwitterReadings():
+
+    # rows of a device: same as PlantTwitterDatastore.selectRecord()
+    READINGS_ROWS = 60
+    READINGS_MINUTES = 60
+
+    def __init__(self, logger, clock=None):
+        self.logger = logger
+        self.clock = PlantTwitterClock() if clock is None else clock
+
+        config = cmConfig()
+        self.watering_minutes = int(config.option_list['Message'][
+                                    'MESSAGE_CONDITION_WATERING_MINUTES'])
+
+        # originator id -> deque of the rows, the latest is the last.
+        self.records = {}
+        # originator id -> the latest watering event
+        self.watering_events = {}
+        # originator id -> PlantTwitterFrameTrace of the latest row
+        self.traces = {}
+
+        self.lock = threading.Lock()
+
+        # set when a watering event is registered
+        self.updated = threading.Event()
+
+    def pushRecord(self, values, trace=None):
+        """Add the registered values of PlantTwitterDatastore.insertRecord().
+
+        登録したinsertRecord()の値を追加します。読み込み前のデバイスは無視します。
+
+        Add the registered values of insertRecord().
+        The devices not loaded yet are ignored.
+        trace is PlantTwitterFrameTrace of the values, taken by popTrace().
+        """
+
+        received_at = values[PlantTwitterDatastore.VALUES_INDEX_RECEIVED_AT]
+        create_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(received_at // 1000))
+        row = values[:PlantTwitterDatastore.ROW_INDEX_CREATE_AT] + (create_at, received_at)
+
+        originator_id = self.toOriginatorID(values[PlantTwitterDatastore.ROW_INDEX_ORIGINATOR_ID])
+
+        with self.lock:
+            rows = self.records.get(originator_id)
+            if rows is None:
+                return
+            # the row may be loaded from the database already.
+            if rows and rows[-1][PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT] >= received_at:
+                return
+            rows.append(row)
+            if trace is not None:
+                self.traces[originator_id] = trace
+
+    def popTrace(self, originator_id):
+        # PlantTwitterFrameTrace of the latest row not tweeted yet, or None
+        originator_id = self.toOriginatorID(originator_id)
+        with self.lock:
+            return self.traces.pop(originator_id, None)
+
+    def pushWateringEvent(self, event):
+        # event: same as PlantTwitterDatastore.selectWateringEvent()
+        originator_id = self.toOriginatorID(
+            event[PlantTwitterDatastore.ROW_INDEX_WATERING_ORIGINATOR_ID])
+
+        with self.lock:
+            self.watering_events[originator_id] = event
+
+        self.updated.set()
+
+    def selectRecord(self, originator_id, device_model, rowcount=60):
+        originator_id = self.toOriginatorID(originator_id)
+        begin_at = int(self.clock.time() * 1000) - self.READINGS_MINUTES * 60 * 1000
+
+        with self.lock:
+            if originator_id not in self.records:
+                self.loadDevice(originator_id, device_model)
+
+            sensor_list = []
+            for r in reversed(self.records[originator_id]):
+                if len(sensor_list) >= rowcount or \
+                        r[PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT] <= begin_at:
+                    break
+                if r[PlantTwitterDatastore.ROW_INDEX_DEVICE_MODEL] == device_model:
+                    sensor_list.append(r)
+
+        return sensor_list
+
+    def selectWateringEvent(self, originator_id, minutes=30):
+        originator_id = self.toOriginatorID(originator_id)
+        begin_at = int(self.clock.time() * 1000) - minutes * 60 * 1000
+
+        with self.lock:
+            event = self.watering_events.get(originator_id)
+
+        if event is None or event[PlantTwitterDatastore.ROW_INDEX_WATERING_RECEIVED_AT] <= begin_at:
+            return None
+        return event
+
+    def selectWateringEventsAfter(self, received_at):
+        # same as PlantTwitterDatastore.selectWateringEventsAfter()
+        with self.lock:
+            events = [e for e in self.watering_events.values()
+                      if e[PlantTwitterDatastore.ROW_INDEX_WATERING_RECEIVED_AT] > received_at]
+        return sorted(events, key=lambda e: e[PlantTwitterDatastore.ROW_INDEX_WATERING_RECEIVED_AT])
+
+    def loadDevice(self, originator_id, device_model):
+        # called with the lock
+        data_store = PlantTwitterDatastore(self.logger, self.clock)
+        data_store.openConnection(read_only=True)
+
+        sensor_list = data_store.selectRecord(originator_id, device_model, self.READINGS_ROWS)
+        event = data_store.selectWateringEvent(originator_id, self.watering_minutes)
+
+        data_store.closeConnection()
+
+        self.records[originator_id] = deque(
+            [r[:PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT + 1] for r in reversed(sensor_list)],
+            maxlen=self.READINGS_ROWS)
+        if event is not None:
+            self.watering_events.setdefault(originator_id, event)
+
+        self.logger.debug("readings: load device:{0} rows={1}".format(
+            originator_id, len(sensor_list)))
+
+    def toOriginatorID(self, originator_id):
+        if isinstance(originator_id, str):
+            return originator_id.encode('utf-8')
+        return originator_id
@@ -33,12 +33,19 @@ import binascii
 import struct
 import time
 import threading
+import multiprocessing
 from queue import Queue
 
 from config import cmConfig
 from logger import cmLogger
 from register import PlantTwitterRegister
 from parse import EnOceanTelegramParser
+from metrics import cmMetrics
+from metrics import cmMetricsServer
+from profiler import PlantTwitterProfiler
+from spool import PlantTwitterSpool
+from latency import PlantTwitterFrameTrace
+from ring import PlantTwitterFrameRing
 
 
 class PlantTwitterReceiver():
@@ -48,12 +55,29 @@ class PlantTwitterReceiver():
 
         self.config = cmConfig()
 
-    def receivePacket(self, eo_queue):
+        metrics = cmMetrics()
+        self.metric_packets = metrics.counter(
+            'plant_twitter_packets_received_total', 'Received ESP3 packets.')
+        self.metric_bytes = metrics.counter(
+            'plant_twitter_serial_bytes_total', 'Bytes read from the serial port.')
+        self.metric_oversize = metrics.counter(
+            'plant_twitter_packets_oversize_total', 'Packets exceeded max packet length.')
+        self.metric_last_packet = metrics.gauge(
+            'plant_twitter_last_packet_timestamp_seconds', 'Receive time of the last packet.')
+        self.metric_framing = metrics.histogram(
+            'plant_twitter_stage_seconds', 'Time of each receiving stage.', {'stage': 'framing'})
+
+    def receivePacket(self, eo_queue, eo_spool=None):
         """Receive packet data via serial port.
 
         シリアルポートからパケットを受信します。
+        eo_spoolを指定した場合は、キューに入れる前にスプールに追記します。
+        eo_queueはQueueまたはPlantTwitterFrameRingです。(INGEST_MODE)
 
         Receive packet data via serial port.
+        If eo_spool is given, the packet is appended to the spool before it
+        is put in the queue.
+        eo_queue is a Queue or a PlantTwitterFrameRing. (INGEST_MODE)
         """
 
         # open serial port
@@ -72,6 +96,7 @@ class PlantTwitterReceiver():
 
         if eo_serial.isOpen():
             self.logger.info("opened serial port:{0}".format(serialport))
+            cmMetrics().setReady('receiver')
 
         # read packet
         p_dat = b''
@@ -79,6 +104,9 @@ class PlantTwitterReceiver():
         p_list = []
         p_list_offset = 0
         p_list_length = 0
+        p_received_at = 0
+        p_framing_at = 0
+        p_trace = None
         eo_parser = EnOceanTelegramParser(self.logger)
 
         while True:
@@ -89,12 +117,19 @@ class PlantTwitterReceiver():
             if p_dat == b'':
                 continue
 
+            self.metric_bytes.inc()
+
             # read sync packet b'55'
             if p_list_offset == 0:
                 if p_dat == eo_parser.ESP3_HEADER_SYNC_BYTE:
                     p_list.append(p_dat)
                     p_list_offset += 1
 
+                    # receive time: epoch milliseconds
+                    p_received_at = int(time.time() * 1000)
+                    p_framing_at = time.perf_counter()
+                    p_trace = PlantTwitterFrameTrace()
+
             # read data length
             elif p_list_offset == 1:
                 p_list.append(p_dat)
@@ -120,6 +155,7 @@ class PlantTwitterReceiver():
                 if p_list_length > eo_parser.ESP3_MAX_PACKET_SIZE:
                     self.logger.error(
                         "receive packet exceeded max packet length:{0}".format(p_list_length))
+                    self.metric_oversize.inc()
                     p_dat_pre = b''
                     p_list = []
                     p_list_offset = 0
@@ -133,7 +169,14 @@ class PlantTwitterReceiver():
             # set packet data to the thread queue
             elif p_list_offset >= (p_list_length - 1):
                 p_list.append(p_dat)
-                eo_queue.put(p_list)
+                p_trace.mark('framed')
+                p_sequence = None
+                if eo_spool is not None:
+                    p_sequence = eo_spool.appendFrame(p_list, p_received_at)
+                eo_queue.put((p_list, p_received_at, p_sequence, p_trace))
+                self.metric_packets.inc()
+                self.metric_framing.observe(time.perf_counter() - p_framing_at)
+                self.metric_last_packet.set(p_received_at / 1000)
                 self.logger.info("receive packet data:{0}".format(p_list))
                 p_dat_pre = b''
                 p_list = []
@@ -144,32 +187,115 @@ class PlantTwitterReceiver():
             time.sleep(0.0001)
 
 
+def registerProcess(logger, eo_ring, eo_spool):
+    """Register the frames from the ring buffer in the register process.
+
+    INGEST_MODEが'process'の場合に、受信プロセスからforkしたプロセスで
+    実行します。メトリクスはMETRICS_REGISTER_PORTで公開します。
+    スプールのチェックポイントは共有のmmapなので、受信プロセスと共有します。
+
+    Run in the process forked from the receiving process, if INGEST_MODE is
+    'process'. The metrics are served on METRICS_REGISTER_PORT.
+    The checkpoint of the spool is a shared mmap, so it is shared with the
+    receiving process.
+    """
+
+    logger.debug("--- start: register process ----")
+
+    eo_register = PlantTwitterRegister(logger)
+    cmMetricsServer(logger).startServer('METRICS_REGISTER_PORT')
+
+    try:
+        eo_register.registerPacket(eo_ring, eo_spool)
+    finally:
+        eo_ring.close()
+
+
 if __name__ == '__main__':
 
     # set logger handler
     logger = cmLogger().getLogger()
     logger.debug("--- start: {0} ----".format(__file__))
 
-    # recieve packet data queue
-    eo_queue = Queue()
-
     eo_receiver = PlantTwitterReceiver(logger)
-    eo_register = PlantTwitterRegister(logger)
-
-    # start thread data register
-    try:
-        logger.info("start thread: registerPacket")
-        eo_thread = threading.Thread(
-            target=eo_register.registerPacket, args=(eo_queue,))
-        eo_thread.setDaemon(True)
-        eo_thread.start()
-    except:
-        e_type, e_value, e_traceback = sys.exc_info()
-        logger.error("Exception serial reading.:{0}".format(
-            traceback.format_exception(e_type, e_value, e_traceback)))
+    ingest_mode = cmConfig().option_list['Ingest']['INGEST_MODE']
+
+    # the frames not registered before the restart
+    eo_spool = PlantTwitterSpool(logger)
+    eo_frames = []
+    if eo_spool.enabled:
+        eo_frames = eo_spool.openSpool()
+    else:
+        eo_spool = None
+
+    eo_process = None
+    if ingest_mode == 'process':
+        # recieve packet data ring buffer: fork before the threads start.
+        eo_queue = PlantTwitterFrameRing(logger)
+        try:
+            logger.info("start process: registerPacket")
+            eo_process = multiprocessing.get_context('fork').Process(
+                target=registerProcess, args=(logger, eo_queue, eo_spool), daemon=True)
+            eo_process.start()
+        except:
+            e_type, e_value, e_traceback = sys.exc_info()
+            logger.error("Exception register process.:{0}".format(
+                traceback.format_exception(e_type, e_value, e_traceback)))
+    else:
+        # recieve packet data queue
+        eo_queue = Queue()
+        cmMetrics().gauge('plant_twitter_queue_depth',
+                          'Packets waiting in the queue.').setFunction(eo_queue.qsize)
+
+    # start metrics server
+    cmMetricsServer(logger).startServer('METRICS_RECEIVER_PORT')
+
+    # setup profiler: config.ini or SIGUSR1
+    PlantTwitterProfiler(logger).setup()
+
+    # replay the frames not registered before the restart
+    for frame in eo_frames:
+        if ingest_mode == 'process':
+            eo_queue.put(frame, block=True)
+        else:
+            eo_queue.put(frame)
+
+    if ingest_mode != 'process':
+        # start thread data register
+        try:
+            eo_register = PlantTwitterRegister(logger)
+            logger.info("start thread: registerPacket")
+            eo_thread = threading.Thread(
+                target=eo_register.registerPacket, args=(eo_queue, eo_spool))
+            eo_thread.setDaemon(True)
+            eo_thread.start()
+        except:
+            e_type, e_value, e_traceback = sys.exc_info()
+            logger.error("Exception serial reading.:{0}".format(
+                traceback.format_exception(e_type, e_value, e_traceback)))
 
     # start receiver packet
     logger.info("start: receivePacket")
-    eo_receiver.receivePacket(eo_queue)
+    try:
+        if ingest_mode == 'process':
+            # without the register process, the ring drops every frame: stop the
+            # receiver, and the spool replays the frames after the restart.
+            eo_thread = threading.Thread(
+                target=eo_receiver.receivePacket, args=(eo_queue, eo_spool))
+            eo_thread.setDaemon(True)
+            eo_thread.start()
+            while eo_process is not None and eo_process.is_alive() and eo_thread.is_alive():
+                # check every 1.0 sec
+                eo_thread.join(1)
+            if eo_process is None or eo_process.is_alive() is False:
+                logger.error("register process stopped:exitcode={0}".format(
+                    None if eo_process is None else eo_process.exitcode))
+            raise SystemExit(1)
+        else:
+            eo_receiver.receivePacket(eo_queue, eo_spool)
+    finally:
+        if ingest_mode == 'process':
+            eo_queue.close()
+            eo_queue.unlink()
 
     logger.debug("--- end: {0} ----".format(__file__))
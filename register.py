@@ -27,16 +27,57 @@ from profile import EnOceanEquipmentProfile_A5_02_05
 from profile import EnOceanEquipmentProfile_A5_04_01
 from profile import EnOceanEquipmentProfile_D5_00_01
 from profile import EnOceanEquipmentProfile_F6_02_04
+from watering import PlantTwitterWateringDetector
+from linkstats import PlantTwitterLinkStats
+from liveness import PlantTwitterLivenessMonitor
+from rules import PlantTwitterRuleEngine
+from sinks import PlantTwitterSinks
+from outbox import PlantTwitterOutbox
+from metrics import cmMetrics
+from latency import PlantTwitterFrameTracer
 
 
 class PlantTwitterRegister():
 
-    def __init__(self, logger):
+    # seconds to insert a spooled frame again: the checkpoint waits for it.
+    REGISTER_RETRY_SECONDS = 1
+
+    def __init__(self, logger, readings=None):
         self.logger = logger
 
         self.config = cmConfig()
 
-    def parsePacket(self, packet):
+        self.watering_detector = PlantTwitterWateringDetector(self.logger)
+        self.link_stats = PlantTwitterLinkStats(self.logger)
+        self.liveness_monitor = PlantTwitterLivenessMonitor(
+            self.logger, int(time.time() * 1000))
+        # alert rules of config.ini: compiled once
+        self.rule_engine = PlantTwitterRuleEngine(self.logger)
+        # output sinks other than the database: csv, jsonl, influx, mqtt
+        self.sinks = PlantTwitterSinks(self.logger)
+
+        # shared state of daemon.py: PlantTwitterReadings
+        self.readings = readings
+
+        self.tracer = PlantTwitterFrameTracer(self.logger)
+
+        metrics = cmMetrics()
+        self.metric_parse_errors = metrics.counter(
+            'plant_twitter_parse_errors_total', 'Packets that cannot be parsed.')
+        self.metric_unknown_devices = metrics.counter(
+            'plant_twitter_unknown_device_total', 'Packets from devices not in the device list.')
+        self.metric_register_failures = metrics.counter(
+            'plant_twitter_register_failures_total', 'Sensor data failed to register.')
+        self.metric_watering_events = metrics.counter(
+            'plant_twitter_watering_events_total', 'Detected watering events.')
+        self.metric_parsing = metrics.histogram(
+            'plant_twitter_stage_seconds', 'Time of each receiving stage.', {'stage': 'parsing'})
+        self.metric_decoding = metrics.histogram(
+            'plant_twitter_stage_seconds', 'Time of each receiving stage.', {'stage': 'decoding'})
+        self.metric_commit = metrics.histogram(
+            'plant_twitter_stage_seconds', 'Time of each receiving stage.', {'stage': 'commit'})
+
+    def parsePacket(self, packet, received_at=None, trace=None):
         """Parse received paket data, and create sensor values.
 
         受信したパケットデータを解析してセンターの値を取得します。
@@ -44,6 +85,8 @@ class PlantTwitterRegister():
 
         Parse received paket data, and create sensor values.
         Device list of Originator ID and device model, please see the config.ini file.
+        received_at is the receive time of the packet (epoch milliseconds).
+        trace is PlantTwitterFrameTrace of the packet to mark the stages.
         """
 
         self.logger.info("parse packet:{0}".format(packet))
@@ -51,13 +94,22 @@ class PlantTwitterRegister():
         values = ()
 
         # parse packet data
+        begin_time = time.perf_counter()
         eo_parser = EnOceanTelegramParser(self.logger)
         ret = eo_parser.parseTelegramData(packet)
+        parsed_time = time.perf_counter()
+        self.metric_parsing.observe(parsed_time - begin_time)
+        if trace is not None:
+            trace.mark('parsed')
         self.logger.info("parse packet result:{0}".format(ret))
         if ret is not True:
             self.logger.error("Cannnot parse packet.")
+            self.metric_parse_errors.inc()
             return values
 
+        if received_at is None:
+            received_at = int(time.time() * 1000)
+
         # get Originator ID, Telegram Type
         id = eo_parser.getOriginatorID()
         type = eo_parser.getTelegramType()
@@ -85,7 +137,7 @@ class PlantTwitterRegister():
                     soil moisture={4} dbm={5}".format(id, device_model, type, temp, moisture, dbm))
 
                 values = (id, device_model, type, data_dl[0],  data_dl[1],  data_dl[
-                          2],  data_dl[3], dbm, temp, moisture, '', '', '')
+                          2],  data_dl[3], dbm, temp, moisture, '', '', '', received_at)
 
                 self.logger.debug("set datastore values:{0}".format(values))
 
@@ -103,7 +155,7 @@ class PlantTwitterRegister():
                     dbm={4}".format(id, device_model, type, temp, dbm))
 
                 values = (id, device_model, type, data_dl[0],  data_dl[
-                          1],  data_dl[2],  data_dl[3], dbm, temp, '', '', '', '')
+                          1],  data_dl[2],  data_dl[3], dbm, temp, '', '', '', '', received_at)
 
                 self.logger.debug("set datastore values:{0}".format(values))
 
@@ -122,7 +174,7 @@ class PlantTwitterRegister():
                     humidity={4} dbm={5}".format(id, device_model, type, temp, humidity, dbm))
 
                 values = (id, device_model, type, data_dl[0],  data_dl[1],  data_dl[
-                          2],  data_dl[3], dbm, temp, '', humidity, '', '')
+                          2],  data_dl[3], dbm, temp, '', humidity, '', '', received_at)
 
                 self.logger.debug("set datastore values:{0}".format(values))
 
@@ -140,7 +192,7 @@ class PlantTwitterRegister():
                     id, device_model, type, contact, dbm))
 
                 values = (id, device_model, type, data_dl[
-                          0],  '',  '',  '', dbm, '', '', '', contact, '')
+                          0],  '',  '',  '', dbm, '', '', '', contact, '', received_at)
 
                 self.logger.debug("set datastore values:{0}".format(values))
 
@@ -158,7 +210,7 @@ class PlantTwitterRegister():
                     id, device_model, type, rocker, dbm))
 
                 values = (id, device_model, type, data_dl[
-                          0],  '',  '',  '', dbm, '', '', '', '', rocker)
+                          0],  '',  '',  '', dbm, '', '', '', '', rocker, received_at)
 
                 self.logger.debug("set datastore values:{0}".format(values))
 
@@ -173,16 +225,31 @@ class PlantTwitterRegister():
         else:
             self.logger.error("Device id is not found in device list:{0}. see config.ini.".format(
                 id.decode('utf-8')))
+            self.metric_unknown_devices.inc()
+
+        self.metric_decoding.observe(time.perf_counter() - parsed_time)
+        if values != ():
+            self.link_stats.updateLink(id, eo_parser.getDbm(), eo_parser.getSubTelNum(),
+                                       received_at)
+            if trace is not None:
+                trace.mark('decoded')
 
         return values
 
-    def registerPacket(self, eo_queue):
+    def registerPacket(self, eo_queue, eo_spool=None):
         """register packet data into the database.
 
         受信したパケットデータを解析して、データベースに登録します。
+        eo_spoolを指定した場合は、登録後にスプールのチェックポイントを進めます。
+        登録に失敗した場合は、チェックポイントを進めずに、成功するまで
+        REGISTER_RETRY_SECONDS秒ごとに登録し直します。
         この関数は、スレッドとして起動されます。
 
         Receive packet data, and register it into the database.
+        If eo_spool is given, the checkpoint of the spool is advanced after
+        the registration. If the registration fails, the checkpoint stays,
+        and the frame is registered again every REGISTER_RETRY_SECONDS
+        seconds until it succeeds.
         This function is called by thread object.
         """
 
@@ -191,29 +258,129 @@ class PlantTwitterRegister():
         # open database
         data_store = PlantTwitterDatastore(self.logger)
 
+        metrics = cmMetrics()
+        metrics.setReady('register')
+        metric_readings = {}
+
         while True:
             if eo_queue.empty() is False:
 
                 # read packet from the thread queue
-                item = eo_queue.get()
+                (item, received_at, sequence, trace) = eo_queue.get()
 
                 # parse packet
-                values = self.parsePacket(item)
+                values = self.parsePacket(item, received_at, trace)
 
                 # register sensor data to the database
-                if values != '':
+                if values != ():
+                    # the other sinks do not wait for the database.
+                    self.sinks.putReading(values)
+
+                    begin_time = time.perf_counter()
                     data_store.openConnection()
 
-                    if data_store.insertRecord(*values):
+                    registered = data_store.insertRecord(*values)
+                    while registered is False and eo_spool is not None:
+                        # a stalled database: the checkpoint must not pass the frame.
+                        self.logger.error(
+                            "register sensor data result: Failure, retry")
+                        self.metric_register_failures.inc()
+                        data_store.closeConnection()
+                        time.sleep(self.REGISTER_RETRY_SECONDS)
+                        data_store.openConnection()
+                        registered = data_store.insertRecord(*values)
+
+                    if registered:
                         self.logger.info(
                             "register sensor data result: Success")
+                        if trace is not None:
+                            trace.mark('committed')
+                        if self.readings is not None:
+                            self.readings.pushRecord(values, trace)
+                        self.detectWatering(data_store, values)
+                        self.evaluateRules(values)
+                        self.detectLiveness(data_store, values)
+
+                        device_model = values[data_store.ROW_INDEX_DEVICE_MODEL]
+                        if device_model not in metric_readings:
+                            metric_readings[device_model] = metrics.counter(
+                                'plant_twitter_readings_total', 'Registered sensor data.',
+                                {'device_model': device_model})
+                        metric_readings[device_model].inc()
                     else:
                         self.logger.error(
                             "register sensor data result: Failure")
+                        self.metric_register_failures.inc()
+
+                    summaries = self.link_stats.popSummaries(received_at)
+                    if summaries:
+                        data_store.updateLinkStats(summaries)
 
                     data_store.closeConnection()
+                    self.metric_commit.observe(time.perf_counter() - begin_time)
+                    self.tracer.finishFrame(
+                        trace, values[data_store.ROW_INDEX_ORIGINATOR_ID])
+
+                if eo_spool is not None:
+                    eo_spool.commitFrame(sequence)
 
                 eo_queue.task_done()
 
+            # devices past the deadline
+            events = self.liveness_monitor.expireDevices(int(time.time() * 1000))
+            if events:
+                data_store.openConnection()
+                for event in events:
+                    data_store.insertLivenessEvent(*event)
+                data_store.closeConnection()
+
             # sleep 1.0 msec
             time.sleep(0.001)
+
+    def evaluateRules(self, values):
+        # queue the messages of the fired rules: tweeted by the delivery.
+        messages = [r.getMessage() for r in self.rule_engine.updateReading(values) if r.message]
+        if not messages:
+            return
+
+        outbox = PlantTwitterOutbox(self.logger)
+        outbox.openConnection()
+        for message in messages:
+            outbox.enqueueMessage(message, outbox.createKey(
+                message, values[PlantTwitterDatastore.VALUES_INDEX_RECEIVED_AT]))
+        outbox.closeConnection()
+
+    def detectLiveness(self, data_store, values):
+        # move the deadline, and register the event if the device is alive again.
+        event = self.liveness_monitor.updateDevice(
+            values[data_store.ROW_INDEX_ORIGINATOR_ID],
+            values[data_store.VALUES_INDEX_RECEIVED_AT])
+        if event is not None:
+            data_store.insertLivenessEvent(*event)
+
+    def detectWatering(self, data_store, values):
+        """Detect watering, and register the event into the database.
+
+        土壌水分量から水やりを検知して、イベントをデータベースに登録します。
+
+        Detect watering from the soil moisture, and register the event into
+        the database.
+        """
+
+        if values[data_store.ROW_INDEX_DEVICE_MODEL] != 'STM431JS':
+            return
+
+        id = values[data_store.ROW_INDEX_ORIGINATOR_ID]
+        received_at = values[data_store.VALUES_INDEX_RECEIVED_AT]
+
+        if self.watering_detector.hasDevice(id) is False:
+            self.watering_detector.loadSoilMoisture(
+                data_store, id, values[data_store.ROW_INDEX_DEVICE_MODEL], received_at)
+
+        event = self.watering_detector.updateSoilMoisture(
+            id, values[data_store.ROW_INDEX_SOIL_MOISTURE], received_at)
+        if event is not None:
+            data_store.insertWateringEvent(*event)
+            self.metric_watering_events.inc()
+            if self.readings is not None:
+                self.readings.pushWateringEvent(event)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""Shared-memory ring buffer of the received frames between processes.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+config.ini のINGEST_MODEが'process'の場合、receiver.py はシリアルポートの
+受信(フレームの組み立て)と、解析・データベースへの登録を別のプロセスで
+実行します。フレームはmultiprocessing.shared_memoryのリングバッファで
+渡します。書き込みは受信プロセスだけ、読み込みは登録プロセスだけなので
+(single-producer/single-consumer)、ロックもpickleも使用しません。
+書き込み側は書き込み位置(head)、読み込み側は読み込み位置(tail)だけを
+更新し、レコードを書き終えてからheadを進めます。Pythonでは書き込みの順序が
+保証されない(ARMのRaspberry Piなど)ので、読み込み側はレコード番号とフレームの
+crc32が一致するまで、レコードがまだ公開されていないものとして読み直します。
+空きがない場合は、受信プロセスを止めずにフレームを破棄して数えます。
+(plant_twitter_ring_dropped_total) Python 3.8以降が必要です。
+
+If INGEST_MODE of the config.ini file is 'process', receiver.py runs the
+serial reading (framing) and the parsing and the registration into the
+database in separate processes. The frames are passed through the ring
+buffer of multiprocessing.shared_memory. Only the receiving process writes
+and only the registering process reads (single-producer/single-consumer), so
+neither locks nor pickling are used.
+The writer updates only the write position (head), and the reader only the
+read position (tail). head is advanced after the record is written.
+Python gives no ordering of the stores (on the ARM of the Raspberry Pi and
+so on), so the reader reads a record again as not yet published until its
+record number and the crc32 of the frame match.
+If the ring is full, the frame is dropped and counted without stalling the
+receiving process. (plant_twitter_ring_dropped_total)
+Python 3.8 or later is required.
+
+Shared memory (little endian):
+    head uint64 (offset 0), tail uint64 (offset 64),
+    dropped frames uint64 (offset 128), written frames uint64 (offset 136),
+    records from offset 192 (INGEST_RING_SIZE bytes)
+Record (aligned to 8 bytes):
+    length uint32 (0xffffffff: wrap to the beginning), record number uint32,
+    receive time int64 (epoch ms), spool sequence number uint64 (0: none),
+    first_byte float64, framed float64 (time.monotonic(), NaN: none),
+    crc32 of the frame uint32, the frame bytes
+"""
+
+import math
+import time
+import zlib
+import struct
+import binascii
+from multiprocessing import shared_memory
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+from latency import PlantTwitterFrameTrace
+
+
+class PlantTwitterFrameRing():
+
+    RING_HEADER_SIZE = 192
+    RING_HEAD_OFFSET = 0
+    RING_TAIL_OFFSET = 64
+    RING_DROPPED_OFFSET = 128
+    RING_WRITTEN_OFFSET = 136
+
+    RING_POSITION = struct.Struct('<Q')
+    RECORD_HEADER = struct.Struct('<IIqQddI')
+    RECORD_WRAP = 0xffffffff
+    # wrap: 0xffffffff and the number of the next record
+    RECORD_MARK = struct.Struct('<II')
+
+    # seconds of an unpublished record until an error is logged
+    RING_PUBLISH_TIMEOUT = 1
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        # multiple of 8: the records are aligned.
+        self.capacity = int(config.option_list['Ingest']['INGEST_RING_SIZE']) // 8 * 8
+
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.RING_HEADER_SIZE + self.capacity)
+        self.buf = self.shm.buf
+        self.buf[:self.RING_HEADER_SIZE] = bytes(self.RING_HEADER_SIZE)
+
+        # positions of this side: head of the writer, tail of the reader
+        self.head = 0
+        self.tail = 0
+        self.written = 0
+        self.read_count = 0
+        self.dropped = 0
+
+        metrics = cmMetrics()
+        metrics.gauge('plant_twitter_ring_used_bytes',
+                      'Bytes of the frames in the ring buffer.').setFunction(self.getUsedBytes)
+        metrics.gauge('plant_twitter_ring_dropped_total',
+                      'Frames dropped by the full ring buffer.').setFunction(
+                          lambda: self.readPosition(self.RING_DROPPED_OFFSET))
+
+    def readPosition(self, offset):
+        return self.RING_POSITION.unpack_from(self.buf, offset)[0]
+
+    def writePosition(self, offset, value):
+        self.RING_POSITION.pack_into(self.buf, offset, value)
+
+    def getUsedBytes(self):
+        return self.readPosition(self.RING_HEAD_OFFSET) - self.readPosition(self.RING_TAIL_OFFSET)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def put(self, item, block=False):
+        """Write the frame to the ring, same as Queue.put() of the receiver.
+
+        (パケットのリスト, 受信時刻, シーケンス番号, PlantTwitterFrameTrace)を
+        書き込みます。空きがない場合はフレームを破棄してFalseを返します。
+        blockがTrueの場合は、空きができるまで待ちます。(スプールの再生)
+
+        Write (packet list, receive time, sequence number,
+        PlantTwitterFrameTrace). If the ring is full, the frame is dropped
+        and False is returned. If block is True, wait until the ring has
+        room. (replay of the spool)
+        """
+
+        (p_list, received_at, sequence, trace) = item
+        frame = binascii.unhexlify(b''.join(p_list))
+        size = (self.RECORD_HEADER.size + len(frame) + 7) // 8 * 8
+        if size > self.capacity:
+            return self.dropFrame()
+
+        while True:
+            position = self.head % self.capacity
+            # a record is not split: skip the end of the ring.
+            skip = self.capacity - position if self.capacity - position < size else 0
+            free = self.capacity - (self.head - self.readPosition(self.RING_TAIL_OFFSET))
+            if skip + size <= free:
+                break
+            if block is False:
+                return self.dropFrame()
+            time.sleep(0.001)
+
+        if skip:
+            self.RECORD_MARK.pack_into(self.buf, self.RING_HEADER_SIZE + position,
+                                       self.RECORD_WRAP, self.written & 0xffffffff)
+            self.head += skip
+            position = 0
+
+        first_byte_at = math.nan
+        framed_at = math.nan
+        if trace is not None:
+            first_byte_at = trace.marks['first_byte']
+            framed_at = trace.marks.get('framed', math.nan)
+
+        # the frame and the header first, then head.
+        offset = self.RING_HEADER_SIZE + position
+        self.buf[offset + self.RECORD_HEADER.size:
+                 offset + self.RECORD_HEADER.size + len(frame)] = frame
+        self.RECORD_HEADER.pack_into(self.buf, offset, len(frame), self.written & 0xffffffff,
+                                     received_at, sequence or 0, first_byte_at, framed_at,
+                                     zlib.crc32(frame))
+        self.head += size
+        self.written += 1
+        self.writePosition(self.RING_WRITTEN_OFFSET, self.written)
+        self.writePosition(self.RING_HEAD_OFFSET, self.head)
+
+        return True
+
+    def dropFrame(self):
+        self.dropped += 1
+        self.writePosition(self.RING_DROPPED_OFFSET, self.dropped)
+        self.logger.error("ring: full: drop frame:dropped={0}".format(self.dropped))
+        return False
+
+    def empty(self):
+        return self.readPosition(self.RING_HEAD_OFFSET) == self.tail
+
+    def get(self):
+        """Read a frame from the ring, same as Queue.get() of the register.
+
+        (パケットのリスト, 受信時刻, シーケンス番号, PlantTwitterFrameTrace)を
+        読み込みます。empty()がFalseの場合に呼び出してください。
+
+        Read (packet list, receive time, sequence number,
+        PlantTwitterFrameTrace). Call it if empty() is False.
+        The record is read again until it is published.
+        """
+
+        expected = self.read_count & 0xffffffff
+        begin_time = time.monotonic()
+        logged = False
+        while True:
+            position = self.tail % self.capacity
+            offset = self.RING_HEADER_SIZE + position
+            (length, number) = self.RECORD_MARK.unpack_from(self.buf, offset)
+            if length == self.RECORD_WRAP and number == expected:
+                self.tail += self.capacity - position
+                continue
+
+            (length, number, received_at, sequence, first_byte_at, framed_at,
+             crc) = self.RECORD_HEADER.unpack_from(self.buf, offset)
+            if number == expected and length <= self.capacity:
+                frame = bytes(self.buf[offset + self.RECORD_HEADER.size:
+                                       offset + self.RECORD_HEADER.size + length])
+                if zlib.crc32(frame) == crc:
+                    break
+
+            # the stores of the writer are not visible yet.
+            if logged is False and time.monotonic() - begin_time > self.RING_PUBLISH_TIMEOUT:
+                self.logger.error("ring: record not published:{0} expected={1}".format(
+                    number, expected))
+                logged = True
+            time.sleep(0.0001)
+
+        self.tail += (self.RECORD_HEADER.size + length + 7) // 8 * 8
+        self.read_count += 1
+        self.writePosition(self.RING_TAIL_OFFSET, self.tail)
+
+        trace = None
+        if math.isnan(first_byte_at) is False:
+            trace = PlantTwitterFrameTrace(first_byte_at)
+            if math.isnan(framed_at) is False:
+                trace.marks['framed'] = framed_at
+
+        p_list = [binascii.hexlify(frame[i:i + 1]) for i in range(length)]
+        return (p_list, received_at, sequence or None, trace)
+
+    def task_done(self):
+        pass
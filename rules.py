@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""Evaluate the alert rules on each registered reading.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+config.ini のRULE_LISTのルール([Rule:{ルール名}]セクション)を起動時に一度だけ
+解析して、デバイス毎の評価プラン(そのデバイスの値を使う条件のリスト)を
+作成します。registerモジュールは値を登録するたびにupdateReading()を呼び出し、
+そのデバイスの条件だけを評価するので、1回の評価はルールの履歴の長さによらず
+O(1)です。(rises/fallsの時間枠は単調キューで、償却O(1)です)
+ツイートのループを待たずに、パケットを受信してすぐにルールが成立します。
+
+RULE_WHEN: 条件を"and"でつなぎます。条件は以下のいずれかです。
+    {デバイス}.{項目} {<, <=, >, >=, ==, !=} {値}
+    {デバイス}.{項目} {falls, rises} {変化量} in {分}
+        直近{分}分の最大値(最小値)から{変化量}以上下がった(上がった)場合
+    デバイスはoriginator id、またはデバイスモデルです。デバイスモデルの場合は
+    そのモデルのデバイス毎にルールを作成します。(1つのルールに1モデルまで)
+    項目はTEMPERATURE, SOIL_MOISTURE, HUMIDITY, DBM, CONTACT_SWITCH,
+    ROCKER_SWITCHです。
+RULE_HYSTERESIS: 成立した数値の条件は、しきい値(変化量)をこの値だけ
+    越えて戻るまで成立したままです。
+RULE_FOR_SECONDS: 全ての条件がこの秒数続いた場合にルールが成立します。
+RULE_MESSAGE: 成立した場合にoutboxに保存するメッセージです。{0}はルールの
+    デバイス(デバイスモデルの場合)、またはルール名に置き換えます。
+    空の場合はログとメトリクスだけです。
+ルールは条件が成立しなくなるまで、再び成立しません。
+
+Parse the rules of RULE_LIST of the config.ini file ([Rule:{rule name}]
+sections) once at the start, and create the evaluation plan of each device
+(the list of the conditions on the values of the device).
+The register module calls updateReading() on every registered reading, and
+only the conditions of the device are evaluated, so an evaluation costs O(1)
+regardless of the history of the rules. (The time window of rises/falls is a
+monotonic queue, amortized O(1))
+A rule fires as soon as the packet is received, without waiting for the
+tweet loop.
+
+RULE_WHEN: the conditions joined by "and". A condition is either of:
+    {device}.{field} {<, <=, >, >=, ==, !=} {value}
+    {device}.{field} {falls, rises} {change} in {minutes}
+        fell (rose) {change} or more from the max (min) of {minutes} minutes
+    A device is an originator id or a device model. For a device model, a
+    rule is created for each device of the model. (one model in a rule)
+    A field is TEMPERATURE, SOIL_MOISTURE, HUMIDITY, DBM, CONTACT_SWITCH or
+    ROCKER_SWITCH.
+RULE_HYSTERESIS: a numeric condition once true stays true until the value
+    goes back past the threshold (change) by it.
+RULE_FOR_SECONDS: the rule fires when all conditions hold for the seconds.
+RULE_MESSAGE: the message stored in the outbox when the rule fires. {0} is
+    replaced by the device of the rule (for a device model) or the rule name.
+    If it is empty, only the log and the metrics.
+A rule does not fire again until the conditions stop holding.
+
+"""
+
+import string
+import operator
+from collections import deque
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+from datastore import PlantTwitterDatastore
+
+
+class PlantTwitterRuleCondition():
+
+    OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+                 '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+    # direction of the hysteresis: the threshold moves while true.
+    HYSTERESIS_SIGNS = {'<': 1, '<=': 1, '>': -1, '>=': -1}
+
+    def __init__(self, rule, field, op, value, hysteresis, window=0):
+        self.rule = rule
+        self.index = getattr(PlantTwitterDatastore, 'ROW_INDEX_' + field)
+        self.op = op
+        self.value = value
+        self.hysteresis = hysteresis
+        # milliseconds of rises/falls: deque of (received_at, value)
+        self.window = window
+        self.recent = deque()
+
+        self.state = False
+        self.received_at = None
+
+    def updateValue(self, value, received_at):
+        """Evaluate the condition, and return True if the state changed.
+
+        新しい値で条件を評価して、状態が変わった場合はTrueを返します。
+
+        Evaluate the condition with the new value, and return True if the
+        state changed.
+        """
+
+        # no value of the field, or a replayed reading older than the last.
+        if value == '' or (self.received_at is not None and received_at < self.received_at):
+            return False
+        self.received_at = received_at
+
+        if self.window:
+            state = self.updateWindow(value, received_at)
+        elif self.op in self.HYSTERESIS_SIGNS:
+            threshold = self.value
+            if self.state:
+                threshold += self.HYSTERESIS_SIGNS[self.op] * self.hysteresis
+            state = self.OPERATORS[self.op](value, threshold)
+        else:
+            state = self.OPERATORS[self.op](value, self.value)
+
+        if state == self.state:
+            return False
+        self.state = state
+        return True
+
+    def updateWindow(self, value, received_at):
+        # evict values older than the window
+        while self.recent and received_at - self.recent[0][0] > self.window:
+            self.recent.popleft()
+
+        # falls: the head is the max, rises: the head is the min.
+        if self.op == 'falls':
+            while self.recent and self.recent[-1][1] <= value:
+                self.recent.pop()
+        else:
+            while self.recent and self.recent[-1][1] >= value:
+                self.recent.pop()
+        self.recent.append((received_at, value))
+
+        change = abs(value - self.recent[0][1])
+        return change >= self.value - (self.hysteresis if self.state else 0)
+
+
+class PlantTwitterRule():
+
+    def __init__(self, name, device, for_seconds, message):
+        self.name = name
+        # originator id of a rule of a device model, or None
+        self.device = device
+        self.for_ms = int(for_seconds * 1000)
+        self.message = message
+
+        self.conditions = []
+        self.true_count = 0
+        # the time when all conditions hold, or None
+        self.since = None
+        self.fired = False
+
+    def updateConditions(self, changed, received_at):
+        """Update the state by the conditions, and return True if the rule fires.
+
+        1つの値で状態が変わった条件を全て反映してから、ルールが成立した場合は
+        Trueを返します。
+
+        Update the state by all the conditions changed by a reading, and
+        return True if the rule fires.
+        """
+
+        if changed:
+            for condition in changed:
+                self.true_count += 1 if condition.state else -1
+            if self.true_count == len(self.conditions):
+                self.since = received_at
+            else:
+                self.since = None
+                self.fired = False
+
+        if self.since is None or self.fired or received_at - self.since < self.for_ms:
+            return False
+        self.fired = True
+        return True
+
+    def getMessage(self):
+        return self.message.replace(
+            '{0}', self.name if self.device is None else self.device.decode('utf-8'))
+
+
+class PlantTwitterRuleEngine():
+
+    RULE_SECTION = 'Rule:'
+    RULE_FIELDS = ('TEMPERATURE', 'SOIL_MOISTURE', 'HUMIDITY', 'DBM',
+                   'CONTACT_SWITCH', 'ROCKER_SWITCH')
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.rules = []
+        # originator id -> list of the conditions on the values of the device
+        self.plans = {}
+        # rule name -> counter of the fired rules
+        self.metric_alerts = {}
+
+        names = self.config.option_list['Rules']['RULE_LIST'].replace(' ', '')
+        for name in [n for n in names.split(',') if n]:
+            try:
+                self.compileRule(name)
+            except (KeyError, ValueError) as e:
+                self.logger.error("rules: invalid rule:{0}:{1}".format(name, e))
+
+        self.logger.info("rules: rules={0} devices={1}".format(
+            len(self.rules), len(self.plans)))
+
+    def parseCondition(self, term):
+        # "{device}.{field} {op} {value}" or "{device}.{field} falls {change} in {minutes}"
+        words = term.split()
+        if len(words) not in (3, 5) or '.' not in words[0]:
+            raise ValueError("condition:{0}".format(term))
+
+        (device, field) = words[0].rsplit('.', 1)
+        field = field.upper()
+        if field not in self.RULE_FIELDS:
+            raise ValueError("field:{0}".format(field))
+
+        op = words[1].lower()
+        if len(words) == 5:
+            if op not in ('falls', 'rises') or words[3].lower() != 'in':
+                raise ValueError("condition:{0}".format(term))
+            return (device, field, op, float(words[2]), int(float(words[4]) * 60 * 1000))
+
+        if op not in PlantTwitterRuleCondition.OPERATORS:
+            raise ValueError("operator:{0}".format(op))
+        try:
+            value = float(words[2])
+        except ValueError:
+            # a word of CONTACT_SWITCH or ROCKER_SWITCH: 'open', 'closed' ...
+            if op not in ('==', '!='):
+                raise ValueError("operator of a word:{0}".format(term))
+            value = words[2]
+        return (device, field, op, value, 0)
+
+    def isOriginatorID(self, device):
+        # 8 hex digits, otherwise a device model
+        return len(device) == 8 and all(c in string.hexdigits for c in device)
+
+    def compileRule(self, name):
+        """Compile a rule into the conditions of the evaluation plans.
+
+        [Rule:{name}]セクションを解析して、ルール(デバイスモデルの場合は
+        デバイス毎のルール)の条件をデバイスの評価プランに追加します。
+
+        Parse the section [Rule:{name}], and add the conditions of the rule
+        (the rule of each device, for a device model) to the evaluation plans
+        of the devices.
+        """
+
+        section = self.config.option_list[self.RULE_SECTION + name]
+        terms = [self.parseCondition(t) for t in section['RULE_WHEN'].split(' and ')]
+        hysteresis = float(section.get('RULE_HYSTERESIS', '0'))
+        for_seconds = float(section.get('RULE_FOR_SECONDS', '0'))
+        message = section.get('RULE_MESSAGE', '')
+
+        models = set(t[0].upper() for t in terms if self.isOriginatorID(t[0]) is False)
+        if len(models) > 1:
+            raise ValueError("device models:{0}".format(','.join(models)))
+
+        if models:
+            model = models.pop()
+            devices = [i for (i, m) in sorted(self.config.device_list.items()) if m == model]
+            if not devices:
+                raise ValueError("no device:{0}".format(model))
+        else:
+            model = None
+            devices = [None]
+
+        for b_sensor_id in devices:
+            rule = PlantTwitterRule(name, b_sensor_id, for_seconds, message)
+            for (device, field, op, value, window) in terms:
+                if device.upper() == model:
+                    originator_id = b_sensor_id
+                else:
+                    originator_id = device.lower().encode('utf-8')
+                condition = PlantTwitterRuleCondition(rule, field, op, value, hysteresis, window)
+                rule.conditions.append(condition)
+                self.plans.setdefault(originator_id, []).append(condition)
+            self.rules.append(rule)
+
+        self.metric_alerts[name] = cmMetrics().counter(
+            'plant_twitter_rule_alerts_total', 'Fired alert rules.', {'rule': name})
+
+    def updateReading(self, values):
+        """Evaluate the conditions of the device, and return the fired rules.
+
+        insertRecord()の値で、そのデバイスの条件だけを評価して、成立した
+        ルールのリストを返します。ルールは全ての条件を評価した後に1回だけ
+        判定します。
+
+        Evaluate only the conditions of the device by the values of
+        insertRecord(), and return the list of the fired rules. A rule is
+        checked once after all the conditions are evaluated.
+        """
+
+        plan = self.plans.get(values[PlantTwitterDatastore.ROW_INDEX_ORIGINATOR_ID])
+        if plan is None:
+            return []
+
+        received_at = values[PlantTwitterDatastore.VALUES_INDEX_RECEIVED_AT]
+        # rule -> the conditions changed by the reading
+        changes = {}
+        for condition in plan:
+            changed = changes.setdefault(condition.rule, [])
+            if condition.updateValue(values[condition.index], received_at):
+                changed.append(condition)
+
+        fired = []
+        for (rule, changed) in changes.items():
+            if rule.updateConditions(changed, received_at):
+                fired.append(rule)
+                self.logger.info("rules: fire:{0} device={1}".format(rule.name, rule.device))
+                self.metric_alerts[rule.name].inc()
+        return fired
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""Schedule the tweets of each device.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+デバイス毎に次にメッセージを作成する時刻を最小ヒープで管理します。
+tweetモジュールは時刻になったデバイスだけを取り出すので、デバイスが
+増えても各デバイスのツイートは遅れず、他のデバイスの待ち時間や水やりの
+状態に影響されません。水やりを検知したデバイスは、待ち時間の途中でも
+すぐに取り出せます。(wakeDevice())
+ツイートする時間帯はTWEET_HOURS_BEGIN時からTWEET_HOURS_END時の前までです。
+(BEGINがENDより大きい場合は、日付をまたぐ時間帯です)
+
+Keep the next time to create a message of each device in a min-heap.
+The tweet module takes only the devices that are due, so the tweet of each
+device is not delayed by the number of the devices, and is not affected by
+the waiting time or the watering state of the other devices. A device where
+watering is detected can be taken at once even while waiting. (wakeDevice())
+The tweets are created from TWEET_HOURS_BEGIN o'clock until before
+TWEET_HOURS_END o'clock. (If BEGIN is greater than END, the hours are over
+midnight)
+
+"""
+
+import heapq
+import datetime
+
+from config import cmConfig
+from logger import cmLogger
+
+
+class PlantTwitterTweetScheduler():
+
+    def __init__(self, logger, now):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.hours_begin = int(self.config.option_list['Twitter']['TWEET_HOURS_BEGIN'])
+        self.hours_end = int(self.config.option_list['Twitter']['TWEET_HOURS_END'])
+
+        # heap of (due time, originator id): the entries not in self.due are stale.
+        self.heap = []
+        # originator id -> due time (epoch seconds)
+        self.due = {}
+
+        for b_sensor_id in self.config.device_list:
+            self.scheduleDevice(b_sensor_id, now)
+
+    def scheduleDevice(self, b_sensor_id, due):
+        self.due[b_sensor_id] = due
+        heapq.heappush(self.heap, (due, b_sensor_id))
+
+    def wakeDevice(self, b_sensor_id, now):
+        # take the device at once, even if it is waiting.
+        if self.due.get(b_sensor_id, now) > now:
+            self.logger.debug("scheduler: wake device:{0}".format(b_sensor_id))
+            self.scheduleDevice(b_sensor_id, now)
+
+    def popDueDevices(self, now):
+        """Return the list of the devices that are due.
+
+        時刻になったデバイスをヒープから取り出して返します。
+        取り出したデバイスは、scheduleDevice()で次の時刻を設定してください。
+
+        Take the devices that are due from the heap, and return them.
+        Set the next time of the taken devices by scheduleDevice().
+        """
+
+        devices = []
+        while self.heap and self.heap[0][0] <= now:
+            (due, b_sensor_id) = heapq.heappop(self.heap)
+            if self.due.get(b_sensor_id) != due:
+                continue
+            del self.due[b_sensor_id]
+            devices.append(b_sensor_id)
+        return devices
+
+    def getNextDue(self):
+        # the earliest due time, or None
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def isActiveTime(self, now_datetime):
+        if self.hours_begin <= self.hours_end:
+            return self.hours_begin <= now_datetime.hour < self.hours_end
+        return now_datetime.hour >= self.hours_begin or now_datetime.hour < self.hours_end
+
+    def getActiveTime(self, now_datetime):
+        # the time when the active hours begin next
+        begin = now_datetime.replace(hour=self.hours_begin, minute=0, second=0, microsecond=0)
+        if begin <= now_datetime:
+            begin += datetime.timedelta(days=1)
+        return begin
@@ -3,7 +3,9 @@
 DB_FILENAME="sensorlogs.db"
 
 SQL_DROP_TABLE="DROP TABLE SENSORLOGS;"
+SQL_DROP_TABLE_OUTBOX="DROP TABLE OUTBOX;"
 SQL_VACUUM="VACUUM;"
+SQL_RESET_VERSION="PRAGMA user_version = 0;"
 
 SQL_CREATE_TABLE="CREATE TABLE SENSORLOGS (
   ID INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -23,14 +25,35 @@ SQL_CREATE_TABLE="CREATE TABLE SENSORLOGS (
   CREATE_AT TIMESTAMP DEFAULT (DATETIME('now','localtime'))
 );"
 
+SQL_CREATE_TABLE_OUTBOX="CREATE TABLE OUTBOX (
+  ID INTEGER PRIMARY KEY AUTOINCREMENT,
+  IDEMPOTENCY_KEY TEXT UNIQUE,
+  MESSAGE TEXT,
+  STATUS TEXT,
+  ATTEMPTS INTEGER DEFAULT 0,
+  NEXT_ATTEMPT_AT REAL DEFAULT 0,
+  LAST_ERROR TEXT,
+  CREATE_AT TIMESTAMP DEFAULT (DATETIME('now','localtime')),
+  SENT_AT TIMESTAMP
+);"
+
 SQL_SCHEMA=".schema"
 
 echo $SQL_DROP_TABLE | sqlite3 $DB_FILENAME
 
+echo $SQL_DROP_TABLE_OUTBOX | sqlite3 $DB_FILENAME
+
 echo $SQL_VACUUM | sqlite3 $DB_FILENAME
 
+echo $SQL_RESET_VERSION | sqlite3 $DB_FILENAME
+
 echo $SQL_CREATE_TABLE | sqlite3 $DB_FILENAME
 
+echo $SQL_CREATE_TABLE_OUTBOX | sqlite3 $DB_FILENAME
+
+# migrate the table to the latest schema, and set the WAL mode (backup.py)
+python3 ./migrate.py --wal
+
 echo $SQL_SCHEMA | sqlite3 $DB_FILENAME
 
 exit 0
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""Simulate the tweets of days in seconds.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+保存されたセンサーデータ、または合成したセンサーデータを受信時刻の順に
+一時ディレクトリのデータベースに登録しながら、tweetモジュールのメッセージ
+作成とスケジューリングを実行します。時計はPlantTwitterSimulatedClockなので、
+tweet.py のsleep()は待たずに時刻を進め、数週間分の動作を数秒で実行できます。
+ツイートはTwitterに送信せずに記録して、件数と送信時刻を表示します。(--outputで
+ファイルに出力します) メッセージ作成のスループット(件/秒)も表示するので、
+ベンチマークとしても使えます。simulate.py は単独で動作するアプリケーションです。
+以下のように実行してください。
+
+$ python3 ./simulate.py --days 14 --devices 30
+$ python3 ./simulate.py --stored --begin 2017-06-01 --days 7 --output tweets.tsv
+
+--storedを指定しない場合は、--devices台のデバイス(STM431JS, STM431J,
+STM431JHの順)の合成データを--interval秒毎に作成します。土壌水分量は
+徐々に下がり、約2日毎に水やりで上がります。
+--no-clock-checkはMESSAGE_CLOCK_CHECKをFalseにして、全デバイスが毎分
+メッセージを作成します。(スループットの計測)
+
+Register the stored or the synthetic sensor data into the database of a
+temporary directory in the order of the receive time, and run the message
+creation and the scheduling of the tweet module. The clock is
+PlantTwitterSimulatedClock, so sleep() of tweet.py advances the time without
+waiting, and weeks of operation run in seconds.
+The tweets are not sent to Twitter but recorded, and their count and the
+send times are displayed. (--output writes them to a file)
+The throughput of the message creation (messages per second) is also
+displayed, so it works as a benchmark too.
+This application works standalone. you can run as follows.
+
+$ python3 ./simulate.py --days 14 --devices 30
+$ python3 ./simulate.py --stored --begin 2017-06-01 --days 7 --output tweets.tsv
+
+Without --stored, the synthetic data of --devices devices (STM431JS, STM431J
+and STM431JH in turn) is created every --interval seconds. The soil moisture
+falls slowly, and rises by watering about every 2 days.
+--no-clock-check sets MESSAGE_CLOCK_CHECK False, and all devices create a
+message every minute. (measure the throughput)
+
+"""
+
+import math
+import time
+import heapq
+import random
+import logging
+import sqlite3
+import argparse
+import datetime
+import tempfile
+
+from config import cmConfig
+from logger import cmLogger
+from clock import PlantTwitterSimulatedClock
+from migrate import PlantTwitterMigration
+from outbox import PlantTwitterOutbox
+from datastore import PlantTwitterDatastore
+from watering import PlantTwitterWateringDetector
+from tweet import PlantTwitterTweet
+
+# same as setup_db.sh: migrate.py creates the latest schema.
+SQL_CREATE_TABLE = "CREATE TABLE SENSORLOGS (" + \
+    "ID INTEGER PRIMARY KEY AUTOINCREMENT, ORIGINATOR_ID TEXT, " + \
+    "DEVICE_MODEL TEXT, TELEGRAM_TYPE TEXT, DB_0 TEXT, DB_1 TEXT, " + \
+    "DB_2 TEXT, DB_3 TEXT, DBM INTEGER, TEMPERATURE INTEGER, " + \
+    "SOIL_MOISTURE INTEGER, HUMIDITY INTEGER, CONTACT_SWITCH TEXT, " + \
+    "ROCKER_SWITCH TEXT, " + \
+    "CREATE_AT TIMESTAMP DEFAULT (DATETIME('now','localtime')))"
+
+
+class PlantTwitterTweetRecorder():
+    """Recorder in place of the Twitter client of PlantTwitterTweet.
+
+    statuses.update()で送信したツイートを(時刻, メッセージ)で記録します。
+
+    Record the tweets sent by statuses.update() as (time, message).
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.statuses = self
+        self.tweets = []
+
+    def update(self, status):
+        self.tweets.append((self.clock.time(), status))
+
+
+class PlantTwitterSimulation():
+
+    SYNTHETIC_MODELS = ('STM431JS', 'STM431J', 'STM431JH')
+    SYNTHETIC_ORIGINATOR_ID = 0x04100000
+
+    # hours between watering of the synthetic data
+    SYNTHETIC_WATERING_HOURS = 48
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.watering_detector = PlantTwitterWateringDetector(self.logger)
+
+    def createDatabase(self):
+        # the database of a temporary directory: the config is shared.
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.config.option_list['DEFAULT']['DATA_FILE_PATH'] = self.data_dir.name
+
+        conn = sqlite3.connect(self.data_dir.name + PlantTwitterDatastore.DATA_STORE_FILE)
+        conn.execute(SQL_CREATE_TABLE)
+        # the commits of the simulation are not synced to the disk.
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.close()
+        return PlantTwitterMigration(self.logger).migrate()
+
+    def setSyntheticDevices(self, devices):
+        self.config.device_list.clear()
+        for i in range(devices):
+            self.config.device_list[b'%08x' % (self.SYNTHETIC_ORIGINATOR_ID + i)] = \
+                self.SYNTHETIC_MODELS[i % len(self.SYNTHETIC_MODELS)]
+
+    def iterSyntheticValues(self, begin_at, end_at, interval):
+        """Generate the synthetic values of the devices in the receive order.
+
+        デバイス毎に位相をずらした気温(1日周期)、湿度、土壌水分量の
+        insertRecord()の値を受信時刻の順に返すジェネレーターです。
+
+        Generator of the values of insertRecord() of the devices in the
+        order of the receive time, with the temperature (a day cycle), the
+        humidity and the soil moisture shifted for each device.
+        """
+
+        devices = sorted(self.config.device_list.items())
+        step = interval * 1000
+        watering_cycle = self.SYNTHETIC_WATERING_HOURS * 60 * 60 * 1000
+
+        for received_at in range(begin_at, end_at, step):
+            for (i, (b_sensor_id, device_model)) in enumerate(devices):
+                at = received_at + i * step // len(devices)
+                phase = (at / 1000 / 86400 + i / len(devices)) * 2 * math.pi
+                temperature = round(20 + 8 * math.sin(phase) + random.uniform(-0.5, 0.5), 2)
+
+                soil_moisture = ''
+                humidity = ''
+                if device_model == 'STM431JS':
+                    # dries up from 200, and watering rises it again.
+                    soil_moisture = int(200 - 150 * ((at + i * 3600000) % watering_cycle) /
+                                        watering_cycle)
+                elif device_model == 'STM431JH':
+                    humidity = round(50 - 20 * math.sin(phase), 1)
+
+                yield (b_sensor_id, device_model, '4BS', b'00',
+                       b'%02x' % (soil_moisture or 0), b'%02x' % int(temperature * 255 / 40),
+                       b'08', -random.randint(40, 90), temperature, soil_moisture,
+                       humidity, '', '', at)
+
+    def iterStoredValues(self, begin_at, end_at):
+        # the stored rows of the devices merged in the receive order
+        data_store = PlantTwitterDatastore(self.logger)
+        data_store.openConnection(read_only=True)
+
+        device_rows = [data_store.iterRecords(b_sensor_id, begin_at, end_at)
+                       for b_sensor_id in sorted(self.config.device_list)]
+        for r in heapq.merge(*device_rows,
+                             key=lambda r: r[PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT]):
+            yield tuple(r[:PlantTwitterDatastore.ROW_INDEX_CREATE_AT]) + \
+                (r[PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT],)
+
+        data_store.closeConnection()
+
+    def registerValues(self, data_store, values):
+        # same as PlantTwitterRegister: the row and the watering event
+        data_store.insertRecord(*values)
+
+        if values[data_store.ROW_INDEX_DEVICE_MODEL] != 'STM431JS' or \
+                values[data_store.ROW_INDEX_SOIL_MOISTURE] == '':
+            return
+
+        event = self.watering_detector.updateSoilMoisture(
+            values[data_store.ROW_INDEX_ORIGINATOR_ID],
+            values[data_store.ROW_INDEX_SOIL_MOISTURE],
+            values[data_store.VALUES_INDEX_RECEIVED_AT])
+        if event is not None:
+            data_store.insertWateringEvent(*event)
+
+    def runSimulation(self, values, begin, end, clock_check=None):
+        """Run the tweet module from begin to end (epoch seconds).
+
+        valuesの値(受信時刻の順)を時刻になったら登録しながら、tweet.py の
+        メインループと同じ手順でメッセージの作成と送信を実行します。
+        結果の辞書を返します。
+
+        Run the message creation and the delivery by the same steps as the
+        main loop of tweet.py, registering the values (in the order of the
+        receive time) when they are due. Return the dictionary of the result.
+        """
+
+        clock = PlantTwitterSimulatedClock(begin)
+
+        eo_tweet = PlantTwitterTweet(self.logger, clock=clock)
+        recorder = PlantTwitterTweetRecorder(clock)
+        eo_tweet.twitter = recorder
+        if clock_check is not None:
+            eo_tweet.clock_check = clock_check
+
+        data_store = PlantTwitterDatastore(self.logger, clock)
+        data_store.openConnection()
+        data_store.conn.execute("PRAGMA synchronous = OFF")
+        outbox = PlantTwitterOutbox(self.logger, clock)
+        outbox.openConnection()
+        outbox.conn.execute("PRAGMA synchronous = OFF")
+
+        values = iter(values)
+        pending = next(values, None)
+
+        registered = 0
+        passes = 0
+        message_time = 0.0
+        begin_time = time.perf_counter()
+
+        while clock.time() < end:
+            # the values received until now
+            now_millis = int(clock.time() * 1000)
+            while pending is not None and \
+                    pending[data_store.VALUES_INDEX_RECEIVED_AT] <= now_millis:
+                self.registerValues(data_store, pending)
+                registered += 1
+                pending = next(values, None)
+
+            message_begin_time = time.perf_counter()
+            eo_tweet.tweetMessage()
+            message_time += time.perf_counter() - message_begin_time
+            passes += 1
+
+            # the delivery thread: the rate limit does not stop the clock.
+            eo_tweet.deliverPending(outbox, block=False)
+            eo_tweet.sleepUntilDue()
+
+        elapsed = time.perf_counter() - begin_time
+        data_store.closeConnection()
+
+        messages = outbox.conn.execute("SELECT COUNT(*) FROM OUTBOX").fetchone()[0]
+        outbox.closeConnection()
+
+        return {'readings': registered, 'passes': passes, 'messages': messages,
+                'tweets': recorder.tweets, 'elapsed': elapsed,
+                'message_time': message_time, 'simulated': clock.time() - begin}
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Simulate the tweets of days in seconds.')
+    arg_parser.add_argument('--days', type=float, default=7,
+                            help='days to simulate (default: 7)')
+    arg_parser.add_argument('--begin',
+                            help='date to begin YYYY-MM-DD (default: DAYS days ago)')
+    arg_parser.add_argument('--stored', action='store_true',
+                            help='replay the stored sensor data (default: synthetic data)')
+    arg_parser.add_argument('--devices', type=int, default=3,
+                            help='devices of the synthetic data (default: 3)')
+    arg_parser.add_argument('--interval', type=int, default=60,
+                            help='seconds between the synthetic data (default: 60)')
+    arg_parser.add_argument('--no-clock-check', action='store_true',
+                            help='set MESSAGE_CLOCK_CHECK False')
+    arg_parser.add_argument('--output', help='write the tweets to the file')
+    args = arg_parser.parse_args()
+
+    # set logger handler: the record logs are not measured.
+    logger = cmLogger().getLogger()
+    logger.setLevel(logging.ERROR)
+
+    if args.begin:
+        begin_datetime = datetime.datetime.strptime(args.begin, '%Y-%m-%d')
+    else:
+        begin_datetime = (datetime.datetime.now() - datetime.timedelta(days=args.days)).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+    begin = time.mktime(begin_datetime.timetuple())
+    end = begin + args.days * 24 * 60 * 60
+
+    eo_simulation = PlantTwitterSimulation(logger)
+
+    # read the stored rows before the database is replaced.
+    if args.stored:
+        values = list(eo_simulation.iterStoredValues(int(begin * 1000), int(end * 1000)))
+    else:
+        eo_simulation.setSyntheticDevices(args.devices)
+        values = eo_simulation.iterSyntheticValues(
+            int(begin * 1000), int(end * 1000), args.interval)
+
+    if eo_simulation.createDatabase() is False:
+        logger.error("simulate: cannot create the database.")
+    else:
+        result = eo_simulation.runSimulation(values, begin, end,
+                                             False if args.no_clock_check else None)
+
+        print("simulated {0:.1f} days of {1} devices in {2:.2f} sec ({3:.0f}x)".format(
+            result['simulated'] / 86400, len(eo_simulation.config.device_list),
+            result['elapsed'], result['simulated'] / max(result['elapsed'], 1e-9)))
+        print("readings: {0}, passes: {1}, messages: {2}, tweets: {3}".format(
+            result['readings'], result['passes'], result['messages'], len(result['tweets'])))
+        print("message creation: {0:.3f} sec ({1:.1f} messages/sec)".format(
+            result['message_time'], result['messages'] / max(result['message_time'], 1e-9)))
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                for (sent_at, message) in result['tweets']:
+                    f.write("{0}\t{1}\n".format(time.strftime(
+                        '%Y-%m-%d %H:%M:%S', time.localtime(sent_at)), message))
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+"""Fan-out of the registered readings to the output sinks.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+registerモジュールが解析したセンサーデータを、データベース(sqlite)に加えて
+config.ini のSINK_LISTの出力先(シンク)にも送信します。
+    csv, jsonl: DATA_FILE_PATHのsinksディレクトリのファイル
+        (SINK_FILE_MAX_BYTESバイトでローテーションし、SINK_FILE_COUNT個まで保存)
+    influx: InfluxDBのラインプロトコル(UDP)
+    mqtt: MQTT 3.1.1のPUBLISH(QoS 0)、JSON形式
+シンク毎にSINK_QUEUE_SIZE件のキューとワーカースレッドがあり、putReading()は
+待ちません。キューが一杯の場合はそのシンクの値だけを破棄して数えるので、
+遅いシンクや停止したシンクがシリアルポートの受信を止めることはありません。
+シンク毎の破棄数、書き込み数、エラー数、キューに入れてから書き込むまでの
+時間をメトリクスで公開します。
+
+Send the readings parsed by the register module to the output sinks of
+SINK_LIST of the config.ini file, in addition to the database (sqlite).
+    csv, jsonl: the files of the sinks directory of DATA_FILE_PATH
+        (rotated at SINK_FILE_MAX_BYTES bytes, SINK_FILE_COUNT files are kept)
+    influx: the line protocol of InfluxDB (UDP)
+    mqtt: PUBLISH (QoS 0) of MQTT 3.1.1, in JSON
+Each sink has a queue of SINK_QUEUE_SIZE readings and a worker thread, and
+putReading() never waits. If a queue is full, the reading is dropped and
+counted only for the sink, so a slow or stopped sink never stalls the
+reading of the serial port.
+The dropped, the written and the failed readings, and the time from the
+queue to the write are exposed by the metrics of each sink.
+
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import struct
+import threading
+import traceback
+from queue import Queue, Full, Empty
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+from datastore import PlantTwitterDatastore
+
+
+class PlantTwitterSink():
+
+    # max. readings written at once by the worker
+    SINK_BATCH_READINGS = 100
+
+    def __init__(self, logger, name):
+        self.logger = logger
+        self.name = name
+
+        self.config = cmConfig()
+        self.queue = Queue(int(self.config.option_list['Sinks']['SINK_QUEUE_SIZE']))
+
+        metrics = cmMetrics()
+        labels = {'sink': name}
+        self.metric_dropped = metrics.counter(
+            'plant_twitter_sink_dropped_total', 'Readings dropped by the full sink queue.', labels)
+        self.metric_written = metrics.counter(
+            'plant_twitter_sink_written_total', 'Readings written to the sink.', labels)
+        self.metric_errors = metrics.counter(
+            'plant_twitter_sink_errors_total', 'Readings failed to write to the sink.', labels)
+        self.metric_latency = metrics.histogram(
+            'plant_twitter_sink_seconds', 'Time from the sink queue to the write.', labels)
+        metrics.gauge('plant_twitter_sink_queue_depth', 'Readings waiting in the sink queue.',
+                      labels).setFunction(self.queue.qsize)
+
+    def putReading(self, values):
+        # never wait: drop the reading of this sink if the queue is full.
+        try:
+            self.queue.put_nowait((values, time.perf_counter()))
+        except Full:
+            self.metric_dropped.inc()
+            return False
+        return True
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='sink-' + self.name)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.SINK_BATCH_READINGS:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            try:
+                self.writeReadings([self.toReading(values) for (values, queued_at) in batch])
+            except (OSError, ValueError) as e:
+                self.logger.error("sink: {0}: write error:{1}".format(self.name, e))
+                self.metric_errors.inc(len(batch))
+                self.closeSink()
+                continue
+            except Exception:
+                # a bug of a sink must not stop the worker: drop the batch.
+                e_type, e_value, e_traceback = sys.exc_info()
+                self.logger.error("Exception sink {0}.:{1}".format(
+                    self.name, traceback.format_exception(e_type, e_value, e_traceback)))
+                self.metric_errors.inc(len(batch))
+                self.closeSink()
+                continue
+
+            written_at = time.perf_counter()
+            for (values, queued_at) in batch:
+                self.metric_latency.observe(written_at - queued_at)
+            self.metric_written.inc(len(batch))
+
+    def toReading(self, values):
+        # the values of insertRecord() -> dictionary of the fields
+        originator_id = values[PlantTwitterDatastore.ROW_INDEX_ORIGINATOR_ID]
+        payload = b''.join(v for v in values[PlantTwitterDatastore.ROW_INDEX_DB_0:
+                                             PlantTwitterDatastore.ROW_INDEX_DB_3 + 1] if v)
+        return {'originator_id': originator_id.decode('utf-8'),
+                'device_model': values[PlantTwitterDatastore.ROW_INDEX_DEVICE_MODEL],
+                'telegram_type': values[PlantTwitterDatastore.ROW_INDEX_TELEGRAM_TYPE],
+                'payload': payload.decode('utf-8'),
+                'dbm': values[PlantTwitterDatastore.ROW_INDEX_DBM],
+                'temperature': values[PlantTwitterDatastore.ROW_INDEX_TEMPERATURE],
+                'soil_moisture': values[PlantTwitterDatastore.ROW_INDEX_SOIL_MOISTURE],
+                'humidity': values[PlantTwitterDatastore.ROW_INDEX_HUMIDITY],
+                'contact_switch': values[PlantTwitterDatastore.ROW_INDEX_CONTACT_SWITCH],
+                'rocker_switch': values[PlantTwitterDatastore.ROW_INDEX_ROCKER_SWITCH],
+                'received_at': values[PlantTwitterDatastore.VALUES_INDEX_RECEIVED_AT]}
+
+    def writeReadings(self, readings):
+        raise NotImplementedError
+
+    def closeSink(self):
+        pass
+
+
+class PlantTwitterFileSink(PlantTwitterSink):
+
+    SINK_DIRECTORY = '/sinks'
+    SINK_FILE_NAME = '/readings.'
+
+    def __init__(self, logger, name):
+        super().__init__(logger, name)
+
+        self.file_name = self.config.option_list['DEFAULT']['DATA_FILE_PATH'] + \
+            self.SINK_DIRECTORY + self.SINK_FILE_NAME + name
+        self.max_bytes = int(self.config.option_list['Sinks']['SINK_FILE_MAX_BYTES'])
+        self.file_count = int(self.config.option_list['Sinks']['SINK_FILE_COUNT'])
+
+        self.file = None
+
+    def openFile(self):
+        if os.path.isdir(os.path.dirname(self.file_name)) is False:
+            os.makedirs(os.path.dirname(self.file_name))
+        self.file = open(self.file_name, 'a', newline='', encoding='utf-8')
+        if self.file.tell() == 0:
+            self.writeHeader()
+
+    def rotateFile(self):
+        # readings.csv -> readings.csv.1 -> ... -> readings.csv.{SINK_FILE_COUNT}
+        self.closeSink()
+        for number in range(self.file_count - 1, 0, -1):
+            if os.path.exists("{0}.{1}".format(self.file_name, number)):
+                os.replace("{0}.{1}".format(self.file_name, number),
+                           "{0}.{1}".format(self.file_name, number + 1))
+        if self.file_count > 0:
+            os.replace(self.file_name, self.file_name + '.1')
+        else:
+            os.remove(self.file_name)
+
+    def writeHeader(self):
+        # the first line of a new file
+        pass
+
+    def writeLines(self, readings):
+        raise NotImplementedError
+
+    def writeReadings(self, readings):
+        if self.file is None:
+            self.openFile()
+
+        self.writeLines(readings)
+        self.file.flush()
+
+        if self.file.tell() >= self.max_bytes:
+            self.rotateFile()
+
+    def closeSink(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PlantTwitterCsvSink(PlantTwitterFileSink):
+
+    CSV_FIELDS = ('originator_id', 'device_model', 'telegram_type', 'payload', 'dbm',
+                  'temperature', 'soil_moisture', 'humidity', 'contact_switch',
+                  'rocker_switch', 'received_at')
+
+    def writeHeader(self):
+        csv.writer(self.file).writerow(self.CSV_FIELDS)
+
+    def writeLines(self, readings):
+        writer = csv.writer(self.file)
+        for r in readings:
+            writer.writerow([r[f] for f in self.CSV_FIELDS])
+
+
+class PlantTwitterJsonlSink(PlantTwitterFileSink):
+
+    def writeLines(self, readings):
+        for r in readings:
+            self.file.write(json.dumps(r, ensure_ascii=False) + '\n')
+
+
+class PlantTwitterInfluxSink(PlantTwitterSink):
+
+    # max. bytes of a datagram: a packet of the ethernet
+    INFLUX_DATAGRAM_BYTES = 1400
+
+    # field -> type of the line protocol: 'i' integer, '' float, '"' string
+    INFLUX_FIELDS = (('dbm', 'i'), ('temperature', ''), ('soil_moisture', 'i'),
+                     ('humidity', ''), ('contact_switch', '"'), ('rocker_switch', '"'))
+
+    def __init__(self, logger, name):
+        super().__init__(logger, name)
+
+        self.address = (self.config.option_list['Sinks']['SINK_INFLUX_ADDRESS'],
+                        int(self.config.option_list['Sinks']['SINK_INFLUX_PORT']))
+        self.measurement = self.config.option_list['Sinks']['SINK_INFLUX_MEASUREMENT']
+
+        self.sock = None
+
+    def toLine(self, r):
+        # measurement,tags fields timestamp(ns)
+        fields = []
+        for (name, field_type) in self.INFLUX_FIELDS:
+            if r[name] == '' or r[name] is None:
+                continue
+            if field_type == 'i':
+                fields.append('{0}={1:d}i'.format(name, int(r[name])))
+            elif field_type == '"':
+                fields.append('{0}="{1}"'.format(
+                    name, str(r[name]).replace('\\', '\\\\').replace('"', '\\"')))
+            else:
+                fields.append('{0}={1}'.format(name, float(r[name])))
+        return '{0},originator_id={1},device_model={2} {3} {4:d}'.format(
+            self.measurement, r['originator_id'], r['device_model'], ','.join(fields),
+            r['received_at'] * 1000000)
+
+    def writeReadings(self, readings):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        datagram = b''
+        for r in readings:
+            line = self.toLine(r).encode('utf-8') + b'\n'
+            if datagram and len(datagram) + len(line) > self.INFLUX_DATAGRAM_BYTES:
+                self.sock.sendto(datagram, self.address)
+                datagram = b''
+            datagram += line
+        if datagram:
+            self.sock.sendto(datagram, self.address)
+
+    def closeSink(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class PlantTwitterMqttSink(PlantTwitterSink):
+
+    # MQTT 3.1.1 control packets
+    MQTT_CONNECT = 0x10
+    MQTT_CONNACK = 0x20
+    MQTT_PUBLISH = 0x30
+    MQTT_PROTOCOL_LEVEL = 4
+    # clean session, keep alive 0: no PINGREQ
+    MQTT_CONNECT_FLAGS = 0x02
+    MQTT_KEEP_ALIVE = 0
+
+    MQTT_TIMEOUT = 5
+
+    def __init__(self, logger, name):
+        super().__init__(logger, name)
+
+        self.address = (self.config.option_list['Sinks']['SINK_MQTT_ADDRESS'],
+                        int(self.config.option_list['Sinks']['SINK_MQTT_PORT']))
+        self.topic = self.config.option_list['Sinks']['SINK_MQTT_TOPIC']
+        self.client_id = self.config.option_list['Sinks']['SINK_MQTT_CLIENT_ID']
+
+        self.sock = None
+
+    def encodeString(self, text):
+        data = text.encode('utf-8')
+        return struct.pack('>H', len(data)) + data
+
+    def encodePacket(self, packet_type, body):
+        # fixed header: type and the remaining length (7 bits of each byte)
+        header = bytearray([packet_type])
+        length = len(body)
+        while True:
+            (length, digit) = divmod(length, 128)
+            header.append(digit | (0x80 if length > 0 else 0))
+            if length == 0:
+                break
+        return bytes(header) + body
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, timeout=self.MQTT_TIMEOUT)
+        self.sock.sendall(self.encodePacket(
+            self.MQTT_CONNECT, self.encodeString('MQTT') +
+            struct.pack('>BBH', self.MQTT_PROTOCOL_LEVEL, self.MQTT_CONNECT_FLAGS,
+                        self.MQTT_KEEP_ALIVE) + self.encodeString(self.client_id)))
+
+        connack = b''
+        while len(connack) < 4:
+            data = self.sock.recv(4 - len(connack))
+            if not data:
+                raise OSError("mqtt: connection closed")
+            connack += data
+        if connack[0] != self.MQTT_CONNACK or connack[3] != 0:
+            raise OSError("mqtt: connection refused:{0}".format(connack[3]))
+        self.logger.info("sink: mqtt: connected:{0}:{1}".format(*self.address))
+
+    def writeReadings(self, readings):
+        if self.sock is None:
+            self.connect()
+
+        self.sock.sendall(b''.join(
+            self.encodePacket(self.MQTT_PUBLISH,
+                              self.encodeString(self.topic.replace('{0}', r['originator_id'])) +
+                              json.dumps(r, ensure_ascii=False).encode('utf-8'))
+            for r in readings))
+
+    def closeSink(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class PlantTwitterSinks():
+
+    SINK_CLASSES = {'csv': PlantTwitterCsvSink, 'jsonl': PlantTwitterJsonlSink,
+                    'influx': PlantTwitterInfluxSink, 'mqtt': PlantTwitterMqttSink}
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        self.sinks = []
+        names = config.option_list['Sinks']['SINK_LIST'].replace(' ', '')
+        for name in [n for n in names.split(',') if n]:
+            if name not in self.SINK_CLASSES:
+                self.logger.error("Unsupported sink:{0}. see config.ini.".format(name))
+                continue
+            sink = self.SINK_CLASSES[name](self.logger, name)
+            sink.start()
+            self.sinks.append(sink)
+
+    def putReading(self, values):
+        """Put the values of insertRecord() in the queue of every sink.
+
+        insertRecord()の値を全てのシンクのキューに入れます。待ちません。
+
+        Put the values of insertRecord() in the queue of every sink.
+        This function does not wait.
+        """
+
+        for sink in self.sinks:
+            sink.putReading(values)
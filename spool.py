@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""Crash-safe spool of the received ESP3 frames.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+シリアルポートから受信したESP3フレームを、キューに入れる前にmmapした
+セグメントファイルに追記します。register モジュールはフレームの登録が
+終わるとチェックポイントを進めます。receiver.py を再起動すると、
+チェックポイントより後のフレームを再生するので、プロセスが停止しても
+キューのフレームは失われません。
+セグメントファイルはDATA_FILE_PATHのspoolディレクトリに作成され、
+数はSPOOL_SEGMENTSまでです。登録済みのセグメントはローテーション時に
+削除します。登録が止まって上限を超えた場合は、最も古いセグメントを
+破棄します。(plant_twitter_spool_dropped_total)
+SPOOL_SYNCがTrueの場合は、フレーム毎にディスクに書き込みます。(電源断にも
+対応しますが、処理時間が増えます)
+
+Append the ESP3 frames received from the serial port to the mmap'd segment
+file before putting them in the queue. The register module advances the
+checkpoint after it registers a frame. When receiver.py restarts, the frames
+after the checkpoint are replayed, so the frames in the queue are not lost
+when the process stops.
+The segment files are created in the spool directory of DATA_FILE_PATH, and
+at most SPOOL_SEGMENTS files are kept. The registered segments are deleted
+when the segment rotates. If the register stalls and the limit is exceeded,
+the oldest segment is dropped. (plant_twitter_spool_dropped_total)
+If SPOOL_SYNC is True, every frame is written to the disk. (It also survives
+a power failure, but takes more time)
+
+Segment file (SPOOL_SEGMENT_SIZE bytes, zero filled):
+    frame records, a record of length 0 is the end of the segment
+Frame record (little endian):
+    length uint32, crc32 of the frame uint32, receive time int64 (epoch ms),
+    sequence number uint64, the frame bytes
+Checkpoint file (8 bytes): the sequence number of the last registered frame
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import binascii
+import threading
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+
+
+class PlantTwitterSpool():
+
+    SPOOL_DIRECTORY = '/spool'
+    SPOOL_CHECKPOINT_FILE = '/checkpoint'
+    SPOOL_SEGMENT_FILE = '/segment_{0:08d}.spool'
+
+    RECORD_HEADER = struct.Struct('<IIqQ')
+    CHECKPOINT = struct.Struct('<Q')
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        config = cmConfig()
+        self.enabled = config.option_list['Spool']['SPOOL_ENABLED'] == 'True'
+        self.segment_size = int(config.option_list['Spool']['SPOOL_SEGMENT_SIZE'])
+        self.segments_max = int(config.option_list['Spool']['SPOOL_SEGMENTS'])
+        self.sync = config.option_list['Spool']['SPOOL_SYNC'] == 'True'
+        self.spool_path = config.option_list['DEFAULT'][
+            'DATA_FILE_PATH'] + self.SPOOL_DIRECTORY
+
+        # segment number -> [sequence number before the segment, last sequence number]
+        self.segments = {}
+        self.segment_number = 0
+        self.segment_file = None
+        self.segment_map = None
+        self.segment_offset = 0
+        self.sequence = 0
+
+        self.checkpoint_file = None
+        self.checkpoint_map = None
+        self.lock = threading.Lock()
+
+        metrics = cmMetrics()
+        self.metric_replayed = metrics.counter(
+            'plant_twitter_spool_replayed_total', 'Frames replayed from the spool.')
+        self.metric_dropped = metrics.counter(
+            'plant_twitter_spool_dropped_total', 'Frames dropped by the segment limit.')
+        metrics.gauge('plant_twitter_spool_backlog',
+                      'Frames spooled and not registered yet.').setFunction(self.getBacklog)
+
+    def openSpool(self):
+        """Open the checkpoint, and return the frames to replay.
+
+        チェックポイントを開いて、再生するフレームのリスト
+        [(パケットのリスト, 受信時刻, シーケンス番号, None)] を返します。
+        再生するフレームの時刻は記録しません。(None)
+        新しいフレームは、新しいセグメントに追記します。
+
+        Open the checkpoint, and return the list of the frames to replay
+        [(packet list, receive time, sequence number, None)].
+        The frames replayed are not traced. (None)
+        The new frames are appended to a new segment.
+        """
+
+        if os.path.isdir(self.spool_path) is False:
+            os.makedirs(self.spool_path)
+
+        checkpoint_name = self.spool_path + self.SPOOL_CHECKPOINT_FILE
+        if os.path.exists(checkpoint_name) is False:
+            with open(checkpoint_name, 'wb') as f:
+                f.write(self.CHECKPOINT.pack(0))
+        self.checkpoint_file = open(checkpoint_name, 'r+b')
+        self.checkpoint_map = mmap.mmap(self.checkpoint_file.fileno(), self.CHECKPOINT.size)
+        checkpoint = self.getCheckpoint()
+
+        frames = []
+        for number in self.listSegments():
+            segment = None
+            for (p_list, received_at, sequence) in self.readSegment(number):
+                if segment is None:
+                    segment = [sequence - 1, sequence]
+                segment[1] = sequence
+                if sequence > checkpoint:
+                    frames.append((p_list, received_at, sequence, None))
+            if segment is None:
+                segment = [self.sequence, self.sequence]
+            self.segments[number] = segment
+            self.segment_number = number
+            self.sequence = max(self.sequence, segment[1])
+
+        self.sequence = max(self.sequence, checkpoint)
+        self.logger.info("spool: open:checkpoint={0} sequence={1} replay={2}".format(
+            checkpoint, self.sequence, len(frames)))
+        self.metric_replayed.inc(len(frames))
+
+        self.rotateSegment()
+
+        return frames
+
+    def closeSpool(self):
+        with self.lock:
+            self.closeSegment()
+        if self.checkpoint_map is not None:
+            self.checkpoint_map.close()
+            self.checkpoint_file.close()
+            self.checkpoint_map = None
+
+    def listSegments(self):
+        numbers = []
+        for name in os.listdir(self.spool_path):
+            if name.startswith('segment_') and name.endswith('.spool'):
+                numbers.append(int(name[8:-6]))
+        return sorted(numbers)
+
+    def getSegmentName(self, number):
+        return self.spool_path + self.SPOOL_SEGMENT_FILE.format(number)
+
+    def readSegment(self, number):
+        # valid records until the end mark or a torn write
+        with open(self.getSegmentName(number), 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        while offset + self.RECORD_HEADER.size <= len(data):
+            (length, crc, received_at, sequence) = self.RECORD_HEADER.unpack_from(data, offset)
+            frame = data[offset + self.RECORD_HEADER.size:
+                         offset + self.RECORD_HEADER.size + length]
+            if length == 0 or len(frame) != length or zlib.crc32(frame) != crc:
+                break
+            p_list = [binascii.hexlify(frame[i:i + 1]) for i in range(length)]
+            yield (p_list, received_at, sequence)
+            offset += self.RECORD_HEADER.size + length
+
+    def appendFrame(self, p_list, received_at):
+        """Append the frame to the segment, and return its sequence number.
+
+        フレームをセグメントに追記して、シーケンス番号を返します。
+
+        Append the frame to the segment, and return its sequence number.
+        """
+
+        frame = binascii.unhexlify(b''.join(p_list))
+        size = self.RECORD_HEADER.size + len(frame)
+
+        with self.lock:
+            # keep the end mark after the record
+            if self.segment_offset + size + self.RECORD_HEADER.size > self.segment_size:
+                self.rotateSegment()
+
+            self.sequence += 1
+            offset = self.segment_offset
+
+            # the frame first, then the header: a torn record is not valid.
+            self.segment_map[offset + self.RECORD_HEADER.size:offset + size] = frame
+            self.RECORD_HEADER.pack_into(self.segment_map, offset, len(frame),
+                                         zlib.crc32(frame), received_at, self.sequence)
+            if self.sync:
+                self.segment_map.flush()
+
+            self.segment_offset += size
+            self.segments[self.segment_number][1] = self.sequence
+
+            return self.sequence
+
+    def commitFrame(self, sequence):
+        """Advance the checkpoint to the registered frame.
+
+        登録が終わったフレームまでチェックポイントを進めます。
+
+        Advance the checkpoint to the registered frame.
+        """
+
+        if self.checkpoint_map is None or sequence is None:
+            return
+        self.CHECKPOINT.pack_into(self.checkpoint_map, 0, sequence)
+        if self.sync:
+            self.checkpoint_map.flush()
+
+    def getCheckpoint(self):
+        if self.checkpoint_map is None:
+            return 0
+        return self.CHECKPOINT.unpack_from(self.checkpoint_map, 0)[0]
+
+    def getBacklog(self):
+        return self.sequence - self.getCheckpoint()
+
+    def rotateSegment(self):
+        """Start a new segment, and delete the registered segments.
+
+        新しいセグメントを開始して、登録済みのセグメントを削除します。
+        セグメント数がSPOOL_SEGMENTSを超える場合は、最も古いセグメントを破棄します。
+
+        Start a new segment, and delete the registered segments.
+        If the segments exceed SPOOL_SEGMENTS, the oldest segment is dropped.
+        """
+
+        self.closeSegment()
+
+        checkpoint = self.getCheckpoint()
+        for number in sorted(self.segments):
+            (base_sequence, last_sequence) = self.segments[number]
+            if last_sequence <= checkpoint:
+                os.remove(self.getSegmentName(number))
+                del self.segments[number]
+            elif len(self.segments) >= self.segments_max:
+                dropped = last_sequence - max(base_sequence, checkpoint)
+                self.logger.error("spool: drop segment:{0} frames={1}".format(
+                    number, dropped))
+                self.metric_dropped.inc(dropped)
+                os.remove(self.getSegmentName(number))
+                del self.segments[number]
+
+        self.segment_number += 1
+        self.segment_file = open(self.getSegmentName(self.segment_number), 'w+b')
+        self.segment_file.truncate(self.segment_size)
+        self.segment_map = mmap.mmap(self.segment_file.fileno(), self.segment_size)
+        self.segment_offset = 0
+        self.segments[self.segment_number] = [self.sequence, self.sequence]
+
+        self.logger.debug("spool: rotate segment:{0}".format(self.segment_number))
+
+    def closeSegment(self):
+        if self.segment_map is not None:
+            self.segment_map.close()
+            self.segment_file.close()
+            self.segment_map = None
+            self.segment_file = None
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+
+"""SQLite storage of the sensor data.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+センサーデータをデータベースの'SENSORLOGS'テーブル(datastore.py)に保存する
+ストレージです。config.ini のDATA_STORE_BACKENDが'sqlite'(デフォルト)の場合、
+PlantTwitterDatastoreはセンサーデータの読み書きをこのストレージに委譲します。
+接続はPlantTwitterDatastoreの接続を共有するので、その他のテーブルと同じ
+データベースです。スキーマのバージョン3以降(migrate.py)は型付きのスキーマ、
+バージョン6以降はarchive.py が移動した行(archivestore.py)も読み込みます。
+メソッドと行の形式はPlantTwitterMmapStore(mmapstore.py)と同じです。
+
+Storage of the sensor data in the 'SENSORLOGS' table of the database
+(datastore.py). If DATA_STORE_BACKEND of the config.ini file is 'sqlite'
+(default), PlantTwitterDatastore delegates reading and writing the sensor
+data to this storage. The connection of PlantTwitterDatastore is shared, so
+it is the same database as the other tables. The schema version 3 or later
+(migrate.py) is the typed schema, and from the version 6 the rows moved by
+archive.py (archivestore.py) are also read.
+The methods and the form of the rows are the same as PlantTwitterMmapStore
+(mmapstore.py).
+"""
+
+import binascii
+import sqlite3
+
+from config import cmConfig
+from logger import cmLogger
+from clock import PlantTwitterClock
+from archivestore import PlantTwitterArchiveStore
+
+
+class PlantTwitterSqliteStore():
+
+    # schema version of the typed SENSORLOGS (migrate.py)
+    SCHEMA_VERSION_TYPED = 3
+    # schema version of ARCHIVE_BLOCKS (migrate.py)
+    SCHEMA_VERSION_ARCHIVE = 6
+
+    # parameters of an IN list: SQLITE_MAX_VARIABLE_NUMBER is 999 before 3.32.
+    SQL_PARAMS_MAX = 500
+
+    SQL_COLUMNS = "ORIGINATOR_ID, DEVICE_MODEL, TELEGRAM_TYPE, DB_0, " + \
+        "DB_1, DB_2, DB_3, DBM, TEMPERATURE, SOIL_MOISTURE, HUMIDITY, " + \
+        "CONTACT_SWITCH, ROCKER_SWITCH, " + \
+        "STRFTIME('%Y-%m-%d %H:%M:%S', RECEIVED_AT / 1000, 'unixepoch', 'localtime'), " + \
+        "RECEIVED_AT"
+    SQL_COLUMNS_TYPED = "ORIGINATOR_ID, DEVICE_MODEL_ID, TELEGRAM_TYPE, PAYLOAD, " + \
+        "DBM, TEMPERATURE, SOIL_MOISTURE, HUMIDITY, CONTACT_SWITCH, ROCKER_SWITCH, " + \
+        "STRFTIME('%Y-%m-%d %H:%M:%S', RECEIVED_AT / 1000, 'unixepoch', 'localtime'), " + \
+        "RECEIVED_AT, ID "
+
+    # same as PlantTwitterDatastore.ROW_INDEX_*
+    ROW_INDEX_DBM = 7
+    ROW_INDEX_TEMPERATURE = 8
+    ROW_INDEX_SOIL_MOISTURE = 9
+    ROW_INDEX_HUMIDITY = 10
+    ROW_INDEX_RECEIVED_AT = 14
+    ROW_INDEX_ID = 15
+
+    def __init__(self, logger, clock=None):
+        self.logger = logger
+        self.clock = PlantTwitterClock() if clock is None else clock
+
+        self.conn = None
+        self.schema_version = 0
+        # device model <-> DEVICE_MODELS.ID
+        self.device_model_ids = {}
+        self.device_model_names = {}
+        # the old rows moved by archive.py
+        self.archive = PlantTwitterArchiveStore(self.logger)
+
+    def openConnection(self, conn):
+        # the connection of PlantTwitterDatastore
+        self.conn = conn
+        self.schema_version = self.getSchemaVersion()
+
+    def closeConnection(self):
+        # the connection is closed by PlantTwitterDatastore.
+        self.conn = None
+
+    def insertRecord(self, *values):
+        if self.schema_version >= self.SCHEMA_VERSION_TYPED:
+            values = self.toTypedValues(values)
+        self.conn.execute(self.getInsertSql(), values)
+        self.conn.commit()
+
+        return True
+
+    def insertRecords(self, values_list):
+        # the rows in a transaction
+        try:
+            if self.schema_version >= self.SCHEMA_VERSION_TYPED:
+                values_list = [self.toTypedValues(v) for v in values_list]
+            self.conn.executemany(self.getInsertSql(), values_list)
+            self.conn.commit()
+        except (sqlite3.Error, ValueError):
+            self.conn.rollback()
+            raise
+
+        return True
+
+    def getInsertSql(self):
+        if self.schema_version >= self.SCHEMA_VERSION_TYPED:
+            return "INSERT INTO SENSORLOGS (ORIGINATOR_ID, DEVICE_MODEL_ID, " + \
+                "TELEGRAM_TYPE, PAYLOAD, DBM, TEMPERATURE, SOIL_MOISTURE, " + \
+                "HUMIDITY, CONTACT_SWITCH, ROCKER_SWITCH, RECEIVED_AT) " + \
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        return "INSERT INTO SENSORLOGS (ORIGINATOR_ID, DEVICE_MODEL, " + \
+            "TELEGRAM_TYPE, DB_0, DB_1, DB_2, DB_3, DBM, TEMPERATURE, " + \
+            "SOIL_MOISTURE, HUMIDITY, CONTACT_SWITCH, ROCKER_SWITCH, " + \
+            "RECEIVED_AT) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+    def selectRecord(self, originator_id, device_model, rowcount=60):
+        cur = self.conn.cursor()
+        cur.arraysize = rowcount
+        begin_at = self.getEpochMillis() - 60 * 60 * 1000
+
+        if self.schema_version >= self.SCHEMA_VERSION_TYPED:
+            device_model_id = self.getDeviceModelID(device_model)
+            if device_model_id is None:
+                return []
+            sql = "SELECT " + self.SQL_COLUMNS_TYPED + "FROM SENSORLOGS " + \
+                "WHERE ORIGINATOR_ID = ? AND DEVICE_MODEL_ID = ? AND RECEIVED_AT > ? " + \
+                "ORDER BY RECEIVED_AT DESC LIMIT ?"
+            params = (self.getOriginatorParam(originator_id),
+                      device_model_id, begin_at, rowcount)
+        else:
+            sql = "SELECT " + self.SQL_COLUMNS + " FROM SENSORLOGS " + \
+                "WHERE ORIGINATOR_ID = ? AND DEVICE_MODEL = ? AND RECEIVED_AT > ? " + \
+                "ORDER BY RECEIVED_AT DESC LIMIT ?"
+            params = (self.toOriginatorID(originator_id),
+                      device_model, begin_at, rowcount)
+
+        self.logger.debug("select values :{0}".format(sql))
+
+        try:
+            cur.execute(sql, params)
+            sensor_list = self.toRows(cur.fetchmany())
+            cur.close()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return ''
+
+        return sensor_list
+
+    def selectRecordsAfter(self, originator_id, device_model, last_id, rowcount=60):
+        begin_at = self.getEpochMillis() - 60 * 60 * 1000
+
+        if self.schema_version >= self.SCHEMA_VERSION_TYPED:
+            device_model_id = self.getDeviceModelID(device_model)
+            if device_model_id is None:
+                return []
+            sql = "SELECT " + self.SQL_COLUMNS_TYPED + "FROM SENSORLOGS " + \
+                "WHERE ORIGINATOR_ID = ? AND DEVICE_MODEL_ID = ? AND RECEIVED_AT > ? " + \
+                "AND ID > ? ORDER BY RECEIVED_AT DESC LIMIT ?"
+            params = (self.getOriginatorParam(originator_id),
+                      device_model_id, begin_at, last_id, rowcount)
+        else:
+            sql = "SELECT " + self.getColumnsSql() + "FROM SENSORLOGS " + \
+                "WHERE ORIGINATOR_ID = ? AND DEVICE_MODEL = ? AND RECEIVED_AT > ? " + \
+                "AND ID > ? ORDER BY RECEIVED_AT DESC LIMIT ?"
+            params = (self.toOriginatorID(originator_id),
+                      device_model, begin_at, last_id, rowcount)
+
+        try:
+            return self.toRows(self.conn.execute(sql, params).fetchall())
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+    def selectRecentRecords(self, devices, last_id=0, rowcount=60):
+        # a window function (ROW_NUMBER) of SQLite 3.25 or later
+        recent_rows = {}
+        if self.schema_version < self.SCHEMA_VERSION_TYPED or \
+                sqlite3.sqlite_version_info < (3, 25, 0):
+            for (originator_id, device_model) in devices:
+                recent_rows[originator_id] = self.selectRecordsAfter(
+                    originator_id, device_model, last_id, rowcount)
+            return recent_rows
+
+        begin_at = self.getEpochMillis() - 60 * 60 * 1000
+
+        # ORIGINATOR_ID, DEVICE_MODEL_ID -> originator_id
+        device_keys = {}
+        for (originator_id, device_model) in devices:
+            recent_rows[originator_id] = []
+            device_model_id = self.getDeviceModelID(device_model)
+            if device_model_id is not None:
+                device_keys[(self.getOriginatorParam(originator_id),
+                             device_model_id)] = originator_id
+
+        params = sorted(set(k[0] for k in device_keys))
+        for begin in range(0, len(params), self.SQL_PARAMS_MAX):
+            chunk = params[begin:begin + self.SQL_PARAMS_MAX]
+            sql = "SELECT " + self.SQL_COLUMNS_TYPED + "FROM (" + \
+                "SELECT *, ROW_NUMBER() OVER (PARTITION BY ORIGINATOR_ID, DEVICE_MODEL_ID " + \
+                "ORDER BY RECEIVED_AT DESC) AS DEVICE_ROW FROM SENSORLOGS " + \
+                "WHERE ORIGINATOR_ID IN (" + ", ".join("?" * len(chunk)) + ") " + \
+                "AND RECEIVED_AT > ? AND ID > ?) " + \
+                "WHERE DEVICE_ROW <= ? ORDER BY ORIGINATOR_ID, RECEIVED_AT DESC"
+
+            try:
+                rows = self.conn.execute(
+                    sql, tuple(chunk) + (begin_at, last_id, rowcount)).fetchall()
+            except sqlite3.Error as e:
+                self.logger.error(
+                    "sqlite3: Execute sql error:{0}".format(e.args[0]))
+                continue
+
+            for r in rows:
+                originator_id = device_keys.get((r[0], r[1]))
+                if originator_id is not None:
+                    recent_rows[originator_id].extend(self.toRows([r]))
+
+        return recent_rows
+
+    def iterRecords(self, originator_id=None, begin_at=0, end_at=None, chunk_rows=1000,
+                    archived=True):
+        if end_at is None:
+            end_at = self.getEpochMillis() + 1
+
+        if archived and self.hasArchive():
+            yield from self.archive.iterRecords(
+                self.conn, None if originator_id is None else self.toOriginatorID(originator_id),
+                begin_at, end_at)
+
+        columns = self.getColumnsSql() + "FROM SENSORLOGS "
+
+        if originator_id is not None:
+            # keyset (RECEIVED_AT, ID) on the index of the device
+            sql = "SELECT " + columns + \
+                "WHERE ORIGINATOR_ID = ? AND RECEIVED_AT >= ? AND RECEIVED_AT < ? " + \
+                "AND (RECEIVED_AT > ? OR ID > ?) " + \
+                "ORDER BY RECEIVED_AT, ID LIMIT ?"
+        else:
+            # keyset ID on the table
+            sql = "SELECT " + columns + \
+                "WHERE ID > ? AND RECEIVED_AT >= ? AND RECEIVED_AT < ? " + \
+                "ORDER BY ID LIMIT ?"
+
+        last_received_at = begin_at - 1
+        last_id = 0
+
+        while True:
+            if originator_id is not None:
+                params = (self.getOriginatorParam(originator_id),
+                          max(begin_at, last_received_at), end_at,
+                          last_received_at, last_id, chunk_rows)
+            else:
+                params = (last_id, begin_at, end_at, chunk_rows)
+
+            try:
+                rows = self.toRows(self.conn.execute(sql, params).fetchall())
+            except sqlite3.Error as e:
+                self.logger.error(
+                    "sqlite3: Execute sql error:{0}".format(e.args[0]))
+                return
+
+            for r in rows:
+                yield r
+
+            if len(rows) < chunk_rows:
+                return
+
+            last_received_at = rows[-1][self.ROW_INDEX_RECEIVED_AT]
+            last_id = rows[-1][self.ROW_INDEX_ID]
+
+    def iterColumns(self, originator_id, begin_at, end_at, chunk_rows):
+        if self.hasArchive():
+            rows = []
+            for r in self.archive.iterRecords(
+                    self.conn, self.toOriginatorID(originator_id), begin_at, end_at):
+                rows.append((r[self.ROW_INDEX_RECEIVED_AT],) +
+                            tuple(None if r[i] == '' else r[i]
+                                  for i in (self.ROW_INDEX_DBM, self.ROW_INDEX_TEMPERATURE,
+                                            self.ROW_INDEX_HUMIDITY,
+                                            self.ROW_INDEX_SOIL_MOISTURE)))
+                if len(rows) >= chunk_rows:
+                    yield tuple(list(c) for c in zip(*rows))
+                    rows = []
+            if rows:
+                yield tuple(list(c) for c in zip(*rows))
+
+        # the absent values are '' before the schema version 3.
+        sql = "SELECT RECEIVED_AT, DBM, NULLIF(TEMPERATURE, ''), NULLIF(HUMIDITY, ''), " + \
+            "NULLIF(SOIL_MOISTURE, ''), ID FROM SENSORLOGS " + \
+            "WHERE ORIGINATOR_ID = ? AND RECEIVED_AT >= ? AND RECEIVED_AT < ? " + \
+            "AND (RECEIVED_AT > ? OR ID > ?) " + \
+            "ORDER BY RECEIVED_AT, ID LIMIT ?"
+
+        last_received_at = begin_at - 1
+        last_id = 0
+
+        while True:
+            params = (self.getOriginatorParam(originator_id),
+                      max(begin_at, last_received_at), end_at,
+                      last_received_at, last_id, chunk_rows)
+
+            try:
+                rows = self.conn.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                self.logger.error(
+                    "sqlite3: Execute sql error:{0}".format(e.args[0]))
+                return
+
+            if rows:
+                yield tuple(list(c) for c in zip(*rows))[:5]
+
+            if len(rows) < chunk_rows:
+                return
+
+            last_received_at = rows[-1][0]
+            last_id = rows[-1][5]
+
+    def selectLatestRecord(self, originator_id):
+        sql = "SELECT " + self.getColumnsSql() + "FROM SENSORLOGS " + \
+            "WHERE ORIGINATOR_ID = ? ORDER BY RECEIVED_AT DESC LIMIT 1"
+
+        try:
+            rows = self.toRows(self.conn.execute(
+                sql, (self.getOriginatorParam(originator_id),)).fetchall())
+            if not rows and self.hasArchive():
+                return self.archive.selectLatestRecord(
+                    self.conn, self.toOriginatorID(originator_id))
+            return rows[0] if rows else None
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return None
+
+    def selectDownsampledRecords(self, originator_id, begin_at, end_at, step):
+        if self.hasArchive():
+            return self.selectDownsampledArchive(originator_id, begin_at, end_at, step)
+
+        sql = "SELECT (RECEIVED_AT / ?) * ?, COUNT(*), AVG(NULLIF(DBM, '')), " + \
+            "AVG(NULLIF(TEMPERATURE, '')), AVG(NULLIF(SOIL_MOISTURE, '')), " + \
+            "AVG(NULLIF(HUMIDITY, '')) FROM SENSORLOGS " + \
+            "WHERE ORIGINATOR_ID = ? AND RECEIVED_AT >= ? AND RECEIVED_AT < ? " + \
+            "GROUP BY RECEIVED_AT / ? ORDER BY 1"
+
+        try:
+            return self.conn.execute(sql, (step, step, self.getOriginatorParam(originator_id),
+                                           begin_at, end_at, step)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+    def selectDownsampledArchive(self, originator_id, begin_at, end_at, step):
+        # selectDownsampledRecords() of the rows and the archived rows
+        sql = "SELECT (RECEIVED_AT / ?) * ?, COUNT(*), " + \
+            "SUM(NULLIF(DBM, '')), COUNT(NULLIF(DBM, '')), " + \
+            "SUM(NULLIF(TEMPERATURE, '')), COUNT(NULLIF(TEMPERATURE, '')), " + \
+            "SUM(NULLIF(SOIL_MOISTURE, '')), COUNT(NULLIF(SOIL_MOISTURE, '')), " + \
+            "SUM(NULLIF(HUMIDITY, '')), COUNT(NULLIF(HUMIDITY, '')) FROM SENSORLOGS " + \
+            "WHERE ORIGINATOR_ID = ? AND RECEIVED_AT >= ? AND RECEIVED_AT < ? " + \
+            "GROUP BY RECEIVED_AT / ?"
+
+        try:
+            rows = self.conn.execute(sql, (step, step, self.getOriginatorParam(originator_id),
+                                           begin_at, end_at, step)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return []
+
+        # begin time -> [begin time, rows, [sum, count] of dBm, temperature,
+        # soil moisture, humidity]
+        steps = {}
+        for r in rows:
+            steps[r[0]] = [r[0], r[1]] + [[r[i] or 0, r[i + 1]] for i in range(2, 10, 2)]
+
+        for r in self.archive.iterRecords(
+                self.conn, self.toOriginatorID(originator_id), begin_at, end_at):
+            step_at = (r[self.ROW_INDEX_RECEIVED_AT] // step) * step
+            sums = steps.get(step_at)
+            if sums is None:
+                sums = steps[step_at] = [step_at, 0, [0, 0], [0, 0], [0, 0], [0, 0]]
+            sums[1] += 1
+            for (values, i) in zip(sums[2:], (self.ROW_INDEX_DBM, self.ROW_INDEX_TEMPERATURE,
+                                              self.ROW_INDEX_SOIL_MOISTURE,
+                                              self.ROW_INDEX_HUMIDITY)):
+                if r[i] != '':
+                    values[0] += r[i]
+                    values[1] += 1
+
+        return [(sums[0], sums[1]) + tuple(s / c if c > 0 else None for s, c in sums[2:])
+                for sums in (steps[k] for k in sorted(steps))]
+
+    def selectLastID(self):
+        try:
+            return self.conn.execute("SELECT MAX(ID) FROM SENSORLOGS").fetchone()[0]
+        except sqlite3.Error as e:
+            self.logger.error(
+                "sqlite3: Execute sql error:{0}".format(e.args[0]))
+            return None
+
+    def getDataVersion(self):
+        # the schema may be migrated by another connection.
+        self.schema_version = self.getSchemaVersion()
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def getSchemaVersion(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def hasArchive(self):
+        # ARCHIVE_BLOCKS of archive.py
+        return self.schema_version >= self.SCHEMA_VERSION_ARCHIVE
+
+    def getColumnsSql(self):
+        # columns of iterRecords() and selectLatestRecord()
+        if self.schema_version >= self.SCHEMA_VERSION_TYPED:
+            return self.SQL_COLUMNS_TYPED
+        return self.SQL_COLUMNS + ", ID "
+
+    def getDeviceModelID(self, device_model, create=False):
+        """Return DEVICE_MODELS.ID of the device model.
+
+        デバイスモデルのDEVICE_MODELS.IDを返します。createがTrueの場合、
+        登録されていないデバイスモデルを追加します。
+
+        Return DEVICE_MODELS.ID of the device model. If create is True, the
+        device model not registered yet is added.
+        """
+
+        if device_model not in self.device_model_ids:
+            if create:
+                self.conn.execute("INSERT OR IGNORE INTO DEVICE_MODELS " +
+                                  "(DEVICE_MODEL) VALUES (?)", (device_model,))
+            self.loadDeviceModels()
+        return self.device_model_ids.get(device_model)
+
+    def getDeviceModelName(self, device_model_id):
+        if device_model_id not in self.device_model_names:
+            self.loadDeviceModels()
+        return self.device_model_names.get(device_model_id, '')
+
+    def loadDeviceModels(self):
+        self.device_model_ids = dict(self.conn.execute(
+            "SELECT DEVICE_MODEL, ID FROM DEVICE_MODELS").fetchall())
+        self.device_model_names = {i: m for m, i in self.device_model_ids.items()}
+
+    def getOriginatorParam(self, originator_id):
+        # ORIGINATOR_ID is an integer in the typed schema.
+        originator_id = self.toOriginatorID(originator_id)
+        if self.schema_version >= self.SCHEMA_VERSION_TYPED:
+            return int(originator_id, 16)
+        return originator_id
+
+    def toTypedValues(self, values):
+        """Convert the values of insertRecord() to the typed schema.
+
+        insertRecord()の値を型付きのスキーマの値に変換します。
+
+        Convert the values of insertRecord() to the values of the typed schema.
+        """
+
+        (originator_id, device_model, telegram_type, db_0, db_1, db_2, db_3, dbm,
+         temperature, soil_moisture, humidity, contact, rocker, received_at) = values
+
+        payload = b''.join(binascii.unhexlify(d) for d in (db_0, db_1, db_2, db_3) if d != '')
+
+        return (self.getOriginatorParam(originator_id),
+                self.getDeviceModelID(device_model, create=True),
+                telegram_type or None, payload or None, dbm,
+                self.toNull(temperature), self.toNull(soil_moisture), self.toNull(humidity),
+                self.toNull(contact), self.toNull(rocker), received_at)
+
+    def toRows(self, rows):
+        """Convert the rows of the typed schema to the rows of selectRecord().
+
+        型付きのスキーマの行を、selectRecord()の行の形式に変換します。
+
+        Convert the rows of the typed schema to the form of the rows of
+        selectRecord().
+        """
+
+        if self.schema_version < self.SCHEMA_VERSION_TYPED:
+            return rows
+
+        converted = []
+        for r in rows:
+            payload = r[3] or b''
+            data_dl = [binascii.hexlify(payload[i:i + 1]) for i in range(len(payload))]
+            data_dl += [''] * (4 - len(data_dl))
+            converted.append(
+                (b'%08x' % r[0], self.getDeviceModelName(r[1]), r[2] or '') +
+                tuple(data_dl[:4]) +
+                tuple('' if v is None else v for v in r[4:10]) + r[10:])
+        return converted
+
+    def toNull(self, value):
+        return None if value == '' else value
+
+    def getEpochMillis(self):
+        return int(self.clock.time() * 1000)
+
+    def toOriginatorID(self, originator_id):
+        if isinstance(originator_id, str):
+            return originator_id.encode('utf-8')
+        return originator_id
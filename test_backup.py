@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Measure the commit latency of the receiver while a backup runs
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+一時ディレクトリに指定した行数のデータベースを作成して、receiver.py と同じ
+1行ずつのコミットを続けるスレッドのコミット時間(p50/p99/最大)を、
+バックアップなしの場合と、backup.py でバックアップ中の場合で比較する
+テストプログラムです。その後、スナップショットの検査と復元を行い、復元した
+データベースの行数がバックアップ開始時点以上であることを確認します。
+--journalでデータベースのジャーナルモード(wal/delete)を指定します。deleteの
+場合は書き込みでコピーが完了しないことがあり、その場合はコミット時間だけを
+確認します。(バックアップの失敗は想定どおりです)
+以下のコマンドを実行してください。
+
+$ python3 ./test_backup.py --rows 1000000 --journal wal
+
+This is the test program that creates a database of the rows in a temporary
+directory, and compares the commit time (p50/p99/max) of a thread that
+commits a row at a time like receiver.py, without a backup and while
+backup.py runs a backup. After that, the snapshot is verified and restored,
+and it is checked that the restored database has the rows at the start of
+the backup at least.
+--journal sets the journal mode of the database (wal/delete). In the delete
+mode the writes may keep the copy from completing, then only the commit
+time is checked. (The failure of the backup is expected)
+This test program works standalone. you can run as follows.
+
+$ python3 ./test_backup.py --rows 1000000 --journal wal
+
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+
+from config import cmConfig
+from logger import cmLogger
+from migrate import PlantTwitterMigration
+from datastore import PlantTwitterDatastore
+from backup import PlantTwitterBackup
+from simulate import SQL_CREATE_TABLE
+from test_scaling import SensorHistory, TEST_MODELS, TEST_ORIGINATOR_ID, TEST_LOAD_ROWS
+
+# seconds between the commits of the writer
+TEST_WRITE_INTERVAL = 0.01
+
+
+class CommitWriter():
+    """Writer thread that commits a row at a time like receiver.py."""
+
+    def __init__(self, logger, history):
+        self.logger = logger
+        self.history = history
+        self.commit_times = []
+        self.running = False
+        self.thread = None
+
+    def run(self):
+        data_store = PlantTwitterDatastore(self.logger)
+        data_store.openConnection()
+        while self.running:
+            values = self.history.nextValues()
+            begin_time = time.perf_counter()
+            data_store.insertRecord(*values)
+            self.commit_times.append(time.perf_counter() - begin_time)
+            time.sleep(TEST_WRITE_INTERVAL)
+        data_store.closeConnection()
+
+    def start(self):
+        self.commit_times = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.commit_times
+
+
+def printCommitTimes(name, commit_times):
+    commit_times = sorted(commit_times)
+    print("{0:<16} commits {1:6d}  p50 {2:7.3f} ms  p99 {3:7.3f} ms  max {4:7.3f} ms".format(
+        name, len(commit_times), commit_times[len(commit_times) // 2] * 1000,
+        commit_times[int(len(commit_times) * 0.99)] * 1000, commit_times[-1] * 1000))
+
+
+def countRows(file_name):
+    conn = sqlite3.connect(file_name)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM SENSORLOGS").fetchone()[0]
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Measure the commits during a backup.')
+    arg_parser.add_argument('--rows', type=int, default=1000000,
+                            help='rows of the database (default: 1000000)')
+    arg_parser.add_argument('--journal', choices=('wal', 'delete'), default='wal',
+                            help='journal mode of the database (default: wal)')
+    arg_parser.add_argument('--seconds', type=float, default=5,
+                            help='seconds of the commits without a backup (default: 5)')
+    args = arg_parser.parse_args()
+
+    # set logger handler: the record logs are not measured.
+    logger = cmLogger().getLogger()
+    logger.setLevel(logging.ERROR)
+
+    data_dir = tempfile.TemporaryDirectory()
+    config = cmConfig()
+    config.option_list['DEFAULT']['DATA_FILE_PATH'] = data_dir.name
+    config.option_list['Backup']['BACKUP_RETRY_SECONDS'] = '1'
+    db_file = data_dir.name + PlantTwitterDatastore.DATA_STORE_FILE
+
+    conn = sqlite3.connect(db_file)
+    conn.execute(SQL_CREATE_TABLE)
+    conn.close()
+    PlantTwitterMigration(logger).migrate()
+    if args.journal == 'wal':
+        PlantTwitterMigration(logger).setWalMode()
+
+    # the rows of the devices of the five models
+    devices = [(b'%08x' % (TEST_ORIGINATOR_ID + i), TEST_MODELS[i % len(TEST_MODELS)])
+               for i in range(10)]
+    history = SensorHistory(devices, int(time.time() * 1000) - 86400000 * 30, 60)
+    loader = PlantTwitterDatastore(logger)
+    loader.openConnection()
+    loader.conn.execute("PRAGMA synchronous = OFF")
+    for begin in range(0, args.rows, TEST_LOAD_ROWS):
+        loader.insertRecords([history.nextValues()
+                              for i in range(min(TEST_LOAD_ROWS, args.rows - begin))])
+    loader.closeConnection()
+    print("database: {0} rows, {1:.1f} MB, journal {2}".format(
+        args.rows, os.path.getsize(db_file) / 1024 / 1024, args.journal))
+
+    writer = CommitWriter(logger, history)
+    writer.start()
+    time.sleep(args.seconds)
+    printCommitTimes('no backup', writer.stop())
+
+    eo_backup = PlantTwitterBackup(logger)
+    writer.start()
+    begin_rows = countRows(db_file)
+    begin_time = time.perf_counter()
+    result = eo_backup.createSnapshot(datetime.datetime.now())
+    backup_time = time.perf_counter() - begin_time
+    printCommitTimes('during backup', writer.stop())
+
+    print("backup: {0} in {1:.1f} sec, steps {2}, restarts {3}, retries {4}, "
+          "max step {5:.3f} sec".format('Success' if result else 'Failure', backup_time,
+                                        eo_backup.steps, eo_backup.restarts,
+                                        eo_backup.retries, eo_backup.step_max))
+    if result is not True:
+        # the rollback journal: the copy never waits for the writer.
+        raise SystemExit(1 if args.journal == 'wal' else 0)
+
+    snapshot_file = eo_backup.findSnapshot('latest')
+    print("snapshot: {0} {1:.1f} MB".format(
+        os.path.basename(snapshot_file), os.path.getsize(snapshot_file) / 1024 / 1024))
+    print("verify: {0}".format(eo_backup.verifySnapshot(snapshot_file)))
+
+    end_rows = countRows(db_file)
+    print("restore: {0}".format(eo_backup.restoreSnapshot(
+        snapshot_file, datetime.datetime.now(), force=True)))
+    restored_rows = countRows(db_file)
+    print("rows: at the start {0}, restored {1}, at the end {2}".format(
+        begin_rows, restored_rows, end_rows))
+    if not begin_rows <= restored_rows <= end_rows:
+        print("restored rows are out of the backup")
+        raise SystemExit(1)
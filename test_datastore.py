@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the storage backends of the sensor data
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+センサーデータの保存先(sqlite, mmap)毎に、書き込みと期間の読み込みに
+かかる時間を計測するテストプログラムです。一時ディレクトリに1デバイス分の
+データを1分間隔で書き込み、ランダムな1時間と1日の期間を読み込みます。
+両方の保存先で読み込んだ行が一致することも確認します。
+以下のコマンドを実行してください。
+
+$ python3 ./test_datastore.py [record count]
+
+This is the test program that measures the time to write and to read time
+ranges of each storage backend (sqlite, mmap) of the sensor data. It writes
+the data of a device every minute to a temporary directory, and reads random
+ranges of an hour and a day. It also checks that the rows read from both
+backends are the same.
+This test program works standalone. you can run as follows.
+
+$ python3 ./test_datastore.py [record count]
+
+"""
+
+import sys
+import time
+import random
+import logging
+import sqlite3
+import tempfile
+
+from logger import cmLogger
+from datastore import PlantTwitterDatastore
+from mmapstore import PlantTwitterMmapStore
+
+TEST_ORIGINATOR_ID = b'040154f1'
+TEST_DEVICE_MODEL = 'STM431JS'
+
+# number of range reads of each size
+TEST_READ_COUNT = 200
+
+SQL_CREATE_TABLE = "CREATE TABLE SENSORLOGS (" + \
+    "ID INTEGER PRIMARY KEY AUTOINCREMENT, ORIGINATOR_ID TEXT, " + \
+    "DEVICE_MODEL TEXT, TELEGRAM_TYPE TEXT, DB_0 TEXT, DB_1 TEXT, " + \
+    "DB_2 TEXT, DB_3 TEXT, DBM INTEGER, TEMPERATURE INTEGER, " + \
+    "SOIL_MOISTURE INTEGER, HUMIDITY INTEGER, CONTACT_SWITCH TEXT, " + \
+    "ROCKER_SWITCH TEXT, " + \
+    "CREATE_AT TIMESTAMP DEFAULT (DATETIME('now','localtime')), " + \
+    "RECEIVED_AT INTEGER)"
+SQL_CREATE_INDEX = "CREATE INDEX IDX_SENSORLOGS_RECEIVED_AT " + \
+    "ON SENSORLOGS (ORIGINATOR_ID, RECEIVED_AT)"
+
+
+def createValues(count, end_at):
+    values = []
+    for i in range(count):
+        received_at = end_at - (count - i) * 60 * 1000
+        moisture = 100 + (i % 150)
+        values.append((TEST_ORIGINATOR_ID, TEST_DEVICE_MODEL, '4BS',
+                       b'00', b'%02x' % moisture, b'%02x' % (i % 256), b'08',
+                       -random.randint(40, 90), 40 - (i % 256) * 40 / 255,
+                       moisture, (i % 250) / 250 * 100, '', '', received_at))
+    return values
+
+
+def openDatastore(logger, data_path, backend):
+    data_store = PlantTwitterDatastore(logger)
+    data_store.db_file = data_path + PlantTwitterDatastore.DATA_STORE_FILE
+    data_store.backend = PlantTwitterDatastore.DATA_STORE_BACKENDS[backend](logger)
+    if backend == 'mmap':
+        data_store.backend.data_path = data_path + PlantTwitterMmapStore.DATA_STORE_DIRECTORY
+    else:
+        conn = sqlite3.connect(data_store.db_file)
+        conn.execute(SQL_CREATE_TABLE)
+        conn.execute(SQL_CREATE_INDEX)
+        conn.close()
+    data_store.openConnection()
+    return data_store
+
+
+def benchmark(logger, backend, values, ranges):
+    with tempfile.TemporaryDirectory() as data_path:
+        data_store = openDatastore(logger, data_path, backend)
+
+        begin_time = time.perf_counter()
+        for v in values:
+            data_store.insertRecord(*v)
+        write_time = time.perf_counter() - begin_time
+
+        results = []
+        read_times = []
+        for range_list in ranges:
+            rows = 0
+            begin_time = time.perf_counter()
+            for begin_at, end_at in range_list:
+                selected = list(data_store.iterRecords(TEST_ORIGINATOR_ID, begin_at, end_at))
+                rows += len(selected)
+                results.append([r[:PlantTwitterDatastore.ROW_INDEX_CREATE_AT] +
+                                (r[PlantTwitterDatastore.ROW_INDEX_RECEIVED_AT],)
+                                for r in selected])
+            read_times.append((time.perf_counter() - begin_time, rows))
+
+        data_store.closeConnection()
+
+    print("{0}: write {1} records: {2:.3f} sec ({3:.1f} usec/record)".format(
+        backend, len(values), write_time, write_time / len(values) * 1000000))
+    for (name, range_list), (read_time, rows) in zip((('hour', ranges[0]), ('day', ranges[1])),
+                                                     read_times):
+        print("{0}: read {1} ranges of a {2}: {3:.3f} sec ({4:.1f} usec/range, {5} rows)".format(
+            backend, len(range_list), name, read_time,
+            read_time / len(range_list) * 1000000, rows))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    # set logger handler: the record logs are not measured.
+    logger = cmLogger().getLogger()
+    logger.setLevel(logging.ERROR)
+
+    end_at = int(time.time() * 1000)
+    values = createValues(record_count, end_at)
+    begin_at = values[0][PlantTwitterDatastore.VALUES_INDEX_RECEIVED_AT]
+
+    ranges = []
+    for length in (60 * 60 * 1000, 24 * 60 * 60 * 1000):
+        range_list = []
+        for i in range(TEST_READ_COUNT):
+            range_begin = random.randint(begin_at, max(begin_at, end_at - length))
+            range_list.append((range_begin, range_begin + length))
+        ranges.append(range_list)
+
+    results = {}
+    for backend in PlantTwitterDatastore.DATA_STORE_BACKENDS:
+        results[backend] = benchmark(logger, backend, values, ranges)
+
+    if results['sqlite'] == results['mmap']:
+        print("rows: same")
+    else:
+        print("rows: different")
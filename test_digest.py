@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Test the daily statistics of the digest against a loop over the days
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+digest.py のベクトル演算の日毎の統計(値の数、最小、平均、最大)を、日毎に
+Pythonのループで計算した値と比較するテストプログラムです。データのない日が
+期間の途中と最後にある場合(デバイスが止まった場合や、期間が今日まである場合)
+も確認します。
+以下のコマンドを実行してください。
+
+$ python3 ./test_digest.py
+
+This is the test program that compares the daily statistics (count, minimum,
+average, maximum) of the vector operations of digest.py with the values
+computed by a Python loop over the days. The days without data in the middle
+and at the end of the range (a device has gone silent, or the range reaches
+today) are also tested.
+This test program works standalone. you can run as follows.
+
+$ python3 ./test_digest.py
+
+"""
+
+import math
+import random
+import datetime
+
+import numpy as np
+
+from logger import cmLogger
+from datastore import PlantTwitterDatastore
+from digest import PlantTwitterDigest
+
+TEST_DATE = datetime.datetime(2017, 6, 1)
+
+
+def reduceDaysByLoop(values, starts, ends):
+    result = []
+    for (start, end) in zip(starts, ends):
+        day = [v for v in values[start:end] if not math.isnan(v)]
+        if day:
+            result.append((len(day), min(day), sum(day) / len(day), max(day)))
+        else:
+            result.append((0, None, None, None))
+    return result
+
+
+def checkReduceDays(eo_digest, values, starts, ends):
+    values = np.array(values, dtype=np.float64)
+    reduced = eo_digest.reduceDays(values, np.array(starts), np.array(ends))
+    for i, expected in enumerate(reduceDaysByLoop(values, starts, ends)):
+        actual = [None if v != v else v.item() for v in (r[i] for r in reduced)]
+        if expected[0] == 0:
+            assert actual[0] == 0 and actual[1:] == [None, None, None], (i, actual)
+        else:
+            assert actual[0] == expected[0] and actual[1] == expected[1] and \
+                abs(actual[2] - expected[2]) < 1e-9 and actual[3] == expected[3], \
+                (i, actual, expected)
+
+
+def createColumns(bounds, silent_days):
+    # a value every 10 minutes except the silent days, NaN at random
+    received_at = []
+    for day in range(len(bounds) - 1):
+        if day not in silent_days:
+            received_at.extend(range(int(bounds[day]), int(bounds[day + 1]), 600000))
+    columns = [np.array(received_at, dtype=np.int64)]
+    for i in range(1, 5):
+        columns.append(np.array([random.uniform(-10, 40) if random.random() < 0.9 else np.nan
+                                 for t in received_at], dtype=np.float64))
+    return columns
+
+
+if __name__ == '__main__':
+
+    logger = cmLogger().getLogger()
+    eo_digest = PlantTwitterDigest(logger)
+
+    # the last day with the data, and an empty day after it
+    checkReduceDays(eo_digest, [1., 2., 9.], [0, 3], [3, 3])
+    checkReduceDays(eo_digest, [9., 1., 2.], [0, 3], [3, 3])
+    checkReduceDays(eo_digest, [np.nan, 5., np.nan], [0, 1, 3, 3], [1, 3, 3, 3])
+    checkReduceDays(eo_digest, [], [0, 0], [0, 0])
+    print("reduceDays: ok")
+
+    # 7 days: silent in the middle and at the end
+    bounds = eo_digest.getDayBounds(TEST_DATE, 7)
+    for silent_days in ((), (2,), (5, 6), (0, 3, 6), tuple(range(7))):
+        columns = createColumns(bounds, silent_days)
+        received_at = columns[PlantTwitterDatastore.COLUMN_INDEX_RECEIVED_AT]
+        starts = np.searchsorted(received_at, bounds[:-1])
+        ends = np.searchsorted(received_at, bounds[1:])
+        stats = eo_digest.computeDigests(columns, bounds, [])
+
+        for name, index in (('temperature', PlantTwitterDatastore.COLUMN_INDEX_TEMPERATURE),
+                            ('dbm', PlantTwitterDatastore.COLUMN_INDEX_DBM)):
+            checkReduceDays(eo_digest, columns[index], starts, ends)
+            for day, expected in enumerate(reduceDaysByLoop(columns[index], starts, ends)):
+                if expected[0]:
+                    assert stats[name + '_min'][day] == expected[1], (name, day)
+                    assert stats[name + '_max'][day] == expected[3], (name, day)
+                else:
+                    assert np.isnan(stats[name + '_max'][day]), (name, day)
+        print("computeDigests: silent days {0}: ok".format(list(silent_days)))
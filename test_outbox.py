@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""Test tweet delivery with a local stub of the Twitter API
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+ローカルで起動したTwitter APIのスタブサーバーに対して、OUTBOXに登録した
+メッセージを送信するテストプログラムです。スタブサーバーは一定の割合で
+エラー(503)を返すので、再送の動作も確認できます。送信にかかった時間と
+スループットを表示します。
+以下のコマンドを実行してください。
+
+$ python3 ./test_outbox.py [message count]
+
+This is the test program that sends the messages queued in the OUTBOX to a
+local stub server of the Twitter API. The stub server returns an error (503)
+at a fixed rate, so the retries are also tested. The elapsed time and the
+throughput of the delivery are displayed.
+This test program works standalone. you can run as follows.
+
+$ python3 ./test_outbox.py [message count]
+
+"""
+
+import sys
+import json
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+from twitter import Twitter, OAuth
+
+from logger import cmLogger
+from outbox import PlantTwitterOutbox
+from outbox import PlantTwitterTokenBucket
+from tweet import PlantTwitterTweet
+
+# stub server returns 503 every STUB_ERROR_INTERVAL requests
+STUB_ERROR_INTERVAL = 10
+
+
+class StubTwitterHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    requests = 0
+    statuses = set()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = parse_qs(self.rfile.read(length).decode('utf-8'))
+        status = body.get('status', [''])[0]
+
+        StubTwitterHandler.requests += 1
+
+        if StubTwitterHandler.requests % STUB_ERROR_INTERVAL == 0:
+            self.sendJson(503, {'errors': [{'code': 130, 'message': 'Over capacity'}]})
+        elif status in StubTwitterHandler.statuses:
+            self.sendJson(403, {'errors': [{'code': 187, 'message': 'Status is a duplicate.'}]})
+        else:
+            StubTwitterHandler.statuses.add(status)
+            self.sendJson(200, {'id': StubTwitterHandler.requests, 'text': status})
+
+    def sendJson(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    # set logger handler
+    logger = cmLogger().getLogger()
+    logger.info("--- start: {0} ----".format(__file__))
+
+    # start stub server
+    stub_server = HTTPServer(('127.0.0.1', 0), StubTwitterHandler)
+    stub_thread = threading.Thread(target=stub_server.serve_forever)
+    stub_thread.setDaemon(True)
+    stub_thread.start()
+    stub_domain = '127.0.0.1:{0}'.format(stub_server.server_port)
+
+    # connect to the stub server without the rate limit
+    eo_tweet = PlantTwitterTweet(logger)
+    eo_tweet.twitter = Twitter(auth=OAuth('token', 'secret', 'key', 'secret'),
+                               domain=stub_domain, secure=False)
+    eo_tweet.token_bucket = PlantTwitterTokenBucket(1000000, 1000000)
+
+    # queue test messages
+    outbox = PlantTwitterOutbox(logger)
+    outbox.backoff = 0
+    outbox.openConnection()
+    run_key = time.time()
+    for i in range(message_count):
+        outbox.enqueueMessage("test message {0} {1}".format(run_key, i))
+
+    # send messages
+    begin_time = time.perf_counter()
+    while outbox.countPending() > 0:
+        eo_tweet.deliverPending(outbox)
+    elapsed = time.perf_counter() - begin_time
+    outbox.closeConnection()
+
+    print("stub server: {0}".format(stub_domain))
+    print("messages: {0} requests: {1}".format(
+        message_count, StubTwitterHandler.requests))
+    print("elapsed: {0:.3f} sec throughput: {1:.1f} msg/sec".format(
+        elapsed, message_count / elapsed))
+
+    stub_server.shutdown()
+
+    logger.info("--- end: {0} ----".format(__file__))
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+"""Measure the datastore and message paths on large databases
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+5つのデバイスモデル(STM431JS, STM431J, STM431JH, PTM210J, STM429J)の
+センサーデータの履歴を合成して、データベースを指定した行数まで順に大きく
+しながら、各サイズで読み込み、書き込み、メッセージ作成の処理時間の
+p50/p99を計測するテストプログラムです。保持期間(archive.py)やインデックスの
+設定を決めるために使います。
+気温は1日と1年の周期、湿度は気温の逆、土壌水分量は水やりの周期(約2日)で
+変化します。PTM210Jはランダムな時刻に押され、STM429Jは朝と夕方に開きます。
+時計はPlantTwitterSimulatedClockで、最後の行の時刻を現在時刻にします。
+データベースは一時ディレクトリ(--pathを指定した場合はそのディレクトリ)に
+作成します。
+以下のコマンドを実行してください。
+
+$ python3 ./test_scaling.py --rows 1000000,10000000,100000000 --devices 30
+
+This is the test program that synthesizes the sensor data histories of the
+five device models (STM431JS, STM431J, STM431JH, PTM210J, STM429J), grows the
+database to each number of rows in turn, and measures p50/p99 of the time of
+the read, the insert and the message paths at each size. Use it to choose
+the retention (archive.py) and the index settings.
+The temperature has a day and a year cycle, the humidity is the inverse of
+the temperature, and the soil moisture follows the watering cycle (about 2
+days). PTM210J is pressed at random times, and STM429J opens in the morning
+and the evening.
+The clock is PlantTwitterSimulatedClock, and the time of the last row is the
+current time.
+The database is created in a temporary directory (or the directory of
+--path).
+This test program works standalone. you can run as follows.
+
+$ python3 ./test_scaling.py --rows 1000000,10000000,100000000 --devices 30
+
+"""
+
+import os
+import math
+import time
+import heapq
+import random
+import logging
+import sqlite3
+import argparse
+import datetime
+import tempfile
+
+from config import cmConfig
+from logger import cmLogger
+from clock import PlantTwitterSimulatedClock
+from migrate import PlantTwitterMigration
+from datastore import PlantTwitterDatastore
+from message import PlantTwitterMessage
+from simulate import SQL_CREATE_TABLE
+
+TEST_MODELS = ('STM431JS', 'STM431J', 'STM431JH', 'PTM210J', 'STM429J')
+TEST_ORIGINATOR_ID = 0x04200000
+
+# the history begins at it (local time)
+TEST_BEGIN = datetime.datetime(2015, 1, 1)
+
+# rows of a transaction of the loader
+TEST_LOAD_ROWS = 20000
+
+
+class SensorHistory():
+    """Generator of the synthetic sensor data of the devices.
+
+    デバイス毎の次の受信時刻の最小ヒープから、受信時刻の順に
+    insertRecord()の値を返します。水やりのイベントはwatering_eventsに
+    追加します。
+
+    Return the values of insertRecord() in the order of the receive time
+    from the min-heap of the next receive time of each device. The watering
+    events are added to watering_events.
+    """
+
+    # hours between watering
+    WATERING_HOURS = 48
+    # seconds of a heartbeat of STM429J, mean seconds between presses of PTM210J
+    CONTACT_INTERVAL = 900
+    ROCKER_INTERVAL = 7200
+
+    def __init__(self, devices, begin_at, interval):
+        self.devices = devices
+        self.interval = interval * 1000
+        self.watering_events = []
+
+        # (next receive time, index of the device)
+        self.heap = [(begin_at + random.randint(0, self.interval), i)
+                     for i in range(len(devices))]
+        heapq.heapify(self.heap)
+        # index -> the soil moisture of the last row, the next watering time
+        self.soil_moisture = {}
+        self.watering_at = {}
+
+    def getTemperature(self, at, i):
+        hours = at / 3600000
+        season = 8 * math.sin((hours / 24 / 365.25 - 0.3) * 2 * math.pi)
+        day = 6 * math.sin((hours % 24 - 9) / 24 * 2 * math.pi)
+        return round(18 + season + day + (i % 5) - 2 + random.gauss(0, 0.3), 2)
+
+    def getSoilMoisture(self, at, i):
+        # dries up slowly, and watering rises it.
+        watering_at = self.watering_at.setdefault(
+            i, at + random.randint(1, self.WATERING_HOURS * 3600000))
+        soil_moisture = self.soil_moisture.get(i, 200)
+        if at >= watering_at:
+            soil_moisture = random.randint(190, 220)
+            self.watering_events.append((self.devices[i][0], soil_moisture,
+                                         self.soil_moisture.get(i, 200), at))
+            self.watering_at[i] = at + random.randint(
+                self.WATERING_HOURS * 3600000 // 2, self.WATERING_HOURS * 3600000 * 3 // 2)
+        elif random.random() < 0.3:
+            soil_moisture = max(40, soil_moisture - 1)
+        self.soil_moisture[i] = soil_moisture
+        return soil_moisture
+
+    def createValues(self, at, i):
+        (b_sensor_id, device_model) = self.devices[i]
+        dbm = -random.randint(45, 90)
+
+        if device_model == 'PTM210J':
+            return ((b_sensor_id, device_model, 'RPS', b'30', '', '', '', dbm,
+                     '', '', '', '', random.choice(('BI', 'BO', 'AI', 'AO')), at),
+                    at + int(random.expovariate(1 / self.ROCKER_INTERVAL) * 1000) + 1)
+
+        if device_model == 'STM429J':
+            hour = time.localtime(at // 1000).tm_hour
+            contact = 'open' if hour in (7, 18) and random.random() < 0.5 else 'closed'
+            return ((b_sensor_id, device_model, '1BS', b'09' if contact == 'closed' else b'08',
+                     '', '', '', dbm, '', '', '', contact, '', at),
+                    at + self.CONTACT_INTERVAL * 1000)
+
+        temperature = self.getTemperature(at, i)
+        soil_moisture = ''
+        humidity = ''
+        if device_model == 'STM431JS':
+            soil_moisture = self.getSoilMoisture(at, i)
+        elif device_model == 'STM431JH':
+            humidity = int(min(100, max(10, 80 - 1.5 * temperature + random.gauss(0, 2))))
+        return ((b_sensor_id, device_model, '4BS', b'00', b'%02x' % (soil_moisture or 0),
+                 b'%02x' % int(max(0, min(255, 255 - temperature * 255 / 40))), b'08',
+                 dbm, temperature, soil_moisture, humidity, '', '', at),
+                at + self.interval + random.randint(-2000, 2000))
+
+    def nextValues(self):
+        (at, i) = self.heap[0]
+        (values, next_at) = self.createValues(at, i)
+        heapq.heapreplace(self.heap, (next_at, i))
+        return values
+
+
+def getPercentile(samples, percentile):
+    samples = sorted(samples)
+    return samples[int(round(percentile / 100 * (len(samples) - 1)))]
+
+
+def measurePath(name, samples, function):
+    times = []
+    for i in range(samples):
+        begin_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - begin_time)
+    print("  {0:<22} p50 {1:9.3f} ms  p99 {2:9.3f} ms".format(
+        name, getPercentile(times, 50) * 1000, getPercentile(times, 99) * 1000))
+
+
+def measurePaths(logger, clock, devices, samples):
+    sensors = [d for d in devices if d[1] in PlantTwitterMessage.SUPPORTED_DEVICES]
+    begin_at = int(time.mktime(TEST_BEGIN.timetuple()) * 1000)
+    now_at = int(clock.time() * 1000)
+
+    data_store = PlantTwitterDatastore(logger, clock)
+    data_store.openConnection()
+
+    measurePath('selectRecord', samples, lambda: data_store.selectRecord(*random.choice(sensors)))
+    measurePath('selectRecentRecords', samples, lambda: data_store.selectRecentRecords(
+        [(i.decode('utf-8'), m) for (i, m) in sensors]))
+    measurePath('selectLatestRecord', samples,
+                lambda: data_store.selectLatestRecord(random.choice(devices)[0]))
+    measurePath('selectWateringEvent', samples,
+                lambda: data_store.selectWateringEvent(random.choice(sensors)[0]))
+
+    def iterDay():
+        day_at = random.randint(begin_at, max(begin_at, now_at - 86400000))
+        list(data_store.iterRecords(random.choice(devices)[0], day_at, day_at + 86400000))
+    measurePath('iterRecords (a day)', samples, iterDay)
+
+    # the insert of the register: a commit of each row
+    history = SensorHistory(devices, now_at, 60)
+    measurePath('insertRecord', samples, lambda: data_store.insertRecord(*history.nextValues()))
+
+    data_store.closeConnection()
+
+    # the message paths without the cache of the recent rows
+    measurePath('createMessage', samples, lambda: PlantTwitterMessage(
+        logger, clock=clock).createMessage(*[(i.decode('utf-8'), m)
+                                             for (i, m) in [random.choice(sensors)]][0]))
+    measurePath('readDevices (a pass)', max(1, samples // 10), lambda: PlantTwitterMessage(
+        logger, clock=clock).readDevices([(i.decode('utf-8'), m) for (i, m) in sensors]))
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Measure the paths on large databases.')
+    arg_parser.add_argument('--rows', default='1000000',
+                            help='rows of each size, comma separated (default: 1000000)')
+    arg_parser.add_argument('--devices', type=int, default=30,
+                            help='devices of the five models in turn (default: 30)')
+    arg_parser.add_argument('--interval', type=int, default=60,
+                            help='seconds between the sensor data (default: 60)')
+    arg_parser.add_argument('--samples', type=int, default=200,
+                            help='measurements of each path (default: 200)')
+    arg_parser.add_argument('--path', help='directory of the database (default: temporary)')
+    args = arg_parser.parse_args()
+
+    # set logger handler: the record logs are not measured.
+    logger = cmLogger().getLogger()
+    logger.setLevel(logging.ERROR)
+
+    if args.path:
+        data_path = args.path
+    else:
+        data_dir = tempfile.TemporaryDirectory()
+        data_path = data_dir.name
+
+    config = cmConfig()
+    config.option_list['DEFAULT']['DATA_FILE_PATH'] = data_path
+    db_file = data_path + PlantTwitterDatastore.DATA_STORE_FILE
+    if os.path.exists(db_file):
+        print("database exists:{0}".format(db_file))
+        raise SystemExit(1)
+
+    conn = sqlite3.connect(db_file)
+    conn.execute(SQL_CREATE_TABLE)
+    conn.close()
+    PlantTwitterMigration(logger).migrate()
+
+    # devices of the five models
+    config.device_list.clear()
+    devices = []
+    for i in range(args.devices):
+        devices.append((b'%08x' % (TEST_ORIGINATOR_ID + i), TEST_MODELS[i % len(TEST_MODELS)]))
+        config.device_list[devices[-1][0]] = devices[-1][1]
+
+    begin_at = int(time.mktime(TEST_BEGIN.timetuple()) * 1000)
+    history = SensorHistory(devices, begin_at, args.interval)
+    clock = PlantTwitterSimulatedClock(begin_at / 1000)
+
+    # the loader does not wait for the disk.
+    loader = PlantTwitterDatastore(logger, clock)
+    loader.openConnection()
+    loader.conn.execute("PRAGMA synchronous = OFF")
+
+    rows = 0
+    for size in [int(s) for s in args.rows.split(',')]:
+        (begin_time, begin_rows) = (time.perf_counter(), rows)
+        while rows < size:
+            values_list = [history.nextValues() for i in range(min(TEST_LOAD_ROWS, size - rows))]
+            loader.insertRecords(values_list)
+            for event in history.watering_events:
+                loader.insertWateringEvent(*event)
+            history.watering_events = []
+            rows += len(values_list)
+            last_at = values_list[-1][PlantTwitterDatastore.VALUES_INDEX_RECEIVED_AT]
+        load_time = time.perf_counter() - begin_time
+
+        # now is just after the last row.
+        clock.now = last_at / 1000 + 1
+        print("{0} rows: {1:.1f} days, {2:.1f} MB, loaded in {3:.1f} sec ({4:.0f} rows/sec)".format(
+            rows, (last_at - begin_at) / 86400000, os.path.getsize(db_file) / 1024 / 1024,
+            load_time, (rows - begin_rows) / max(load_time, 1e-9)))
+        measurePaths(logger, clock, devices, args.samples)
+
+    loader.closeConnection()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""Test the output sinks with local stand-ins of MQTT and InfluxDB
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+ローカルで起動したMQTTブローカーのスタブ(CONNECTとPUBLISHだけ)と
+InfluxDBのUDPのスタブに、全てのシンク(csv, jsonl, influx, mqtt)から
+センサーデータを送信するテストプログラムです。ファイルは一時ディレクトリに
+書き込みます。各シンクが受け取った件数と、putReading()にかかった時間を
+表示します。MQTTのスタブは途中で読み込みを止めるので、遅いシンクの値だけが
+破棄されて、受信側が待たないことも確認できます。
+以下のコマンドを実行してください。
+
+$ python3 ./test_sinks.py [reading count]
+
+This is the test program that sends the sensor data from all sinks (csv,
+jsonl, influx, mqtt) to a local stub of an MQTT broker (CONNECT and PUBLISH
+only) and a stub of the UDP of InfluxDB. The files are written to a
+temporary directory. The readings received by each sink and the time of
+putReading() are displayed. The MQTT stub stops reading on the way, so it is
+also checked that only the readings of the slow sink are dropped and the
+receiver does not wait.
+This test program works standalone. you can run as follows.
+
+$ python3 ./test_sinks.py [reading count]
+
+"""
+
+import sys
+import json
+import time
+import socket
+import logging
+import tempfile
+import threading
+import socketserver
+
+from config import cmConfig
+from logger import cmLogger
+from metrics import cmMetrics
+from sinks import PlantTwitterSinks
+
+TEST_ORIGINATOR_ID = b'040154f1'
+
+# the MQTT stub stops reading after the readings
+STUB_STALL_AFTER = 1000
+
+
+class StubMqttHandler(socketserver.BaseRequestHandler):
+
+    publishes = 0
+
+    def readExactly(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def handle(self):
+        try:
+            while True:
+                packet_type = self.readExactly(1)[0] & 0xf0
+                (length, multiplier) = (0, 1)
+                while True:
+                    digit = self.readExactly(1)[0]
+                    length += (digit & 0x7f) * multiplier
+                    multiplier *= 128
+                    if digit & 0x80 == 0:
+                        break
+                body = self.readExactly(length)
+
+                if packet_type == 0x10:
+                    # CONNACK: accepted
+                    self.request.sendall(b'\x20\x02\x00\x00')
+                elif packet_type == 0x30:
+                    topic_length = int.from_bytes(body[:2], 'big')
+                    json.loads(body[2 + topic_length:].decode('utf-8'))
+                    StubMqttHandler.publishes += 1
+                    # a slow broker: the socket buffer fills up.
+                    if StubMqttHandler.publishes == STUB_STALL_AFTER:
+                        time.sleep(3600)
+        except EOFError:
+            pass
+
+
+def createValues(i, received_at):
+    return (TEST_ORIGINATOR_ID, 'STM431JS', '4BS', b'00', b'%02x' % (i % 256), b'80', b'08',
+            -60, 20.0 + (i % 100) / 10, i % 256, '', '', '', received_at)
+
+
+def countLines(file_name):
+    with open(file_name, encoding='utf-8') as f:
+        return sum(1 for line in f)
+
+
+if __name__ == '__main__':
+
+    reading_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    # set logger handler: the record logs are not measured.
+    logger = cmLogger().getLogger()
+    logger.setLevel(logging.ERROR)
+
+    # start stub servers
+    mqtt_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubMqttHandler)
+    mqtt_server.daemon_threads = True
+    mqtt_thread = threading.Thread(target=mqtt_server.serve_forever)
+    mqtt_thread.daemon = True
+    mqtt_thread.start()
+
+    influx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    influx_sock.bind(('127.0.0.1', 0))
+    influx_sock.settimeout(1)
+    influx_lines = []
+
+    def readInflux():
+        while True:
+            try:
+                influx_lines.extend(influx_sock.recv(65536).decode('utf-8').splitlines())
+            except socket.timeout:
+                return
+
+    influx_thread = threading.Thread(target=readInflux)
+    influx_thread.daemon = True
+    influx_thread.start()
+
+    # all sinks to the stubs and a temporary directory
+    data_dir = tempfile.TemporaryDirectory()
+    option_list = cmConfig().option_list
+    option_list['DEFAULT']['DATA_FILE_PATH'] = data_dir.name
+    option_list['Sinks']['SINK_LIST'] = 'csv, jsonl, influx, mqtt'
+    option_list['Sinks']['SINK_INFLUX_PORT'] = str(influx_sock.getsockname()[1])
+    option_list['Sinks']['SINK_MQTT_PORT'] = str(mqtt_server.server_address[1])
+
+    eo_sinks = PlantTwitterSinks(logger)
+
+    # put readings at the rate of the receiver
+    put_times = []
+    received_at = int(time.time() * 1000)
+    for i in range(reading_count):
+        begin_time = time.perf_counter()
+        eo_sinks.putReading(createValues(i, received_at + i))
+        put_times.append(time.perf_counter() - begin_time)
+        if i % 100 == 0:
+            time.sleep(0.001)
+
+    # wait for the workers except the stalled sink
+    for sink in eo_sinks.sinks:
+        if sink.name != 'mqtt':
+            while sink.queue.qsize() > 0:
+                time.sleep(0.01)
+    time.sleep(0.5)
+    influx_thread.join()
+
+    print("readings: {0}".format(reading_count))
+    print("putReading: max {0:.1f} usec, average {1:.1f} usec".format(
+        max(put_times) * 1000000, sum(put_times) / len(put_times) * 1000000))
+    csv_name = data_dir.name + '/sinks/readings.csv'
+    print("csv: {0} rows".format(countLines(csv_name) - 1))
+    print("jsonl: {0} rows".format(countLines(data_dir.name + '/sinks/readings.jsonl')))
+    print("influx: {0} lines".format(len(influx_lines)))
+    print("mqtt: {0} publishes (stalled after {1})".format(
+        StubMqttHandler.publishes, STUB_STALL_AFTER))
+
+    print()
+    for line in cmMetrics().render().splitlines():
+        if line.startswith('plant_twitter_sink_') and '_bucket' not in line:
+            print(line)
+
+    mqtt_server.shutdown()
@@ -78,5 +78,6 @@ if __name__ == '__main__':
 
     # tweet message
     eo_tweet.tweetMessage()
+    eo_tweet.deliverPending()
 
     logger.info("--- end: {0} ----".format(__file__))
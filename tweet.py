@@ -20,6 +20,15 @@ Twitterのデベロッパーサイト https://dev.twitter.com/ で作成して
     TWITTER_CONSUMER_KEY : Consumer Key (API Key)
     TWITTER_CONSUMER_SECRET : Consumer Secret (API Secret)
 
+作成したメッセージはoutboxモジュールの'OUTBOX'テーブルに保存され、
+deliverMessages()のスレッドが送信します。Twitterクライアントは一つだけ作成して
+使い回します。送信間隔はTWEET_RATE_LIMIT, TWEET_RATE_WINDOW, TWEET_RATE_BURST、
+再送はTWEET_RETRY_MAX, TWEET_RETRY_BACKOFF, TWEET_RETRY_BACKOFF_MAXで設定します。
+送信済みのメッセージはTWEET_OUTBOX_RETENTION_DAYS日後に削除します。
+メッセージを作成する時刻と水やりの状態はデバイス毎にschedulerモジュールで
+管理します。時間帯はTWEET_HOURS_BEGIN, TWEET_HOURS_END、間隔は
+TWEET_INTERVAL_MINUTESで設定します。
+
 
 Create a message from the stored sensor data, and tweet it on Twitter.
 This application works standalone. you can run as follows.
@@ -37,6 +46,16 @@ and write them to the following the config.ini file.
     TWITTER_CONSUMER_KEY : Consumer Key (API Key)
     TWITTER_CONSUMER_SECRET : Consumer Secret (API Secret)
 
+The created messages are stored in the 'OUTBOX' table of the outbox module,
+and the deliverMessages() thread sends them. One Twitter client is created and
+reused. The sending rate is set by TWEET_RATE_LIMIT, TWEET_RATE_WINDOW and
+TWEET_RATE_BURST, and the retries by TWEET_RETRY_MAX, TWEET_RETRY_BACKOFF and
+TWEET_RETRY_BACKOFF_MAX. The sent messages are deleted after
+TWEET_OUTBOX_RETENTION_DAYS days.
+The time to create a message and the watering state are kept for each
+device by the scheduler module. The hours are set by TWEET_HOURS_BEGIN and
+TWEET_HOURS_END, and the interval by TWEET_INTERVAL_MINUTES.
+
 """
 
 
@@ -44,26 +63,59 @@ import sys
 import traceback
 import time
 import datetime
+import threading
 
-from twitter import Twitter, OAuth
+from twitter import Twitter, OAuth, TwitterHTTPError
 
 from config import cmConfig
 from logger import cmLogger
 from message import PlantTwitterMessage
+from outbox import PlantTwitterOutbox
+from outbox import PlantTwitterTokenBucket
+from metrics import cmMetrics
+from clock import PlantTwitterClock
+from metrics import cmMetricsServer
+from profiler import PlantTwitterProfiler
+from latency import PlantTwitterFrameTracer
+from scheduler import PlantTwitterTweetScheduler
+from datastore import PlantTwitterDatastore
 
 
 class PlantTwitterTweet():
 
-    def __init__(self, logger):
+    # Twitter API error code: Status is a duplicate.
+    TWITTER_ERROR_DUPLICATE = 187
+
+    # seconds to try a device again, if no message is created.
+    TWEET_RETRY_SECONDS = 60
+    # milliseconds of the watering events read again: committed late.
+    WATERING_CHECK_MARGIN = 60 * 1000
+    # seconds between the prunes of the sent messages in the outbox.
+    OUTBOX_PRUNE_SECONDS = 3600
+
+    def __init__(self, logger, readings=None, clock=None):
         self.logger = logger
 
         self.config = cmConfig()
 
-        # Set next tweet time.
-        self.next_datetime = datetime.datetime.today() - datetime.timedelta(minutes=20)
-
-        # Tweet a message quickly, if watering.
-        self.state_watering = False
+        # current time and waiting: PlantTwitterSimulatedClock of simulate.py
+        self.clock = PlantTwitterClock() if clock is None else clock
+
+        # shared state of daemon.py: PlantTwitterReadings
+        self.readings = readings
+        # reuse it for the cache of the recent rows.
+        self.message = PlantTwitterMessage(self.logger, self.readings, self.clock)
+
+        # Tweet time and watering state of each device.
+        self.scheduler = PlantTwitterTweetScheduler(self.logger, self.clock.time())
+        self.tweet_interval = int(self.config.option_list[
+            'Twitter']['TWEET_INTERVAL_MINUTES']) * 60
+        # originator id -> end of the waiting time (epoch seconds)
+        self.cooldowns = {}
+        # originator id -> True: Tweet a message quickly, if watering.
+        self.state_watering = {}
+        # the watering events are read after it (epoch milliseconds)
+        self.watering_checked_at = int(self.clock.time() * 1000)
 
         # set twitter.com OAuth key
         self.access_token = self.config.option_list[
@@ -81,80 +133,292 @@ class PlantTwitterTweet():
         else:
             self.clock_check = False
 
+        # Create instance of twitter, and reuse it for every message.
+        api_domain = self.config.option_list['Twitter']['TWITTER_API_DOMAIN']
+        api_secure = self.config.option_list[
+            'Twitter']['TWITTER_API_SECURE'] == 'True'
+        self.twitter = Twitter(auth=OAuth(
+            self.access_token, self.access_secret, self.consumer_key, self.consumer_secret),
+            domain=api_domain, secure=api_secure)
+
+        # Tweet rate limit: TWEET_RATE_LIMIT tweets per TWEET_RATE_WINDOW seconds.
+        rate_limit = int(self.config.option_list['Twitter']['TWEET_RATE_LIMIT'])
+        rate_window = int(self.config.option_list[
+            'Twitter']['TWEET_RATE_WINDOW'])
+        rate_burst = int(self.config.option_list['Twitter']['TWEET_RATE_BURST'])
+        self.token_bucket = PlantTwitterTokenBucket(
+            rate_limit / rate_window, rate_burst, self.clock)
+
+        # Seconds to wait, if the API responds rate limit exceeded.
+        self.retry_after = 0
+        self.last_error = ''
+
+        self.outbox = PlantTwitterOutbox(self.logger, self.clock)
+
+        self.tracer = PlantTwitterFrameTracer(self.logger)
+
+        metrics = cmMetrics()
+        self.metric_sent = metrics.counter(
+            'plant_twitter_tweets_sent_total', 'Delivered tweets.')
+        self.metric_failures = metrics.counter(
+            'plant_twitter_tweet_failures_total', 'Failed tweet attempts.')
+        self.metric_send_time = metrics.histogram(
+            'plant_twitter_tweet_send_seconds', 'Time of a Twitter API request.')
+        self.metric_pending = metrics.gauge(
+            'plant_twitter_outbox_pending', 'Messages waiting in the outbox.')
+
     def tweetMessage(self):
+        """Create the messages of the devices that are due.
 
-        now_datetime = datetime.datetime.today()
-        eo_message = PlantTwitterMessage(self.logger)
-        tweet_update = False
+        時刻になったデバイスのメッセージを作成して、outboxに保存します。
+        デバイス毎にTWEET_INTERVAL_MINUTES分待ちますが、水やりを検知した
+        デバイスはすぐにメッセージを作成します。この関数はブロックしません。
 
-        # Tweet time conditions. : only between 20:00 from 4:00.
-        if self.clock_check:
-            if now_datetime.hour < 4 or now_datetime.hour > 20:
-                self.logger.debug("tweetMessage: don't tweet time(20:00-4:00).:{0}".format(
-                    now_datetime.strftime('%Y-%m-%d %H:%M:%S')))
-                return
+        Create the messages of the devices that are due, and store them in
+        the outbox. Each device waits TWEET_INTERVAL_MINUTES minutes, but a
+        device where watering is detected creates a message at once.
+        This function does not block.
+        """
 
-        # EnOcean devices tweet a message individually.
-        for b_sensor_id, device_model in self.config.device_list.items():
+        now = self.clock.time()
+        now_datetime = datetime.datetime.fromtimestamp(now)
+
+        # Tweet time conditions. : only between TWEET_HOURS_BEGIN and TWEET_HOURS_END.
+        if self.clock_check and self.scheduler.isActiveTime(now_datetime) is False:
+            self.logger.debug("tweetMessage: don't tweet time({0}:00-{1}:00).:{2}".format(
+                self.scheduler.hours_end, self.scheduler.hours_begin,
+                now_datetime.strftime('%Y-%m-%d %H:%M:%S')))
+            return
+
+        # Tweet a message quickly, if watering.
+        for b_sensor_id in self.readWateredDevices():
+            self.scheduler.wakeDevice(b_sensor_id, now)
+
+        devices = self.scheduler.popDueDevices(now)
+        if not devices:
+            return
+
+        # read the sensor data of the devices at once
+        prefetched = self.message.readDevices(
+            [(b_sensor_id.decode('utf-8'), self.config.device_list[b_sensor_id])
+             for b_sensor_id in devices])
+
+        self.outbox.openConnection()
 
-            message = ''
+        # EnOcean devices tweet a message individually.
+        for b_sensor_id in devices:
+            device_model = self.config.device_list[b_sensor_id]
 
             # create message
-            (message, now_watering) = eo_message.createMessage(
-                b_sensor_id.decode('utf-8'), device_model)
+            (message, now_watering) = self.message.createMessage(
+                b_sensor_id.decode('utf-8'), device_model,
+                prefetched.get(b_sensor_id.decode('utf-8')))
 
-            # Skip no message
+            # Skip no message: try it again later.
             if message == '':
+                self.scheduler.scheduleDevice(b_sensor_id, now + self.TWEET_RETRY_SECONDS)
                 continue
 
             # Tweet a message quickly, if watering.
-            if self.state_watering is False and now_watering is True:
-                # Send message
-                tweet_update = self.sendMessage(message)
-
+            if self.state_watering.get(b_sensor_id, False) is False and now_watering is True:
                 # Ignore a watering status for 30 minutes.
-                self.state_watering = True
+                self.state_watering[b_sensor_id] = True
+
+            # Tweet time conditions. : Ignore the tweet for 30 minutes.
+            elif self.clock_check and now < self.cooldowns.get(b_sensor_id, 0):
+                self.logger.debug("tweetMessage: tweet every {0} minutes.:{1} next tweet time {2}".format(
+                    self.tweet_interval // 60, b_sensor_id, datetime.datetime.fromtimestamp(
+                        self.cooldowns[b_sensor_id]).strftime('%Y-%m-%d %H:%M:%S')))
+                self.scheduler.scheduleDevice(b_sensor_id, self.cooldowns[b_sensor_id])
+                continue
 
             else:
-                # Tweet time conditions. : Ignore the tweet for 30 minutes.
-                if self.clock_check and (now_datetime < self.next_datetime):
-                    self.logger.debug("tweetMessage: tweet every 30 minutes.:next tweet time {0}".format(
-                        self.next_datetime.strftime('%Y-%m-%d %H:%M:%S')))
+                # Available a watering status.
+                self.state_watering[b_sensor_id] = False
+
+            # Send message
+            next_due = now + self.TWEET_RETRY_SECONDS
+            # the message has no year: the same text of another year is not a duplicate.
+            if self.outbox.enqueueMessage(message, self.outbox.createKey(
+                    b_sensor_id, message, now_datetime.year)):
+                # Set next tweet time after 30 minutes.
+                self.cooldowns[b_sensor_id] = now + self.tweet_interval
+                if self.clock_check:
+                    next_due = self.cooldowns[b_sensor_id]
+            self.traceMessage(b_sensor_id)
+            self.scheduler.scheduleDevice(b_sensor_id, next_due)
+
+        self.metric_pending.set(self.outbox.countPending())
+        self.outbox.closeConnection()
+
+    def getWaitSeconds(self):
+        """Return the seconds until tweetMessage() has a device to create.
+
+        次にメッセージを作成するデバイスの時刻(時間帯の外では時間帯の開始)
+        までの秒数を返します。デバイスがない場合はNoneを返します。
+
+        Return the seconds until the next device is due (or the active hours
+        begin, if out of them). If there is no device, return None.
+        """
+
+        now = self.clock.time()
+        now_datetime = datetime.datetime.fromtimestamp(now)
+        if self.clock_check and self.scheduler.isActiveTime(now_datetime) is False:
+            return (self.scheduler.getActiveTime(now_datetime) - now_datetime).total_seconds()
+
+        due = self.scheduler.getNextDue()
+        if due is None:
+            return None
+        return max(0.0, due - now)
+
+    def sleepUntilDue(self):
+        # check the watering events every minute.
+        wait = self.getWaitSeconds()
+        self.clock.sleep(60 if wait is None else min(60, max(1, wait)))
+
+    def readWateredDevices(self):
+        # the devices of the watering events registered after the last check
+        checked_at = self.watering_checked_at - self.WATERING_CHECK_MARGIN
+        self.watering_checked_at = int(self.clock.time() * 1000)
+
+        if self.readings is not None:
+            events = self.readings.selectWateringEventsAfter(checked_at)
+        else:
+            data_store = PlantTwitterDatastore(self.logger, self.clock)
+            data_store.openConnection()
+            events = data_store.selectWateringEventsAfter(checked_at)
+            data_store.closeConnection()
+
+        devices = set()
+        for e in events:
+            b_sensor_id = e[PlantTwitterDatastore.ROW_INDEX_WATERING_ORIGINATOR_ID]
+            if isinstance(b_sensor_id, str):
+                b_sensor_id = b_sensor_id.encode('utf-8')
+            if b_sensor_id in self.config.device_list:
+                devices.add(b_sensor_id)
+        return devices
+
+    def traceMessage(self, b_sensor_id):
+        # daemon.py: the latency from the frame of the latest values to the message
+        if self.readings is not None:
+            self.tracer.finishTweet(self.readings.popTrace(b_sensor_id))
+
+    def deliverMessages(self, component='tweet'):
+        """Send the queued messages in the outbox.
+
+        OUTBOXに保存したメッセージを送信します。componentはヘルスチェックの
+        コンポーネント名です。
+        この関数は、スレッドとして起動されます。
+
+        Send the queued messages in the outbox. component is the name of the
+        component of the health check.
+        This function is called by thread object.
+        """
+
+        outbox = PlantTwitterOutbox(self.logger, self.clock)
+        outbox.openConnection()
+
+        cmMetrics().setReady(component)
+
+        prune_at = 0
+        while True:
+            if self.clock.monotonic() >= prune_at:
+                outbox.pruneMessages()
+                prune_at = self.clock.monotonic() + self.OUTBOX_PRUNE_SECONDS
+
+            if self.deliverPending(outbox) == 0:
+                # sleep 1.0 sec
+                self.clock.sleep(1)
+
+    def deliverPending(self, outbox=None, block=True):
+        """Send the messages that are due, and return the number of attempts.
+
+        送信時刻になったメッセージを送信して、送信を試みた件数を返します。
+        blockがFalseの場合は、送信制限のトークンを待たずに戻ります。
+
+        Send the messages that are due, and return the number of attempts.
+        If block is False, return without waiting for a token of the rate
+        limit.
+        """
+
+        close_outbox = False
+        if outbox is None:
+            outbox = PlantTwitterOutbox(self.logger, self.clock)
+            outbox.openConnection()
+            close_outbox = True
+
+        attempts = 0
+        for row in outbox.selectDueMessages():
+
+            # Wait for a token of the rate limit.
+            wait = self.token_bucket.consume()
+            if wait > 0 and block is False:
+                break
+            while wait > 0:
+                self.clock.sleep(wait)
+                wait = self.token_bucket.consume()
+
+            attempts += 1
+            begin_time = time.perf_counter()
+            if self.sendMessage(row[outbox.ROW_INDEX_MESSAGE]):
+                outbox.markSent(row[outbox.ROW_INDEX_ID])
+                self.metric_sent.inc()
+            else:
+                outbox.markRetry(row[outbox.ROW_INDEX_ID], row[outbox.ROW_INDEX_ATTEMPTS],
+                                 self.last_error, self.retry_after)
+                self.metric_failures.inc()
+            self.metric_send_time.observe(time.perf_counter() - begin_time)
 
-                else:
-                    # Send message
-                    tweet_update = self.sendMessage(message)
+        if attempts > 0:
+            self.metric_pending.set(outbox.countPending())
 
-                    # Available a watering status.
-                    self.state_watering = False
+        if close_outbox:
+            outbox.closeConnection()
 
-        if tweet_update:
-            # Set next tweet time after 30 minutes.
-            self.next_datetime = now_datetime + datetime.timedelta(minutes=30)
+        return attempts
 
     def sendMessage(self, message):
 
-        # Create instance of twitter
-        eo_twitter = Twitter(auth=OAuth(
-            self.access_token, self.access_secret, self.consumer_key, self.consumer_secret))
-
         self.logger.info("sendMessage:'{0}'".format(message))
 
+        self.last_error = ''
+        self.retry_after = 0
+
         # Tweet message
         try:
-            eo_twitter.statuses.update(status=message)
-
-            # tweet interval 1.0 sec
-            time.sleep(1)
+            self.twitter.statuses.update(status=message)
+
+        except TwitterHTTPError as e:
+            # Already tweeted by the previous attempt.
+            if self.TWITTER_ERROR_DUPLICATE in self.getErrorCodes(e):
+                self.logger.info("sendMessage: duplicate status.")
+                return True
+
+            # Rate limit exceeded: wait until the limit is reset.
+            if e.e.code == 429:
+                reset = e.e.headers.get('x-rate-limit-reset')
+                if reset is not None:
+                    self.retry_after = max(0, int(reset) - self.clock.time())
+
+            self.last_error = "HTTP {0}".format(e.e.code)
+            self.logger.error("sendMessage: Twitter API error.:{0}".format(e))
+            return False
 
         except:
             e_type, e_value, e_traceback = sys.exc_info()
             self.logger.error("Exception serial reading.:{0}".format(
                 traceback.format_exception(e_type, e_value, e_traceback)))
+            self.last_error = str(e_value)
             return False
 
         return True
 
+    def getErrorCodes(self, e):
+        try:
+            return [error['code'] for error in e.response_data['errors']]
+        except (KeyError, TypeError):
+            return []
+
 
 if __name__ == '__main__':
 
@@ -165,8 +429,25 @@ if __name__ == '__main__':
 
     eo_tweet = PlantTwitterTweet(logger)
 
+    # start metrics server
+    cmMetricsServer(logger).startServer('METRICS_TWEET_PORT')
+
+    # setup profiler: config.ini or SIGUSR1
+    PlantTwitterProfiler(logger).setup()
+
+    # start thread message delivery
+    try:
+        logger.info("start thread: deliverMessages")
+        eo_thread = threading.Thread(target=eo_tweet.deliverMessages)
+        eo_thread.setDaemon(True)
+        eo_thread.start()
+    except:
+        e_type, e_value, e_traceback = sys.exc_info()
+        logger.error("Exception tweet delivery.:{0}".format(
+            traceback.format_exception(e_type, e_value, e_traceback)))
+
     while True:
         eo_tweet.tweetMessage()
-        time.sleep(60)
+        eo_tweet.sleepUntilDue()
 
     logger.debug("--- end: {0} ----".format(__file__))
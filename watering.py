@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Detect watering from the stream of soil moisture.
+
+Copyright (c) 2017 Iori Nishida <iori.nishida@connect-me.net>
+
+STM431JS(土壌湿度センサー付き)の土壌水分量をパケット受信ごとに調べて、
+水やりを検知します。デバイス毎に直近の時間枠(MESSAGE_CONDITION_WATERING_MINUTES)
+の最小値を単調キュー(deque)で保持するので、1回の更新はO(1)です。
+水分量が最小値からMESSAGE_CONDITION_WATERING_RISEより多く増えて、
+MESSAGE_CONDITION_SOIL_MOISTURE_DRY以上になったときに水やりイベントを返します。
+イベントはregisterモジュールが'WATERING_EVENTS'テーブルに登録します。
+
+Detect watering from the soil moisture of STM431JS (with Soil Moisture) on
+every received packet. The minimum of the recent window
+(MESSAGE_CONDITION_WATERING_MINUTES) is kept in a monotonic deque for each
+device, so an update costs O(1).
+When the soil moisture rises more than MESSAGE_CONDITION_WATERING_RISE from
+the minimum and is MESSAGE_CONDITION_SOIL_MOISTURE_DRY or more, a watering
+event is returned. The register module registers the event into the
+'WATERING_EVENTS' table.
+
+"""
+
+from collections import deque
+
+from config import cmConfig
+from logger import cmLogger
+
+
+class PlantTwitterWateringDetector():
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.config = cmConfig()
+
+        self.soil_moisture_dry = int(self.config.option_list['Message'][
+                                     'MESSAGE_CONDITION_SOIL_MOISTURE_DRY'])
+        self.watering_rise = int(self.config.option_list['Message'][
+                                 'MESSAGE_CONDITION_WATERING_RISE'])
+        self.watering_window = int(self.config.option_list['Message'][
+                                   'MESSAGE_CONDITION_WATERING_MINUTES']) * 60 * 1000
+
+        # sliding window minimum of each device: deque of (received_at, soil moisture)
+        self.windows = {}
+
+    def hasDevice(self, originator_id):
+        return originator_id in self.windows
+
+    def loadSoilMoisture(self, data_store, originator_id, device_model, before_at):
+        """Fill the window of the device from the database.
+
+        再起動直後でも検知できるように、データベースから直近の値を読み込みます。
+
+        Fill the window of the device from the database, so that watering
+        can be detected just after the restart.
+        The rows received at before_at or later are skipped.
+        """
+
+        self.windows[originator_id] = deque()
+
+        sensor_rows = data_store.selectRecord(originator_id, device_model)
+        for r in reversed(sensor_rows):
+            if r[data_store.ROW_INDEX_SOIL_MOISTURE] == '' or \
+                    r[data_store.ROW_INDEX_RECEIVED_AT] >= before_at:
+                continue
+            self.pushSoilMoisture(originator_id, r[data_store.ROW_INDEX_SOIL_MOISTURE],
+                                  r[data_store.ROW_INDEX_RECEIVED_AT])
+
+    def pushSoilMoisture(self, originator_id, soil_moisture, received_at):
+        window = self.windows.setdefault(originator_id, deque())
+
+        # evict values older than the window
+        while window and received_at - window[0][0] > self.watering_window:
+            window.popleft()
+
+        # keep the values increasing: the head is the minimum
+        while window and window[-1][1] >= soil_moisture:
+            window.pop()
+        window.append((received_at, soil_moisture))
+
+    def updateSoilMoisture(self, originator_id, soil_moisture, received_at):
+        """Update the window, and return a watering event if detected.
+
+        時間枠を更新して、水やりを検知した場合はイベント
+        (originator_id, soil_moisture, soil_moisture_before, received_at)
+        を返します。検知しない場合はNoneを返します。
+
+        Update the window, and return a watering event
+        (originator_id, soil_moisture, soil_moisture_before, received_at)
+        if detected. Otherwise return None.
+        """
+
+        event = None
+        window = self.windows.setdefault(originator_id, deque())
+
+        while window and received_at - window[0][0] > self.watering_window:
+            window.popleft()
+
+        if window:
+            soil_moisture_before = window[0][1]
+            if (soil_moisture - soil_moisture_before) > self.watering_rise and \
+                    soil_moisture >= self.soil_moisture_dry:
+                event = (originator_id, soil_moisture,
+                         soil_moisture_before, received_at)
+                self.logger.info("detect watering:id={0} soil moisture={1} before={2}".format(
+                    originator_id, soil_moisture, soil_moisture_before))
+
+                # start a new window after watering
+                window.clear()
+
+        self.pushSoilMoisture(originator_id, soil_moisture, received_at)
+
+        return event